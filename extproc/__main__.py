@@ -1,17 +1,45 @@
 import logging
+from typing import Callable, List
+
+from envoy.service.ext_proc.v3.external_processor_pb2_grpc import (
+    ExternalProcessorServicer,
+)
 
 from . import processors
-from .service import serve
+from .service import serve, serve_processes
 
 logger = logging.getLogger(__name__)
 
 
-def is_service(svc: str):
-    if hasattr(processors, svc):
-        return svc
+# allow short names, like "Authn" for "AuthnExternalProcessorService"
+SERVICE_SUFFIXES = ["", "ExternalProcessorService", "Service"]
+
+
+def is_service(svc: str) -> List[str]:
+    """resolve a processor, or a comma separated list of processors to compose"""
+    return [find_service(name.strip()) for name in svc.split(",")]
+
+
+def find_service(svc: str) -> str:
+    for suffix in SERVICE_SUFFIXES:
+        if hasattr(processors, f"{svc}{suffix}"):
+            return f"{svc}{suffix}"
     raise AttributeError(f"{svc} is not defned in processors")
 
 
+def service_factory(services: List[str]) -> Callable[[], ExternalProcessorServicer]:
+    """a single processor, or a composite running the processors in order"""
+    if len(services) == 1:
+        return getattr(processors, services[0])
+
+    def factory() -> ExternalProcessorServicer:
+        return processors.CompositeExternalProcessorService(
+            [getattr(processors, svc)() for svc in services]
+        )
+
+    return factory
+
+
 def run() -> None:
     """main run function. this pattern will be easier to test."""
 
@@ -31,15 +59,35 @@ def run() -> None:
         required=False,
         type=is_service,
         default="BaseExternalProcessorService",
-        help="Processor to use",
+        help="Processor to use, or comma separated processors to run in order (e.g. Authn,Digest)",
+    )
+    runner.add_argument(
+        "-a",
+        "--asyncio",
+        dest="asyncio",
+        action="store_true",
+        default=False,
+        help="Serve with grpc.aio (async processor hooks, streams don't hold threads)",
+    )
+    runner.add_argument(
+        "-p",
+        "--processes",
+        dest="processes",
+        required=False,
+        type=int,
+        default=1,
+        help="Number of (pre-forked) server processes sharing the port",
     )
 
     args: argparse.Namespace = parser.parse_args()
 
     if args.command == "run":
         try:
-            service = getattr(processors, args.service)()
-            serve(service=service)
+            factory = service_factory(args.service)
+            if args.processes > 1:
+                serve_processes(factory, args.processes, use_asyncio=args.asyncio)
+            else:
+                serve(service=factory(), use_asyncio=args.asyncio)
         except KeyboardInterrupt:
             exit(0)
         finally:
@@ -1,6 +1,11 @@
 from .authn import AuthnExternalProcessorService  # noqa: F401
 from .base import BaseExternalProcessorService  # noqa: F401
+from .composite import CompositeExternalProcessorService  # noqa: F401
 from .concurrtest import ConcurrencyTestingService  # noqa: F401
+from .context import CallContext  # noqa: F401
 from .digester import DigestExternalProcessorService  # noqa: F401
 from .idempotency import IdempotencyExternalProcessorService  # noqa: F401
+from .idempotency import (  # noqa: F401
+    WaitingIdempotencyExternalProcessorService,
+)
 from .logging import LoggingExternalProcessorService  # noqa: F401
@@ -1,20 +1,41 @@
 from base64 import urlsafe_b64decode, urlsafe_b64encode
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from json import dumps
+from hashlib import sha256
+import hmac
+from json import dumps, loads
 from logging import getLogger
-from os import environ
+from os import environ, urandom
 import re
-from typing import Dict, List, Optional, Tuple, Union
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
 from envoy.config.core.v3.base_pb2 import HeaderValue as EnvoyHeaderValue
+from envoy.config.core.v3.base_pb2 import (
+    HeaderValueOption as EnvoyHeaderValueOption,
+)
 from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
 from envoy.type.v3.http_status_pb2 import HttpStatus, StatusCode
 from google.protobuf.timestamp_pb2 import Timestamp
 from grpc import ServicerContext
 import jwt
-import requests
 
+from ..utils.cache import FlightTimeout, LRUCache, SingleFlight, WindowCounter
+from ..utils.headers import HeaderView
+from ..utils.http import CircuitBreaker, CircuitOpen, HttpClient, Unavailable
+from ..utils.identity import encode_identity, IDENTITY_HEADER, LEGACY_HEADERS
+from ..utils.jwks import KeySet, KeysUnavailable, UnknownKey
+from ..utils.revocations import RevocationSet
+from ..utils.routes import Route, RouteMatcher
+from ..utils.scopes import (
+    ANY_METHOD,
+    claims_scopes,
+    load_route_scopes,
+    ScopeBits,
+)
+from ..utils.shared import SharedCache
 from .base import BaseExternalProcessorService
+from .context import CallContext
 
 logger = getLogger(__name__)
 
@@ -22,6 +43,43 @@ AUTH_HOST = environ.get("AUTH_HOST", "http://auth")
 AUTH_PORT = int(environ.get("AUTH_PORT", "443"))
 AUTH_URL = f"{AUTH_HOST}:{AUTH_PORT}/api/v0/tokens"
 
+# auth service client; a connection per (grpc) worker thread, and
+# timeouts, retries, hedging and circuit breaking (see utils.http)
+AUTH_POOL_SIZE = int(environ.get("AUTH_POOL_SIZE", environ.get("GRPC_WORKERS", "5")))
+AUTH_CONNECT_TIMEOUT = float(environ.get("AUTH_CONNECT_TIMEOUT", "1.0"))
+AUTH_READ_TIMEOUT = float(environ.get("AUTH_READ_TIMEOUT", "5.0"))
+AUTH_RETRIES = int(environ.get("AUTH_RETRIES", "2"))
+AUTH_RETRY_BACKOFF = float(environ.get("AUTH_RETRY_BACKOFF", "0.1"))
+AUTH_HEDGE_AFTER = float(environ.get("AUTH_HEDGE_AFTER", "0.5"))  # 0 to not hedge
+AUTH_BREAKER_FAILURES = int(environ.get("AUTH_BREAKER_FAILURES", "5"))
+AUTH_BREAKER_RESET = float(environ.get("AUTH_BREAKER_RESET", "10.0"))
+# all attempts (and backoff) of a call; keep it below envoy's message_timeout
+# for the authn filter (5s), so a slow auth service gets a 503, not a timeout
+AUTH_DEADLINE = float(environ.get("AUTH_DEADLINE", "4.0"))
+
+# how long requests wait on a call to the auth service made for the same
+# API key by another request (see SingleFlight)
+AUTH_COALESCE_TIMEOUT = float(environ.get("AUTH_COALESCE_TIMEOUT", "5.0"))
+
+# API keys (by secret digest) the auth service rejected, kept (and rejected
+# without asking again) for AUTH_REJECTION_TTL seconds
+AUTH_REJECTION_CACHE_SIZE = int(environ.get("AUTH_REJECTION_CACHE_SIZE", "10000"))
+AUTH_REJECTION_TTL = float(environ.get("AUTH_REJECTION_TTL", "30"))
+
+# after this many failed authentications for a key id, or from a client
+# (address), in AUTH_FAILURE_WINDOW seconds, respond 429 until the window
+# ends, without asking the auth service (0 to not limit); for a key id, only
+# to credentials that aren't cached (valid ones keep working)
+AUTH_FAILURE_WINDOW = float(environ.get("AUTH_FAILURE_WINDOW", "60"))
+AUTH_KEY_FAILURE_LIMIT = int(environ.get("AUTH_KEY_FAILURE_LIMIT", "10"))
+AUTH_CLIENT_FAILURE_LIMIT = int(environ.get("AUTH_CLIENT_FAILURE_LIMIT", "50"))
+AUTH_FAILURE_COUNTERS_SIZE = int(environ.get("AUTH_FAILURE_COUNTERS_SIZE", "100000"))
+
+# the client (address) is the one envoy trusts: its x-envoy-external-address,
+# else the X-Forwarded-For hop before the last AUTH_XFF_TRUSTED_HOPS (match
+# envoy's xff_num_trusted_hops; envoy appends the peer with use_remote_address)
+AUTH_XFF_TRUSTED_HOPS = int(environ.get("AUTH_XFF_TRUSTED_HOPS", "0"))
+
 # match the service settings
 TOKEN_PUBLIC_KEY = environ.get("TOKEN_PUBLIC_KEY", "CHANGE_ME_PLEASE")
 TOKEN_PRIVATE_KEY = environ.get("TOKEN_PRIVATE_KEY", "CHANGE_ME_PLEASE")
@@ -29,6 +87,36 @@ TOKEN_ALGORITHM = environ.get("TOKEN_ALGORITHM", "HS256")
 TOKEN_ISSUER = environ.get("TOKEN_ISSUER", "auth")
 TOKEN_AUDIENCE = environ.get("TOKEN_AUDIENCE", "auth")
 
+# asymmetric (RS256 and ES256) tokens are verified with keys from a JWKS
+# document, a file or URL, (re)loaded every TOKEN_JWKS_REFRESH seconds
+TOKEN_JWKS = environ.get("TOKEN_JWKS", "")
+TOKEN_JWKS_REFRESH = float(environ.get("TOKEN_JWKS_REFRESH", "300"))
+JWKS_ALGORITHMS = ["RS256", "ES256"]
+
+# tokens of API keys revoked in the auth service are rejected, with revocations
+# polled (every TOKEN_REVOCATIONS_INTERVAL seconds) from this URL, if set
+TOKEN_REVOCATIONS = environ.get("TOKEN_REVOCATIONS", "")
+TOKEN_REVOCATIONS_INTERVAL = float(environ.get("TOKEN_REVOCATIONS_INTERVAL", "2"))
+
+# verified tokens (by digest) kept, until they expire
+TOKEN_CACHE_SIZE = int(environ.get("TOKEN_CACHE_SIZE", "10000"))
+
+# verified tokens and tokens issued for API keys are also kept in a cache
+# shared by the server processes (on a host), in this (memory-mapped) file
+# if set, e.g. /dev/shm/extproc-authn (the file name gets the slots and slot
+# size appended); values are up to a slot size (less 52)
+AUTH_SHARED_CACHE = environ.get("AUTH_SHARED_CACHE", "")
+AUTH_SHARED_CACHE_SLOTS = int(environ.get("AUTH_SHARED_CACHE_SLOTS", "16384"))
+AUTH_SHARED_CACHE_SLOT_SIZE = int(environ.get("AUTH_SHARED_CACHE_SLOT_SIZE", "2048"))
+
+# tokens issued for API keys (basic auth) kept, until TOKEN_EXCHANGE_MARGIN
+# seconds before they expire; used within TOKEN_REFRESH_AHEAD seconds of
+# that, a new token is fetched in the background
+TOKEN_EXCHANGE_CACHE_SIZE = int(environ.get("TOKEN_EXCHANGE_CACHE_SIZE", "10000"))
+TOKEN_EXCHANGE_MARGIN = float(environ.get("TOKEN_EXCHANGE_MARGIN", "10"))
+TOKEN_REFRESH_AHEAD = float(environ.get("TOKEN_REFRESH_AHEAD", "60"))
+TOKEN_REFRESH_WORKERS = int(environ.get("TOKEN_REFRESH_WORKERS", "2"))
+
 
 PATH_REGEX = re.compile(r"/(api|docs|test)/v(([0-9]+)(\.[0-9]+)?)/(/.*)?$")
 # Groups:
@@ -44,7 +132,14 @@ UUID_REGEX = re.compile(r"[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}")
 PATH_PARAM_PATTERNS = [UUID_REGEX]  # add other path param styles IYI
 
 
-WHITELIST = ["/health"]
+WHITELIST = ["/health"]  # routes (templates) not authenticated
+
+# concrete paths memoized, with their route (see utils.routes)
+ROUTE_CACHE_SIZE = int(environ.get("ROUTE_CACHE_SIZE", "10000"))
+
+# scopes required, by route and method, as (inline) JSON or a JSON file
+# (see utils.scopes); routes not listed require none
+ROUTE_SCOPES = environ.get("ROUTE_SCOPES", "")
 
 
 @dataclass
@@ -55,6 +150,14 @@ class HeaderInfo:
     token: Optional[str] = None
     method: Optional[str] = None
     path: Optional[str] = None
+    client: Optional[str] = None
+
+
+@dataclass
+class VerifiedToken:
+    claims: Dict
+    encoded_identity: str  # the X-Gateway-Identity header value
+    scopes: int = 0  # granted, as a mask (see utils.scopes)
 
 
 @dataclass
@@ -80,12 +183,70 @@ class MalformedURL(Exception):
     pass
 
 
+class Forbidden(Exception):
+    pass
+
+
+class Throttled(Exception):
+    """too many failed authentications"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AuthnCallContext(CallContext):
+    """the route of the request (see utils.routes)"""
+
+    __slots__ = ("route",)
+
+
 class AuthnExternalProcessorService(BaseExternalProcessorService):
+    context_class = AuthnCallContext
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # required scopes, as masks, by route template and method
+        self.scope_bits = ScopeBits()
+        self.required_scopes = {
+            template: {
+                method: self.scope_bits.required(scopes) for method, scopes in methods.items()
+            }
+            for template, methods in load_route_scopes(ROUTE_SCOPES).items()
+        }
+        self.routes = route_matcher(self.required_scopes)
+        self.tokens = LRUCache(TOKEN_CACHE_SIZE)
+
+        # behind the (per process) caches, one shared by processes
+        self.shared: Optional[SharedCache] = None
+        if AUTH_SHARED_CACHE:
+            self.shared = SharedCache(
+                AUTH_SHARED_CACHE,
+                slots=AUTH_SHARED_CACHE_SLOTS,
+                slot_size=AUTH_SHARED_CACHE_SLOT_SIZE,
+            )
+
+        # (key id, secret digest) -> token; secrets are only kept digested,
+        # with a random key (per process, or shared with the cache)
+        self.exchanges = LRUCache(TOKEN_EXCHANGE_CACHE_SIZE)
+        self._secret_key = urandom(32) if self.shared is None else self.shared.secret
+        self._refreshing: Set[Tuple[str, bytes]] = set()
+        self._refreshing_lock = Lock()
+        self._refresher: Optional[ThreadPoolExecutor] = None
+
+        # one auth service call per API key at a time
+        self.flights = SingleFlight(timeout=AUTH_COALESCE_TIMEOUT)
+
+        # rejected API keys, and failures by key id and by client
+        self.rejections = LRUCache(AUTH_REJECTION_CACHE_SIZE)
+        self.key_failures = WindowCounter(AUTH_FAILURE_COUNTERS_SIZE, AUTH_FAILURE_WINDOW)
+        self.client_failures = WindowCounter(AUTH_FAILURE_COUNTERS_SIZE, AUTH_FAILURE_WINDOW)
+
     def process_request_headers(
         self,
         headers: ext_api.HttpHeaders,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: AuthnCallContext,
     ) -> Union[ext_api.HeadersResponse, ext_api.ImmediateResponse]:
 
         response = self.just_continue_headers()
@@ -96,23 +257,80 @@ class AuthnExternalProcessorService(BaseExternalProcessorService):
         started.GetCurrentTime()
         self.add_header(common_response, "X-Request-Started", started.ToJsonString())
 
-        info = extract_header_info(headers.headers.headers)
+        info = extract_header_info(self.header_view(headers, callctx))
+
+        # identity headers are only set here, never passed on from clients
+        for name in LEGACY_HEADERS:
+            self.remove_header(common_response, name)
+
+        # a bounded set of endpoints, for metrics and rate limits
+        callctx.route = route = self.routes.match(info.path or "/")
+        self.add_header(common_response, "X-Gateway-Endpoint", route.template)
+        if route.public:  # not authenticated, so no identity (even if passed)
+            self.remove_header(common_response, IDENTITY_HEADER)
+            return response
 
         try:
 
-            if info.token is None:
-                info.token = verify_basic_auth(info.identity, info.secret)
+            try:
+                if info.token is None:
+                    info.token = self.exchange_basic_auth(info.identity, info.secret, info.client)
+                verified = self.verify_token(info.token)
+            except Unauthenticated:
+                self.count_failure(info)
+                raise
 
-            claims = verify_token(info.token)
-            encoded_claims = urlsafe_b64encode(dumps(claims).encode())
+            claims = verified.claims
+            check_revoked(claims)
+            self.authorize(verified, route, info.method)
 
-            if info.identity:
-                self.add_header(common_response, "X-Gateway-KeyId", claims["identity"]["key_id"])
-            self.add_header(common_response, "X-Gateway-Tenant", claims["identity"]["tenant"])
-            self.add_header(common_response, "X-Gateway-UserId", claims["identity"]["user_id"])
-            self.add_header(common_response, "X-Auth-Claims", encoded_claims)
+            # one (compact) header for processors and upstreams (see utils.identity)
+            self.add_header(common_response, "X-Gateway-Identity", verified.encoded_identity)
             return response
 
+        except Throttled as err:
+            return ext_api.ImmediateResponse(
+                status=HttpStatus(code=StatusCode.TooManyRequests),
+                headers=retry_after_headers(err.retry_after),
+                body=dumps(
+                    {
+                        "message": "TooManyRequests",
+                        "status": 429,
+                        "details": f"{err.__class__.__name__} {err}",
+                    }
+                ),
+                details=f"{err.__class__.__name__} {err}",
+            )
+
+        except Unavailable as err:
+            retry_after = err.retry_after if isinstance(err, CircuitOpen) else AUTH_BREAKER_RESET
+            return ext_api.ImmediateResponse(
+                status=HttpStatus(code=StatusCode.ServiceUnavailable),
+                headers=retry_after_headers(retry_after),
+                body=dumps(
+                    {
+                        "message": "ServiceUnavailable",
+                        "status": 503,
+                        "details": f"{err.__class__.__name__} {err}",
+                    }
+                ),
+                details=f"{err.__class__.__name__} {err}",
+            )
+
+        except Forbidden as err:
+            return ext_api.ImmediateResponse(
+                status=HttpStatus(code=StatusCode.Forbidden),
+                headers=ext_api.HeaderMutation(),
+                body=dumps(
+                    {
+                        "message": "Forbidden",
+                        "status": 403,
+                        "details": f"{err.__class__.__name__} {err}",
+                    }
+                ),
+                details=f"{err.__class__.__name__} {err}",
+            )
+
         except Unauthenticated as err:
             return ext_api.ImmediateResponse(
                 status=HttpStatus(code=StatusCode.Unauthorized),
@@ -143,24 +361,174 @@ class AuthnExternalProcessorService(BaseExternalProcessorService):
 
         return self.just_continue_headers()
 
+    def verify_token(self, token: str) -> VerifiedToken:
+        """
+        verify a token, or find it verified already: clients reuse a token
+        until it expires, so the claims (and their encoding) are cached
+        (by token digest) until then
+        """
+        key = sha256(token.encode()).digest()
+        verified = self.tokens.get(key)
+        if verified is not None:
+            return verified
+
+        shared = None if self.shared is None else self.shared.get(key)
+        if shared is not None:  # verified by another process
+            encoded, expires_at = shared
+            verified = self.verified_token(loads(encoded))
+            self.tokens.set(key, verified, expires_at)
+            return verified
+
+        claims = verify_token(token)
+        encoded = dumps(claims).encode()
+        verified = self.verified_token(claims)
+        if "exp" in claims:  # can't tell when others expire
+            self.tokens.set(key, verified, float(claims["exp"]))
+            if self.shared is not None:
+                self.shared.set(key, encoded, float(claims["exp"]))
+        return verified
+
+    def verified_token(self, claims: Dict) -> VerifiedToken:
+        return VerifiedToken(
+            claims=claims,
+            encoded_identity=encode_identity(claims),
+            scopes=self.scope_bits.granted(claims_scopes(claims)),
+        )
 
-def extract_header_info(headers: List[EnvoyHeaderValue]) -> HeaderInfo:
-
-    info = HeaderInfo()
-
-    for header in headers:
-        if header.key == ":method":
-            info.method = str(header.value)
-        elif header.key == ":path":
-            info.path = str(header.value)
-        elif header.key == "identity":
-            info.identity = str(header.value)
-        elif header.key == "authorization":
-            info.authorization = str(header.value)
-        elif header.key == "x-api-key":
-            info.secret = str(header.value)
-        elif header.key == "x-api-token":
-            info.token = str(header.value)
+    def check_failures(self, counter: WindowCounter, key: Optional[str], limit: int) -> None:
+        """raise Throttled, if the key (a client or key id) failed too often lately"""
+        if key is not None and limit and counter.count(key) >= limit:
+            raise Throttled("Too many failed authentications", counter.retry_after(key))
+
+    def count_failure(self, info: HeaderInfo) -> None:
+        for counter, key, _ in self.failure_counters(info):
+            counter.add(key)
+
+    def failure_counters(self, info: HeaderInfo) -> List[Tuple[WindowCounter, str, int]]:
+        counters = []
+        if info.identity is not None:
+            counters.append((self.key_failures, info.identity, AUTH_KEY_FAILURE_LIMIT))
+        if info.client is not None:
+            counters.append((self.client_failures, info.client, AUTH_CLIENT_FAILURE_LIMIT))
+        return counters
+
+    def authorize(self, verified: VerifiedToken, route: Route, method: Optional[str]) -> None:
+        """raise Forbidden, unless the token has the scopes the route requires"""
+        methods = self.required_scopes.get(route.template)
+        if methods is None:
+            return
+        required = methods.get(method, methods.get(ANY_METHOD, 0))
+        if verified.scopes & required != required:
+            raise Forbidden(f"Missing scopes for {method} {route.template}")
+
+    def exchange_basic_auth(self, identity: str, secret: str, client: Optional[str] = None) -> str:
+        """
+        a token for an API key (identity and secret), from the auth service
+        or cached; cached tokens are refreshed (in the background) ahead of
+        their expiry, so keys in use don't wait on the auth service. Keys
+        and clients failing too often are throttled on cache misses only
+        """
+        check_basic_auth(identity, secret)
+
+        key = (identity, hmac.new(self._secret_key, secret.encode(), sha256).digest())
+        # the token and its expiry in one lookup, as the entry can expire
+        # (or be evicted by another thread) between two
+        cached = self.exchanges.get_with_expiry(key)
+        if cached is None and self.shared is not None:
+            cached = self.shared_exchange(key)
+        if cached is None:
+            rejection = self.rejections.get(key)
+            if rejection is not None:
+                raise Unauthenticated(rejection)
+            # only here, so failures with other secrets (or from the same
+            # address, e.g. behind a proxy) don't lock out the holders of
+            # (cached) valid credentials
+            self.check_failures(self.key_failures, identity, AUTH_KEY_FAILURE_LIMIT)
+            self.check_failures(self.client_failures, client, AUTH_CLIENT_FAILURE_LIMIT)
+            # concurrent requests with the same API key share one call
+            try:
+                return self.flights.do(key, self.fetch_exchange, key, identity, secret)
+            except FlightTimeout as err:
+                raise Unavailable(f"{err}") from err
+
+        token, expires_at = cached
+        if expires_at - self.exchanges.clock() < TOKEN_REFRESH_AHEAD:
+            self.refresh_exchange(key, identity, secret)
+        return token
+
+    def fetch_exchange(self, key: Tuple[str, bytes], identity: str, secret: str) -> str:
+        """a (new) token for an API key from the auth service, cached (or its rejection)"""
+        try:
+            token = verify_basic_auth(identity, secret)
+        except Unauthenticated as err:
+            self.rejections.set(key, f"{err}", self.rejections.clock() + AUTH_REJECTION_TTL)
+            raise
+        claims = self.verify_token(token).claims  # verified (and cached) for use anyway
+        if "exp" in claims:
+            expires_at = float(claims["exp"]) - TOKEN_EXCHANGE_MARGIN
+            self.exchanges.set(key, token, expires_at)
+            if self.shared is not None:
+                self.shared.set(shared_exchange_key(key), token.encode(), expires_at)
+        return token
+
+    def shared_exchange(self, key: Tuple[str, bytes]) -> Optional[Tuple[str, float]]:
+        """a token for an API key fetched by another process (and its expiry), if any"""
+        shared = self.shared.get(shared_exchange_key(key))
+        if shared is None:
+            return None
+        token, expires_at = shared[0].decode(), shared[1]
+        self.exchanges.set(key, token, expires_at)
+        return token, expires_at
+
+    def refresh_exchange(self, key: Tuple[str, bytes], identity: str, secret: str) -> None:
+        """fetch a new token for an API key in the background, once at a time"""
+        with self._refreshing_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            if self._refresher is None:
+                self._refresher = ThreadPoolExecutor(max_workers=TOKEN_REFRESH_WORKERS)
+
+        def refresh() -> None:
+            try:
+                self.flights.do(key, self.fetch_exchange, key, identity, secret)
+            except Exception as err:
+                # keep the cached token; it's good until it expires anyway
+                logger.warning(
+                    f"Token refresh for {identity} failed: {err.__class__.__name__} {err}"
+                )
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(key)
+
+        self._refresher.submit(refresh)
+
+
+def shared_exchange_key(key: Tuple[str, bytes]) -> bytes:
+    """(key id, secret digest) as a shared cache key"""
+    return sha256(key[0].encode() + key[1]).digest()
+
+
+def route_matcher(templates: Iterable[str] = ()) -> RouteMatcher:
+    routes = RouteMatcher(PATH_PARAM_PATTERNS, cache_size=ROUTE_CACHE_SIZE)
+    for template in templates:
+        routes.add(template)
+    for template in WHITELIST:
+        routes.add(template, public=True)
+    return routes
+
+
+def extract_header_info(headers: HeaderView) -> HeaderInfo:
+
+    info = HeaderInfo(
+        method=headers.get(":method"),
+        path=headers.get(":path"),
+        identity=headers.get("identity"),
+        authorization=headers.get("authorization"),
+        secret=headers.get("x-api-key"),
+        token=headers.get("x-api-token"),
+        client=client_address(headers),
+    )
 
     if info.authorization is not None:
         if info.authorization.lower().startswith("bearer "):
@@ -174,23 +542,52 @@ def extract_header_info(headers: List[EnvoyHeaderValue]) -> HeaderInfo:
     return info
 
 
+def client_address(headers: HeaderView) -> Optional[str]:
+    """
+    the client address envoy trusts; not the first X-Forwarded-For hop,
+    which the client can set to anything
+    """
+    external = headers.get("x-envoy-external-address")
+    if external:
+        return external.strip()
+    forwarded_for = headers.get("x-forwarded-for")
+    if not forwarded_for:
+        return None
+    hops = forwarded_for.split(",")
+    if AUTH_XFF_TRUSTED_HOPS >= len(hops):
+        return None
+    return hops[-1 - AUTH_XFF_TRUSTED_HOPS].strip() or None
+
+
+def retry_after_headers(retry_after: float) -> ext_api.HeaderMutation:
+    return ext_api.HeaderMutation(
+        set_headers=[
+            EnvoyHeaderValueOption(
+                header=EnvoyHeaderValue(key="Retry-After", value=str(max(1, round(retry_after))))
+            )
+        ]
+    )
+
+
 def decode_basic_auth_header(creds: str) -> Tuple[str, str]:
     return urlsafe_b64decode(creds.encode()).decode().split(":")
 
 
-def verify_basic_auth(identity: str, secret: str) -> str:
-    """Call auth service with API key (identity and secret)"""
-
+def check_basic_auth(identity: str, secret: str) -> None:
     if (identity is None) or (secret is None):
         raise NoCredentials("One of identity or secret not passed")
     if not UUID_REGEX.match(identity):
         raise MalformedCredentials("Identity is not a UUID")
 
-    # TODO: handle initial connection error (not a response error)
-    # TODO: probably want retries
+
+def verify_basic_auth(identity: str, secret: str) -> str:
+    """Call auth service with API key (identity and secret)"""
+
+    check_basic_auth(identity, secret)
+
     basic = urlsafe_b64encode(f"{identity}:{secret}".encode()).decode()
     headers = {"Authorization": f"Basic {basic}"}
-    response = requests.get(AUTH_URL, headers=headers)
+    response = auth_client().get(headers=headers)  # raises Unavailable
     if response.status_code in [200, 201]:
         return response.json()["token"]
     elif response.status_code < 500:
@@ -198,15 +595,71 @@ def verify_basic_auth(identity: str, secret: str) -> str:
     response.raise_for_status()
 
 
+def check_revoked(claims: Dict) -> None:
+    """raise Unauthenticated, if the token's API key was revoked"""
+    key_id = claims.get("identity", {}).get("key_id")
+    if key_id is not None and TOKEN_REVOCATIONS and key_id in revocations():
+        raise Unauthenticated(f"Key {key_id} was revoked")
+
+
+_revocations: Optional[RevocationSet] = None
+
+
+def revocations() -> RevocationSet:
+    """the (process') revoked keys, polled from first use (after any fork)"""
+    global _revocations
+    if _revocations is None:
+        _revocations = RevocationSet(TOKEN_REVOCATIONS, interval=TOKEN_REVOCATIONS_INTERVAL)
+    return _revocations
+
+
+_auth_client: Optional[HttpClient] = None
+
+
+def auth_client() -> HttpClient:
+    """the (process') auth service client, created on first use (after any fork)"""
+    global _auth_client
+    if _auth_client is None:
+        _auth_client = HttpClient(
+            AUTH_URL,
+            pool_size=AUTH_POOL_SIZE,
+            connect_timeout=AUTH_CONNECT_TIMEOUT,
+            read_timeout=AUTH_READ_TIMEOUT,
+            retries=AUTH_RETRIES,
+            backoff=AUTH_RETRY_BACKOFF,
+            hedge_after=AUTH_HEDGE_AFTER,
+            breaker=CircuitBreaker(AUTH_BREAKER_FAILURES, AUTH_BREAKER_RESET),
+            deadline=AUTH_DEADLINE,
+        )
+    return _auth_client
+
+
 def verify_token(token: str) -> Dict:
+    """
+    verify a token, signed with TOKEN_PUBLIC_KEY (HS256) or, if TOKEN_JWKS
+    is set, with one of those (RS256 or ES256) keys (by kid)
+    """
     try:
+        header = jwt.get_unverified_header(token)
+        algorithm = header.get("alg")
+        if TOKEN_JWKS and algorithm in JWKS_ALGORITHMS:
+            jwk, key_algorithm = signing_keys().get(header.get("kid"))
+            if algorithm != key_algorithm:
+                raise Unauthenticated(f"Token algorithm {algorithm} doesn't match its key")
+            key = jwk.key
+        else:
+            key, algorithm = TOKEN_PUBLIC_KEY, "HS256"
         return jwt.decode(
             token,
-            TOKEN_PUBLIC_KEY,
-            algorithms=["HS256"],
+            key,
+            algorithms=[algorithm],
             audience=TOKEN_AUDIENCE,
             issuer=TOKEN_ISSUER,
         )
+    except UnknownKey as err:
+        raise Unauthenticated(f"{err}") from err
+    except KeysUnavailable as err:
+        raise Unavailable(f"{err}") from err
     except (
         jwt.exceptions.ExpiredSignatureError,
         jwt.exceptions.InvalidSignatureError,
@@ -219,3 +672,14 @@ def verify_token(token: str) -> Dict:
         jwt.exceptions.InvalidTokenError,
     ) as err:
         raise Unauthenticated() from err
+
+
+_signing_keys: Optional[KeySet] = None
+
+
+def signing_keys() -> KeySet:
+    """the (process') TOKEN_JWKS keys, loaded in the background after first use"""
+    global _signing_keys
+    if _signing_keys is None:
+        _signing_keys = KeySet(TOKEN_JWKS, refresh_interval=TOKEN_JWKS_REFRESH)
+    return _signing_keys
@@ -1,32 +1,185 @@
+from asyncio import get_running_loop
+from asyncio import run as run_coroutine
+from contextvars import ContextVar
+from inspect import iscoroutinefunction
 from logging import getLogger
-from typing import Dict, Iterator, List, Optional, Union
+from time import perf_counter_ns
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
 from envoy.config.core.v3.base_pb2 import (
     HeaderValueOption as EnvoyHeaderValueOption,
 )
 from envoy.config.core.v3.base_pb2 import HeaderValue as EnvoyHeaderValue
+from envoy.extensions.filters.http.ext_proc.v3.processing_mode_pb2 import (
+    ProcessingMode,
+)
 from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
 from envoy.service.ext_proc.v3.external_processor_pb2_grpc import (
     ExternalProcessorServicer,
 )
+from gateway.identity.v1.identity_pb2 import Identity
+from google.protobuf.message import Message
 from grpc import ServicerContext
 
-from ..utils.timing import Timer
+from ..utils.headers import HeaderView
+from ..utils.identity import decode_identity
+from .context import CallContext, PHASES
 
 logger = getLogger(__name__)
 
+# "move on" responses; copied for every just_continue_..., don't modify
+CONTINUE_COMMON = ext_api.CommonResponse(
+    status=ext_api.CommonResponse.ResponseStatus.CONTINUE,
+    header_mutation=ext_api.HeaderMutation(
+        set_headers=[],
+        remove_headers=[],
+    ),
+)
+CONTINUE_HEADERS = ext_api.HeadersResponse(response=CONTINUE_COMMON)
+CONTINUE_BODY = ext_api.BodyResponse(response=CONTINUE_COMMON)
+CONTINUE_TRAILERS = ext_api.TrailersResponse(header_mutation=ext_api.HeaderMutation())
+
+
+# the methods implementing each phase; body phases can be implemented
+# with (streamed) chunk hooks instead
+PHASE_ACTIONS: Dict[str, Tuple[str, ...]] = {
+    phase: (
+        (f"process_{phase}", f"process_{phase}_chunk", f"process_{phase}_end")
+        if phase.endswith("_body")
+        else (f"process_{phase}",)
+    )
+    for phase in PHASES
+}
+
+
+# set while an async hook runs on a private event loop (see run_sync), so
+# hooks can tell they aren't on a (long lived) AsyncProcess event loop
+SYNC_HOOK: ContextVar[bool] = ContextVar("SYNC_HOOK", default=False)
+
+
+def run_sync(coroutine: Any) -> Any:
+    """
+    run an async hook's coroutine to completion. async hooks are "native"
+    only to AsyncProcess, but we can still run them (slowly) on a private
+    event loop
+    """
+    token = SYNC_HOOK.set(True)
+    try:
+        return run_coroutine(coroutine)
+    finally:
+        SYNC_HOOK.reset(token)
+
+
+def run_hook(action: Callable, *args: Any) -> Any:
+    """call a "process_..." method synchronously, even if it is declared async"""
+    if iscoroutinefunction(action):
+        return run_sync(action(*args))
+    return action(*args)
+
 
 class BaseExternalProcessorService(ExternalProcessorServicer):
     """
     Base ExternalProcessor for envoy. Subclass this and supply
     more specific action methods if desired.
+
+    The phases a subclass implements (overrides "process_..." methods
+    for) are detected when the subclass is created, and the response
+    to request_headers tells envoy (with a mode_override) to not send
+    the other phases. Hooks can skip more phases per request with
+    skip_phases (from process_request_headers).
+
+    Bodies can be processed in chunks, without buffering, instead of
+    overriding process_request_body (or process_response_body): set the
+    body mode to STREAMED and override process_request_body_chunk (run
+    for every chunk envoy sends) and process_request_body_end (run after
+    it for the last chunk). In BUFFERED modes the whole body is a single
+    (last) chunk, so the same hooks work for either mode. A STREAMED body
+    that ends with trailers ends in the trailers phase instead (see
+    process_body_trailers); subclasses overriding process_..._trailers
+    as well should call super() first.
     """
 
+    # the phases implemented, set for each subclass on creation
+    phases: FrozenSet[str] = frozenset()
+
+    # body modes to ask envoy for, if the body phases are implemented
+    request_body_mode: int = ProcessingMode.BUFFERED
+    response_body_mode: int = ProcessingMode.BUFFERED
+
+    # send a mode_override with the request_headers response?
+    override_processing_mode: bool = True
+
+    # the (per-stream) call context class, extend with declared fields
+    context_class: Type[CallContext] = CallContext
+
+    # can only be served with asyncio (AsyncProcess)? see serve
+    requires_asyncio: bool = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._encoded_modes: Dict[FrozenSet[str], bytes] = {}
+
+    # phase -> ("process_..." function, is it async?), set for each subclass
+    _dispatch: Dict[str, Tuple[Callable, bool]] = {}
+
+    # the same, for AsyncProcess; unless an instance has a (more) async
+    # version of some phases (see CompositeExternalProcessorService)
+    _async_dispatch: Dict[str, Tuple[Callable, bool]] = {}
+
+    # directions with STREAMED body end hooks, set for each subclass
+    _trailer_ends: FrozenSet[str] = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._prepare()
+
+    @classmethod
+    def _prepare(cls) -> None:
+        """
+        inspect the "process_..." methods once, when a class is created,
+        instead of looking them up for every message in a stream
+        """
+        cls._trailer_ends = frozenset(
+            direction
+            for direction in ("request", "response")
+            if getattr(cls, f"{direction}_body_mode") == ProcessingMode.STREAMED
+            and getattr(cls, f"process_{direction}_body_end")
+            is not getattr(BaseExternalProcessorService, f"process_{direction}_body_end")
+        )
+        # a streamed body may end in the trailers phase, so ask for it too
+        cls.phases = frozenset(
+            phase
+            for phase in PHASES
+            if cls.implements(phase)
+            or (phase.endswith("_trailers") and phase.split("_")[0] in cls._trailer_ends)
+        )
+        cls._dispatch = {
+            phase: (
+                getattr(cls, f"process_{phase}"),
+                iscoroutinefunction(getattr(cls, f"process_{phase}")),
+            )
+            for phase in PHASES
+        }
+        cls._async_dispatch = cls._dispatch
+
     def Process(
         self,
         request_iterator: Iterator[ext_api.ProcessingRequest],
         context: ServicerContext,
-    ) -> Iterator[ext_api.ProcessingResponse]:
+    ) -> Iterator[Union[bytes, ext_api.ProcessingResponse]]:
         """
         Basic stream handler. This creates a "local" ("call") context
         for each request and walks through the request iterator
@@ -43,38 +196,177 @@ class BaseExternalProcessorService(ExternalProcessorServicer):
         Also defines some helpers like get_header (to get a request
         header in a header phase) and add/remove_header for changing
         headers.
+
+        Unmodified ("just continue") responses are yielded as cached,
+        pre-encoded bytes, so serve with serialize_response.
         """
 
+        dispatch = self._dispatch
+
         # for each stream, define a new "call" context
-        callctx = {"__overhead_ns": 0}
+        callctx = self.new_call_context()
         for request in request_iterator:
 
             phase_name = request.WhichOneof("request")
-            action_name = f"process_{phase_name}"
-            action = getattr(self, action_name)
+            action, is_async = dispatch[phase_name]
             phase_data = getattr(request, phase_name)
 
             # look for previous request phase overhead?
 
             # actually process the request phase
             logger.debug(f"{self.__class__.__name__} started {phase_name}")
-            T = Timer()
-            with T:
-                response = action(phase_data, context, callctx)
-            duration = T.duration.ToNanoseconds()
-            callctx["__overhead_ns"] += duration
-            logger.debug(
-                f"{self.__class__.__name__} finished {phase_name} ({duration*1e-9} seconds)"
-            )
+            started = perf_counter_ns()
+            if is_async:
+                response = run_sync(action(self, phase_data, context, callctx))
+            else:
+                response = action(self, phase_data, context, callctx)
+            duration = perf_counter_ns() - started
+            callctx.record(phase_name, phase_data, duration)
+
+            yield self.processing_response(phase_name, response, duration, callctx)
+
+    async def AsyncProcess(
+        self,
+        request_iterator: AsyncIterator[ext_api.ProcessingRequest],
+        context: ServicerContext,
+    ) -> AsyncIterator[Union[bytes, ext_api.ProcessingResponse]]:
+        """
+        asyncio version of Process, served by grpc.aio (see service.serve).
+
+        "process_..." methods declared with "async def" are awaited on
+        the server's event loop, while regular (sync) methods are run
+        in the loop's default executor. This way a stream doesn't hold
+        a worker thread while it waits for envoy to send the next phase
+        (e.g., while the upstream is processing the request).
+        """
+
+        loop = get_running_loop()
+        dispatch = self._async_dispatch
 
-            # how to store the data in the headers for chaining?
-            # actually, probably write events to kafka
+        # for each stream, define a new "call" context
+        callctx = self.new_call_context()
+        async for request in request_iterator:
 
-            # yield response for the streaming (push/pull) request
-            if isinstance(response, ext_api.ImmediateResponse):
-                yield ext_api.ProcessingResponse(**{"immediate_response": response})
+            phase_name = request.WhichOneof("request")
+            action, is_async = dispatch[phase_name]
+            phase_data = getattr(request, phase_name)
+
+            # actually process the request phase
+            logger.debug(f"{self.__class__.__name__} started {phase_name}")
+            started = perf_counter_ns()
+            if is_async:
+                response = await action(self, phase_data, context, callctx)
             else:
-                yield ext_api.ProcessingResponse(**{phase_name: response})
+                response = await loop.run_in_executor(
+                    None, action, self, phase_data, context, callctx
+                )
+            duration = perf_counter_ns() - started
+            callctx.record(phase_name, phase_data, duration)
+
+            yield self.processing_response(phase_name, response, duration, callctx)
+
+    @classmethod
+    def implements(cls, phase_name: str) -> bool:
+        """does this processor override the "process_..." method(s) for a phase?"""
+        return any(
+            getattr(cls, action_name) is not getattr(BaseExternalProcessorService, action_name)
+            for action_name in PHASE_ACTIONS[phase_name]
+        )
+
+    def skip_phases(self, callctx: CallContext, *phase_names: str) -> None:
+        """
+        ask envoy to not send some phases for this request. Only effective
+        when called from process_request_headers, as envoy only accepts
+        a mode_override in the response to the request headers.
+        """
+        callctx.skipped.update(phase_names)
+
+    def skipped_phases(self, callctx: CallContext) -> Set[str]:
+        """phases skipped (with skip_phases) for this request"""
+        return callctx.skipped
+
+    def processing_mode(self, callctx: CallContext) -> ProcessingMode:
+        """the processing mode this processor needs, for this request"""
+        phases = self.phases - self.skipped_phases(callctx)
+
+        def header_mode(phase: str) -> int:
+            return ProcessingMode.SEND if phase in phases else ProcessingMode.SKIP
+
+        return ProcessingMode(
+            request_header_mode=ProcessingMode.SEND,  # already sent, anyway
+            response_header_mode=header_mode("response_headers"),
+            request_body_mode=(
+                self.request_body_mode if "request_body" in phases else ProcessingMode.NONE
+            ),
+            response_body_mode=(
+                self.response_body_mode if "response_body" in phases else ProcessingMode.NONE
+            ),
+            request_trailer_mode=header_mode("request_trailers"),
+            response_trailer_mode=header_mode("response_trailers"),
+        )
+
+    def new_call_context(self) -> CallContext:
+        """create the "call" context for a new stream"""
+        return self.context_class()
+
+    def processing_response(
+        self,
+        phase_name: str,
+        response: Union[
+            ext_api.HeadersResponse,
+            ext_api.BodyResponse,
+            ext_api.TrailersResponse,
+            ext_api.ImmediateResponse,
+        ],
+        duration: int,
+        callctx: CallContext,
+    ) -> Union[bytes, ext_api.ProcessingResponse]:
+        """
+        wrap a phase response for the stream (processed in duration
+        nanoseconds). Returns (cached) bytes for unmodified responses;
+        see serialize_response
+        """
+
+        logger.debug(f"{self.__class__.__name__} finished {phase_name} ({duration*1e-9} seconds)")
+
+        # how to store the data in the headers for chaining?
+        # actually, probably write events to kafka
+
+        # yield response for the streaming (push/pull) request
+        if isinstance(response, ext_api.ImmediateResponse):
+            return ext_api.ProcessingResponse(**{"immediate_response": response})
+
+        # unmodified "move on" responses are sent pre-encoded
+        unmodified = response == CONTINUE_RESPONSES[phase_name]
+
+        # the first response is the only chance to tell envoy which
+        # phases (not) to send us for the rest of the stream
+        if phase_name == "request_headers" and self.override_processing_mode:
+            if unmodified:
+                return self.encoded_continue_with_mode(callctx)
+            return ext_api.ProcessingResponse(
+                **{phase_name: response, "mode_override": self.processing_mode(callctx)}
+            )
+
+        if unmodified:
+            return CONTINUE_ENCODED[phase_name]
+
+        return ext_api.ProcessingResponse(**{phase_name: response})
+
+    def encoded_continue_with_mode(self, callctx: CallContext) -> bytes:
+        """
+        an unmodified request_headers response with this request's
+        mode_override, encoded; cached as there are only a few variants
+        """
+        skipped = frozenset(self.skipped_phases(callctx))
+        encoded = self._encoded_modes.get(skipped)
+        if encoded is None:
+            encoded = ext_api.ProcessingResponse(
+                request_headers=CONTINUE_RESPONSES["request_headers"],
+                mode_override=self.processing_mode(callctx),
+            ).SerializeToString()
+            self._encoded_modes[skipped] = encoded
+        return encoded
 
     # phase-specific methods below here; override to
     # specialize filter behavior, these will simply move on
@@ -83,7 +375,7 @@ class BaseExternalProcessorService(ExternalProcessorServicer):
         self,
         headers: ext_api.HttpHeaders,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: CallContext,
     ) -> Union[ext_api.HeadersResponse, ext_api.ImmediateResponse]:
         return self.just_continue_headers()
 
@@ -91,7 +383,23 @@ class BaseExternalProcessorService(ExternalProcessorServicer):
         self,
         body: ext_api.HttpBody,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: CallContext,
+    ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
+        return self.process_body_chunk("request", body, grpcctx, callctx)
+
+    def process_request_body_chunk(
+        self,
+        body: ext_api.HttpBody,
+        grpcctx: ServicerContext,
+        callctx: CallContext,
+    ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
+        return self.just_continue_body()
+
+    def process_request_body_end(
+        self,
+        body: ext_api.HttpBody,
+        grpcctx: ServicerContext,
+        callctx: CallContext,
     ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
         return self.just_continue_body()
 
@@ -99,15 +407,15 @@ class BaseExternalProcessorService(ExternalProcessorServicer):
         self,
         trailers: ext_api.HttpTrailers,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: CallContext,
     ) -> Union[ext_api.TrailersResponse, ext_api.ImmediateResponse]:
-        return self.just_continue_trailers()
+        return self.process_body_trailers("request", trailers, grpcctx, callctx)
 
     def process_response_headers(
         self,
         headers: ext_api.HttpHeaders,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: CallContext,
     ) -> Union[ext_api.HeadersResponse, ext_api.ImmediateResponse]:
         return self.just_continue_headers()
 
@@ -115,7 +423,23 @@ class BaseExternalProcessorService(ExternalProcessorServicer):
         self,
         body: ext_api.HttpBody,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: CallContext,
+    ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
+        return self.process_body_chunk("response", body, grpcctx, callctx)
+
+    def process_response_body_chunk(
+        self,
+        body: ext_api.HttpBody,
+        grpcctx: ServicerContext,
+        callctx: CallContext,
+    ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
+        return self.just_continue_body()
+
+    def process_response_body_end(
+        self,
+        body: ext_api.HttpBody,
+        grpcctx: ServicerContext,
+        callctx: CallContext,
     ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
         return self.just_continue_body()
 
@@ -123,8 +447,55 @@ class BaseExternalProcessorService(ExternalProcessorServicer):
         self,
         trailers: ext_api.HttpTrailers,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: CallContext,
+    ) -> Union[ext_api.TrailersResponse, ext_api.ImmediateResponse]:
+        return self.process_body_trailers("response", trailers, grpcctx, callctx)
+
+    def process_body_chunk(
+        self,
+        direction: str,
+        body: ext_api.HttpBody,
+        grpcctx: ServicerContext,
+        callctx: CallContext,
+    ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
+        """
+        run the chunk hook for a body message, then the end hook if it's
+        the last one. Responses for the last chunk are merged
+        """
+        response = run_hook(
+            getattr(self, f"process_{direction}_body_chunk"), body, grpcctx, callctx
+        )
+        last = body.end_of_stream or (
+            getattr(self, f"{direction}_body_mode") != ProcessingMode.STREAMED
+        )
+        if not last or isinstance(response, ext_api.ImmediateResponse):
+            return response
+        end = run_hook(getattr(self, f"process_{direction}_body_end"), body, grpcctx, callctx)
+        if isinstance(end, ext_api.ImmediateResponse) or response == CONTINUE_BODY:
+            return end
+        return merge_body_response(response, end)
+
+    def process_body_trailers(
+        self,
+        direction: str,
+        trailers: ext_api.HttpTrailers,
+        grpcctx: ServicerContext,
+        callctx: CallContext,
     ) -> Union[ext_api.TrailersResponse, ext_api.ImmediateResponse]:
+        """
+        run the end hook for a STREAMED body that ends with trailers: envoy
+        sends trailers only if no body chunk had end_of_stream, so the end
+        hook hasn't run. It gets an empty last chunk; its mutations can't
+        be applied anymore, but it can still respond immediately
+        """
+        if direction not in self._trailer_ends or (
+            f"{direction}_body" in self.skipped_phases(callctx)
+        ):
+            return self.just_continue_trailers()
+        last = ext_api.HttpBody(end_of_stream=True)
+        end = run_hook(getattr(self, f"process_{direction}_body_end"), last, grpcctx, callctx)
+        if isinstance(end, ext_api.ImmediateResponse):
+            return end
         return self.just_continue_trailers()
 
     # some boilerplate; not really encapsulating anything but
@@ -132,30 +503,65 @@ class BaseExternalProcessorService(ExternalProcessorServicer):
 
     def just_continue_response(self) -> ext_api.CommonResponse:
         """generic "move on" response object (can be modified)"""
-        return ext_api.CommonResponse(
-            status=ext_api.CommonResponse.ResponseStatus.CONTINUE,
-            header_mutation=ext_api.HeaderMutation(
-                set_headers=[],
-                remove_headers=[],
-            ),
-        )
+        response = ext_api.CommonResponse()
+        response.CopyFrom(CONTINUE_COMMON)  # (much) faster than constructing
+        return response
 
     def just_continue_headers(self) -> ext_api.HeadersResponse:
         """generic "move on" headers response object (can be modified)"""
-        return ext_api.HeadersResponse(response=self.just_continue_response())
+        response = ext_api.HeadersResponse()
+        response.CopyFrom(CONTINUE_HEADERS)
+        return response
 
     def just_continue_body(self) -> ext_api.BodyResponse:
         """generic "move on" body response object (can be modified)"""
-        return ext_api.BodyResponse(response=self.just_continue_response())
+        response = ext_api.BodyResponse()
+        response.CopyFrom(CONTINUE_BODY)
+        return response
 
     def just_continue_trailers(self) -> ext_api.TrailersResponse:
         """generic "move on" trailers response object (can be modified)"""
-        return ext_api.TrailersResponse(header_mutation=ext_api.HeaderMutation())
+        response = ext_api.TrailersResponse()
+        response.CopyFrom(CONTINUE_TRAILERS)
+        return response
 
     # helpers
 
-    def get_header(self, headers: ext_api.HttpHeaders, name: str, lower_cased: bool = False) -> str:
+    def header_view(self, headers: ext_api.HttpHeaders, callctx: CallContext) -> HeaderView:
+        """
+        an indexed view of a phase's headers, built once per phase message
+        and cached on the call context (so helpers and hooks can share it)
+        """
+        view = callctx.view
+        if view is None or view.source is not headers:
+            view = callctx.view = HeaderView(headers)
+        return view
+
+    def identity(
+        self, callctx: CallContext, headers: Optional[ext_api.HttpHeaders] = None
+    ) -> Identity:
+        """
+        the caller's identity (see utils.identity), from the request headers
+        (or the headers seen last, if not passed), decoded once per stream;
+        empty if not authenticated
+        """
+        identity = callctx.identity
+        if identity is None:
+            view = callctx.view if headers is None else self.header_view(headers, callctx)
+            if view is None:
+                return Identity()
+            identity = callctx.identity = decode_identity(view)
+        return identity
+
+    def get_header(
+        self,
+        headers: Union[ext_api.HttpHeaders, HeaderView],
+        name: str,
+        lower_cased: bool = False,
+    ) -> str:
         """get a header value by name (envoy uses lower cased names)"""
+        if isinstance(headers, HeaderView):
+            return headers.get(name)
         _name = name if lower_cased else name.lower()
         for header in headers.headers.headers:
             if header.key == _name:
@@ -164,12 +570,14 @@ class BaseExternalProcessorService(ExternalProcessorServicer):
 
     def get_headers(
         self,
-        headers: ext_api.HttpHeaders,
+        headers: Union[ext_api.HttpHeaders, HeaderView],
         names: List[str],  # Union[List[str], Dict[str, str]],
         lower_cased: bool = False,
         mapping: Optional[List[str]] = None,
     ) -> Dict[str, str]:
         """get multiple header values by name (envoy uses lower cased names)"""
+        if isinstance(headers, HeaderView):
+            return headers.pick(names, mapping=mapping)
         results = {}
         _names = names if lower_cased else [name.lower() for name in names]
         ctxkeys = {
@@ -193,3 +601,46 @@ class BaseExternalProcessorService(ExternalProcessorServicer):
         """remove a header from a CommonResponse"""
         response.header_mutation.remove_headers.append(name)
         return response
+
+
+BaseExternalProcessorService._prepare()
+
+
+# what the default ("move on") phase methods respond with, and the
+# encoded ProcessingResponse for each; unmodified responses are sent
+# as these bytes instead of being wrapped and serialized every time
+CONTINUE_RESPONSES: Dict[str, Message] = {
+    "request_headers": CONTINUE_HEADERS,
+    "request_body": CONTINUE_BODY,
+    "request_trailers": CONTINUE_TRAILERS,
+    "response_headers": CONTINUE_HEADERS,
+    "response_body": CONTINUE_BODY,
+    "response_trailers": CONTINUE_TRAILERS,
+}
+CONTINUE_ENCODED = {
+    phase: ext_api.ProcessingResponse(**{phase: response}).SerializeToString()
+    for phase, response in CONTINUE_RESPONSES.items()
+}
+
+
+def merge_body_response(
+    response: ext_api.BodyResponse,
+    other: ext_api.BodyResponse,
+) -> ext_api.BodyResponse:
+    """merge a (later) body response into another (in place): mutations add up"""
+    if other == CONTINUE_BODY:
+        return response
+    mutation = response.response.header_mutation
+    mutation.set_headers.extend(other.response.header_mutation.set_headers)
+    mutation.remove_headers.extend(other.response.header_mutation.remove_headers)
+    if other.response.HasField("body_mutation"):
+        response.response.body_mutation.CopyFrom(other.response.body_mutation)
+    response.response.clear_route_cache |= other.response.clear_route_cache
+    return response
+
+
+def serialize_response(response: Union[bytes, ext_api.ProcessingResponse]) -> bytes:
+    """grpc response serializer, passing through pre-encoded responses"""
+    if isinstance(response, bytes):
+        return response
+    return response.SerializeToString()
@@ -0,0 +1,462 @@
+from asyncio import get_running_loop
+from logging import getLogger
+from typing import Any, Callable, Generator, List, Optional, Set, Tuple, Union
+
+from envoy.config.core.v3.base_pb2 import HeaderMap as EnvoyHeaderMap
+from envoy.extensions.filters.http.ext_proc.v3.processing_mode_pb2 import (
+    ProcessingMode,
+)
+from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
+from google.protobuf.message import Message
+from grpc import ServicerContext
+
+from .base import BaseExternalProcessorService, run_sync
+from .context import CallContext, PHASES
+
+logger = getLogger(__name__)
+
+# a processor's hook call: (processor, phase, data, grpc context, its call context)
+Step = Tuple[BaseExternalProcessorService, str, Message, ServicerContext, CallContext]
+
+# a pipeline, yielding the hook calls it needs the results of
+Steps = Generator[Step, Any, Any]
+
+
+class CompositeCallContext(CallContext):
+    """the processors' own contexts, and the state of the pipeline"""
+
+    __slots__ = ("contexts", "pending", "responder", "request_headers", "response_headers")
+
+    def __init__(self):
+        super().__init__()
+        self.contexts: List[CallContext] = []
+        self.pending: Tuple[str, List[int]] = ("request", [])  # held headers phases
+        self.responder: Optional[int] = None  # the processor responding immediately
+
+
+class CompositeExternalProcessorService(BaseExternalProcessorService):
+    """
+    Run an ordered list of processors inside a single ext_proc stream,
+    instead of chaining one ext_proc filter (and gRPC stream) per
+    processor in envoy.
+
+    This mimics what envoy does for a chain of filters:
+
+    * request phases run through the processors in order, response
+      phases in reverse order (envoy encodes in reverse filter order)
+    * header mutations from one processor are applied before the next
+      processor sees the headers
+    * a processor that reads the body "holds" the headers phase of the
+      processors after it until the body arrives, so (e.g.) idempotency
+      sees the X-Request-Digest the digester computes from a POST body
+    * an ImmediateResponse from any processor short-circuits the rest,
+      and is sent as that processor would send it
+    * with a STREAMED body, held processors run (headers, then body) with
+      the last chunk, so they don't see the chunks before it
+    * phases a processor skipped (see skip_phases) aren't run for it
+    * served with asyncio, async processor hooks are awaited on the
+      server's event loop (see await_steps)
+
+    Each processor gets its own call context, and envoy gets a single
+    response per phase with all the mutations merged.
+    """
+
+    context_class = CompositeCallContext
+
+    def __init__(self, processors: List[BaseExternalProcessorService], *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not processors:
+            raise ValueError("Composite processor requires at least one processor")
+        self.processors = processors
+        self.requires_asyncio = any(p.requires_asyncio for p in processors)
+
+        # served with asyncio, run the pipeline on the event loop if any
+        # processor has async hooks, so they're awaited there (instead of
+        # blocking an executor thread); else each phase is a single call
+        # in the executor
+        if any(is_async for p in processors for _, is_async in p._async_dispatch.values()):
+            self._async_dispatch = {phase: (awaiting(phase), True) for phase in PHASES}
+
+        # ask envoy for what any processor needs
+        self.phases = frozenset().union(*(p.phases for p in processors))
+        for direction in ("request", "response"):
+            modes = [
+                getattr(p, f"{direction}_body_mode")
+                for p in processors
+                if f"{direction}_body" in p.phases
+            ]
+            if modes:
+                setattr(self, f"{direction}_body_mode", max(modes))
+
+    def __str__(self) -> str:
+        names = ",".join(p.__class__.__name__ for p in self.processors)
+        return f"{self.__class__.__name__}({names})"
+
+    def new_call_context(self) -> CompositeCallContext:
+        callctx = super().new_call_context()
+        callctx.contexts = [p.new_call_context() for p in self.processors]
+        return callctx
+
+    def processing_response(
+        self,
+        phase_name: str,
+        response: Union[
+            ext_api.HeadersResponse,
+            ext_api.BodyResponse,
+            ext_api.TrailersResponse,
+            ext_api.ImmediateResponse,
+        ],
+        duration: int,
+        callctx: CompositeCallContext,
+    ) -> Union[bytes, ext_api.ProcessingResponse]:
+        """
+        immediate responses are wrapped by the processor responding, so
+        they're sent as it would send them (e.g., pre-encoded replays)
+        """
+        i = callctx.responder
+        if i is not None and isinstance(response, ext_api.ImmediateResponse):
+            p, ctx = self.processors[i], callctx.contexts[i]
+            return p.processing_response(phase_name, response, duration, ctx)
+        return super().processing_response(phase_name, response, duration, callctx)
+
+    def skipped_phases(self, callctx: CompositeCallContext) -> Set[str]:
+        """phases skipped by every processor that implements them"""
+        skipped = set(self.phases)
+        for p, ctx in zip(self.processors, callctx.contexts):
+            skipped -= p.phases - p.skipped_phases(ctx)
+        return skipped | super().skipped_phases(callctx)
+
+    def process_request_headers(
+        self,
+        headers: ext_api.HttpHeaders,
+        grpcctx: ServicerContext,
+        callctx: CompositeCallContext,
+    ) -> Union[ext_api.HeadersResponse, ext_api.ImmediateResponse]:
+        return run_steps(self.run_headers("request", headers, grpcctx, callctx))
+
+    def process_request_body(
+        self,
+        body: ext_api.HttpBody,
+        grpcctx: ServicerContext,
+        callctx: CompositeCallContext,
+    ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
+        return run_steps(self.run_body("request", body, grpcctx, callctx))
+
+    def process_request_trailers(
+        self,
+        trailers: ext_api.HttpTrailers,
+        grpcctx: ServicerContext,
+        callctx: CompositeCallContext,
+    ) -> Union[ext_api.TrailersResponse, ext_api.ImmediateResponse]:
+        return run_steps(self.run_trailers("request", trailers, grpcctx, callctx))
+
+    def process_response_headers(
+        self,
+        headers: ext_api.HttpHeaders,
+        grpcctx: ServicerContext,
+        callctx: CompositeCallContext,
+    ) -> Union[ext_api.HeadersResponse, ext_api.ImmediateResponse]:
+        return run_steps(self.run_headers("response", headers, grpcctx, callctx))
+
+    def process_response_body(
+        self,
+        body: ext_api.HttpBody,
+        grpcctx: ServicerContext,
+        callctx: CompositeCallContext,
+    ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
+        return run_steps(self.run_body("response", body, grpcctx, callctx))
+
+    def process_response_trailers(
+        self,
+        trailers: ext_api.HttpTrailers,
+        grpcctx: ServicerContext,
+        callctx: CompositeCallContext,
+    ) -> Union[ext_api.TrailersResponse, ext_api.ImmediateResponse]:
+        return run_steps(self.run_trailers("response", trailers, grpcctx, callctx))
+
+    # pipeline; each run_... is a generator of the processors' hook calls
+    # (see Steps), so it runs synchronously (run_steps) or on the event
+    # loop (await_steps) the same way
+
+    def order(self, direction: str) -> List[int]:
+        """processor order for a direction, like envoy's filter chain"""
+        indices = list(range(len(self.processors)))
+        return indices if direction == "request" else indices[::-1]
+
+    def hook(
+        self,
+        i: int,
+        phase_name: str,
+        data: Message,
+        grpcctx: ServicerContext,
+        callctx: CompositeCallContext,
+    ) -> Step:
+        """a call of processor i's hook for a phase"""
+        return (self.processors[i], phase_name, data, grpcctx, callctx.contexts[i])
+
+    def run_headers(
+        self,
+        direction: str,
+        headers: ext_api.HttpHeaders,
+        grpcctx: ServicerContext,
+        callctx: CompositeCallContext,
+    ) -> Steps:
+
+        yield from self.flush_pending(grpcctx, callctx)
+
+        # a (mutable) copy of the headers, for later processors to see
+        current = ext_api.HttpHeaders()
+        current.CopyFrom(headers)
+        callctx[f"{direction}_headers"] = current
+        callctx.pending = (direction, self.order(direction))
+
+        response = self.just_continue_headers()
+        immediate = yield from self.run_pending_headers(
+            grpcctx, callctx, response.response, until_body=not headers.end_of_stream
+        )
+        return response if immediate is None else immediate
+
+    def run_body(
+        self,
+        direction: str,
+        body: ext_api.HttpBody,
+        grpcctx: ServicerContext,
+        callctx: CompositeCallContext,
+    ) -> Steps:
+
+        phase_name = f"{direction}_body"
+        _, pending = callctx.pending
+
+        current = ext_api.HttpBody()
+        current.CopyFrom(body)
+        mutated = False
+
+        # held processors wait for the last chunk of a streamed body
+        last = body.end_of_stream or (
+            getattr(self, f"{direction}_body_mode") != ProcessingMode.STREAMED
+        )
+
+        response = self.just_continue_body()
+        for i in self.order(direction):
+
+            # processors "held" by an earlier processor reading the body
+            # get their headers phase now; mutations ride on this response
+            if i in pending:
+                if not last:
+                    continue
+                pending.remove(i)
+                immediate = yield from self.run_headers_for(
+                    i, direction, grpcctx, callctx, response.response
+                )
+                if immediate is not None:
+                    return immediate
+
+            if not self.runs(i, phase_name, callctx):
+                continue
+
+            result = yield self.hook(i, phase_name, current, grpcctx, callctx)
+            if isinstance(result, ext_api.ImmediateResponse):
+                callctx.responder = i
+                return result
+
+            merge_header_mutation(
+                response.response.header_mutation, result.response.header_mutation
+            )
+            if f"{direction}_headers" in callctx:
+                apply_header_mutation(
+                    callctx[f"{direction}_headers"].headers, result.response.header_mutation
+                )
+            response.response.clear_route_cache |= result.response.clear_route_cache
+
+            mutation = result.response.body_mutation
+            if mutation.HasField("body"):
+                current.body, mutated = mutation.body, True
+            elif mutation.HasField("clear_body") and mutation.clear_body:
+                current.body, mutated = b"", True
+
+        if mutated:
+            if current.body:
+                response.response.body_mutation.body = current.body
+            else:
+                response.response.body_mutation.clear_body = True
+
+        return response
+
+    def run_trailers(
+        self,
+        direction: str,
+        trailers: ext_api.HttpTrailers,
+        grpcctx: ServicerContext,
+        callctx: CompositeCallContext,
+    ) -> Steps:
+
+        yield from self.flush_pending(grpcctx, callctx)
+
+        phase_name = f"{direction}_trailers"
+
+        current = ext_api.HttpTrailers()
+        current.CopyFrom(trailers)
+
+        response = self.just_continue_trailers()
+        for i in self.order(direction):
+            if not self.runs(i, phase_name, callctx):
+                continue
+            result = yield self.hook(i, phase_name, current, grpcctx, callctx)
+            if isinstance(result, ext_api.ImmediateResponse):
+                callctx.responder = i
+                return result
+            merge_header_mutation(response.header_mutation, result.header_mutation)
+            apply_header_mutation(current.trailers, result.header_mutation)
+
+        return response
+
+    def run_pending_headers(
+        self,
+        grpcctx: ServicerContext,
+        callctx: CompositeCallContext,
+        response: ext_api.CommonResponse,
+        until_body: bool = True,
+    ) -> Steps:
+        """
+        run the headers phase for pending processors, in order, stopping
+        after a processor that reads the body (if a body is coming);
+        returns an ImmediateResponse, if any processor responded with one
+        """
+        direction, pending = callctx.pending
+        while pending:
+            i = pending.pop(0)
+            immediate = yield from self.run_headers_for(i, direction, grpcctx, callctx, response)
+            if immediate is not None:
+                return immediate
+            if until_body and self.reads_body(i, direction, callctx):
+                break
+        return None
+
+    def runs(self, i: int, phase_name: str, callctx: CompositeCallContext) -> bool:
+        """does processor i run a phase (implements it, and didn't skip it)?"""
+        p = self.processors[i]
+        return phase_name in p.phases and phase_name not in p.skipped_phases(callctx.contexts[i])
+
+    def reads_body(self, i: int, direction: str, callctx: CompositeCallContext) -> bool:
+        """will processor i read the body (it didn't skip it for this request)?"""
+        p = self.processors[i]
+        return f"{direction}_body" in p.phases - p.skipped_phases(callctx.contexts[i])
+
+    def run_headers_for(
+        self,
+        i: int,
+        direction: str,
+        grpcctx: ServicerContext,
+        callctx: CompositeCallContext,
+        response: ext_api.CommonResponse,
+    ) -> Steps:
+        """run one processor's headers phase, merging its mutations"""
+
+        phase_name = f"{direction}_headers"
+        if not self.runs(i, phase_name, callctx):
+            return None
+
+        headers = callctx[phase_name]
+        result = yield self.hook(i, phase_name, headers, grpcctx, callctx)
+        if isinstance(result, ext_api.ImmediateResponse):
+            callctx.responder = i
+            return result
+
+        merge_header_mutation(response.header_mutation, result.response.header_mutation)
+        apply_header_mutation(headers.headers, result.response.header_mutation)
+        response.clear_route_cache |= result.response.clear_route_cache
+        return None
+
+    def flush_pending(self, grpcctx: ServicerContext, callctx: CompositeCallContext) -> Steps:
+        """
+        run headers phases still held for a body that never came (e.g., if
+        envoy isn't configured to send it), so the processors' contexts are
+        complete; their mutations can't be applied anymore though
+        """
+        if not callctx.pending[1]:
+            return
+        logger.warning(f"{self} running held headers phases without a body phase")
+        yield from self.run_pending_headers(
+            grpcctx, callctx, self.just_continue_response(), until_body=False
+        )
+
+
+# non-class helpers
+
+
+def run_steps(steps: Steps) -> Any:
+    """run a pipeline, calling the processors' hooks synchronously"""
+    try:
+        step = next(steps)
+        while True:
+            p, phase_name, *args = step
+            action, is_async = p._dispatch[phase_name]
+            step = steps.send(run_sync(action(p, *args)) if is_async else action(p, *args))
+    except StopIteration as done:
+        return done.value
+
+
+async def await_steps(steps: Steps) -> Any:
+    """
+    run a pipeline on the event loop: async hooks are awaited there, and
+    sync hooks run in the loop's default executor (like AsyncProcess)
+    """
+    loop = get_running_loop()
+    try:
+        step = next(steps)
+        while True:
+            p, phase_name, *args = step
+            action, is_async = p._async_dispatch[phase_name]
+            if is_async:
+                result = await action(p, *args)
+            else:
+                result = await loop.run_in_executor(None, action, p, *args)
+            step = steps.send(result)
+    except StopIteration as done:
+        return done.value
+
+
+def awaiting(phase_name: str) -> Callable:
+    """an async "process_..." method, running a phase's pipeline with await_steps"""
+    direction, kind = phase_name.split("_")
+
+    async def action(self, data: Message, grpcctx: ServicerContext, callctx: CallContext) -> Any:
+        run = getattr(self, f"run_{kind}")
+        return await await_steps(run(direction, data, grpcctx, callctx))
+
+    return action
+
+
+def apply_header_mutation(headers: EnvoyHeaderMap, mutation: ext_api.HeaderMutation) -> None:
+    """apply a HeaderMutation to a HeaderMap (in place), like envoy would"""
+
+    for name in mutation.remove_headers:
+        remove_header(headers, name.lower())
+
+    for option in mutation.set_headers:
+        key = option.header.key.lower()
+        # ext_proc overwrites unless told to append
+        if not (option.HasField("append") and option.append.value):
+            remove_header(headers, key)
+        headers.headers.add(key=key, value=option.header.value)
+
+
+def remove_header(headers: EnvoyHeaderMap, key: str) -> None:
+    if any(header.key == key for header in headers.headers):
+        kept = [header for header in headers.headers if header.key != key]
+        del headers.headers[:]
+        headers.headers.extend(kept)
+
+
+def merge_header_mutation(merged: ext_api.HeaderMutation, mutation: ext_api.HeaderMutation) -> None:
+    """
+    merge a (later) mutation into an (earlier) one. envoy applies removals
+    before sets, so a later removal also drops earlier sets of that header
+    """
+    if mutation.remove_headers:
+        removed = {name.lower() for name in mutation.remove_headers}
+        kept = [o for o in merged.set_headers if o.header.key.lower() not in removed]
+        del merged.set_headers[:]
+        merged.set_headers.extend(kept)
+        merged.remove_headers.extend(mutation.remove_headers)
+    merged.set_headers.extend(mutation.set_headers)
@@ -17,7 +17,7 @@ class ConcurrencyTestingService(BaseExternalProcessorService):
 
         callctx.update(
             self.get_headers(
-                headers,
+                self.header_view(headers, callctx),
                 [":path", "x-request-id", "x-gateway-request-id"],
                 mapping=["path", "_rid", "grid"],
             )
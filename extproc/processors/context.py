@@ -0,0 +1,193 @@
+from time import perf_counter_ns
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
+
+from gateway.identity.v1.identity_pb2 import Identity
+
+from ..utils.headers import HeaderView
+
+# the HTTP request phases envoy can send, named as in ProcessingRequest
+PHASES = (
+    "request_headers",
+    "request_body",
+    "request_trailers",
+    "response_headers",
+    "response_body",
+    "response_trailers",
+)
+PHASE_INDEX = {phase: i for i, phase in enumerate(PHASES)}
+
+
+class CallContext:
+    """
+    Per-stream ("call") context, created for each stream (see
+    BaseExternalProcessorService.new_call_context) and passed to every
+    "process_..." method of the stream.
+
+    Processors declare the fields they keep across phases as __slots__
+    of a subclass, and set it as their "context_class":
+
+        class DigestCallContext(CallContext):
+            __slots__ = ("digest", "method", "path", "tenant")
+
+    so a context is a fixed size object with attribute access, instead
+    of a dict with (magic) string keys. A field that hasn't been set is
+    missing, like a key not in a dict.
+
+    Dict-style access (callctx["key"], "key" in callctx, get, update,
+    setdefault) still works, for fields and for any other keys; those
+    are stored in an "extras" dict, only created if used.
+
+    Also keeps some stream stats: when the stream started, the time
+    spent in processing (overhead_ns), the number of messages per phase
+    (phase_counts) and the body bytes received (request_bytes and
+    response_bytes). Processors that hold on to data (e.g., buffering
+    a body) account for it with retain/release (retained_bytes).
+    """
+
+    __slots__ = (
+        "started_ns",
+        "overhead_ns",
+        "phase_counts",
+        "request_bytes",
+        "response_bytes",
+        "retained_bytes",
+        "view",
+        "identity",
+        "skipped",
+        "_extras",
+    )
+
+    # the fields available with dict-style access, set for each subclass
+    _fields: FrozenSet[str] = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = fields_of(cls)
+
+    def __init__(self):
+        self.started_ns = perf_counter_ns()
+        self.overhead_ns = 0
+        self.phase_counts = [0] * len(PHASES)
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.retained_bytes = 0
+        self.view: Optional[HeaderView] = None  # see header_view
+        self.identity: Optional[Identity] = None  # see identity
+        self.skipped: Set[str] = set()  # see skip_phases
+        self._extras: Optional[Dict[str, Any]] = None
+
+    # stats
+
+    def record(self, phase_name: str, data: Any, duration: int) -> None:
+        """record a phase message (data), processed in duration nanoseconds"""
+        self.phase_counts[PHASE_INDEX[phase_name]] += 1
+        self.overhead_ns += duration
+        if phase_name == "request_body":
+            self.request_bytes += len(data.body)
+        elif phase_name == "response_body":
+            self.response_bytes += len(data.body)
+
+    def count(self, phase_name: str) -> int:
+        """the number of messages received for a phase"""
+        return self.phase_counts[PHASE_INDEX[phase_name]]
+
+    def retain(self, size: int) -> None:
+        """account for size bytes held (by a processor) for the stream"""
+        self.retained_bytes += size
+
+    def release(self, size: int) -> None:
+        """account for size bytes (retained) no longer held"""
+        self.retained_bytes = max(0, self.retained_bytes - size)
+
+    def elapsed_ns(self) -> int:
+        """nanoseconds since the stream started"""
+        return perf_counter_ns() - self.started_ns
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "elapsed_ns": self.elapsed_ns(),
+            "overhead_ns": self.overhead_ns,
+            "phase_counts": dict(zip(PHASES, self.phase_counts)),
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+            "retained_bytes": self.retained_bytes,
+        }
+
+    # dict-style access
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extras is None:
+            raise KeyError(key)
+        return self._extras[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in self._fields:
+            setattr(self, key, value)
+        else:
+            if self._extras is None:
+                self._extras = {}
+            self._extras[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key in self._fields:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extras is None:
+            raise KeyError(key)
+        else:
+            del self._extras[key]
+
+    def __contains__(self, key: str) -> bool:
+        if key in self._fields:
+            return hasattr(self, key)
+        return self._extras is not None and key in self._extras
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def keys(self) -> List[str]:
+        keys = [field for field in self._fields if hasattr(self, field)]
+        return keys + ([] if self._extras is None else list(self._extras))
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+# non-class helpers
+
+
+def fields_of(cls: type) -> FrozenSet[str]:
+    """the (public) slots of a CallContext class, including inherited ones"""
+    return frozenset(
+        slot
+        for klass in cls.__mro__
+        for slot in getattr(klass, "__slots__", ())
+        if not slot.startswith("_")
+    )
+
+
+CallContext._fields = fields_of(CallContext)
@@ -1,53 +1,91 @@
 from hashlib import sha256
-from typing import Dict, Union
+from os import environ
+from typing import Union
 
+from envoy.extensions.filters.http.ext_proc.v3.processing_mode_pb2 import (
+    ProcessingMode,
+)
 from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
 from grpc import ServicerContext
 
 from .base import BaseExternalProcessorService
+from .context import CallContext
+
+# BUFFERED (default) or STREAMED; see DigestExternalProcessorService
+DIGEST_BODY_MODE = ProcessingMode.BodySendMode.Value(environ.get("DIGEST_BODY_MODE", "BUFFERED"))
+
+
+class DigestCallContext(CallContext):
+    """the (incremental) request digest"""
+
+    __slots__ = ("digest", "method", "path", "tenant")
 
 
 class DigestExternalProcessorService(BaseExternalProcessorService):
+    """
+    Adds an X-Request-Digest header, a hash of the tenant, method, path
+    and body, for idempotency. The body is hashed incrementally, so
+    with DIGEST_BODY_MODE=STREAMED it isn't buffered at all. Note that
+    envoy only applies a header mutation sent with the (last) body
+    chunk while it still holds the headers, i.e. in BUFFERED mode or
+    within a CompositeExternalProcessorService pipeline.
+    """
+
+    context_class = DigestCallContext
+    request_body_mode = DIGEST_BODY_MODE
+
     def process_request_headers(
         self,
         headers: ext_api.HttpHeaders,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: DigestCallContext,
     ) -> Union[ext_api.HeadersResponse, ext_api.ImmediateResponse]:
 
         callctx.update(
             self.get_headers(
-                headers,
-                [":path", ":method", "x-gateway-tenant"],
-                mapping=["path", "method", "tenant"],
+                self.header_view(headers, callctx),
+                [":path", ":method"],
+                mapping=["path", "method"],
             )
         )
+        callctx.tenant = self.identity(callctx, headers).tenant
 
         # add to hash here to assert ordering
-        callctx["digest"] = sha256()
-        callctx["digest"].update(callctx["tenant"].encode())
-        callctx["digest"].update(callctx["method"].encode())
-        callctx["digest"].update(callctx["path"].encode())
+        callctx.digest = sha256()
+        callctx.digest.update(callctx.tenant.encode())
+        callctx.digest.update(callctx.method.encode())
+        callctx.digest.update(callctx.path.encode())
 
         response = self.just_continue_headers()
 
         # GETs don't have bodies
-        if callctx["method"].lower() == "get":
-            digest = callctx["digest"].hexdigest()
+        if callctx.method.lower() == "get":
+            self.skip_phases(callctx, "request_body")
+            digest = callctx.digest.hexdigest()
             common_response = response.response
             self.add_header(common_response, "X-Request-Digest", digest)
 
         return response
 
-    def process_request_body(
+    def process_request_body_chunk(
+        self,
+        body: ext_api.HttpBody,
+        grpcctx: ServicerContext,
+        callctx: DigestCallContext,
+    ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
+
+        # hash as the body streams by, nothing is kept
+        callctx.digest.update(body.body)
+        return self.just_continue_body()
+
+    def process_request_body_end(
         self,
         body: ext_api.HttpBody,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: DigestCallContext,
     ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
 
-        callctx["digest"].update(str(body.body).encode())
-        digest = callctx["digest"].hexdigest()
+        digest = callctx.digest.hexdigest()
 
         response = self.just_continue_body()
         common_response = response.response
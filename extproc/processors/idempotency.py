@@ -1,8 +1,11 @@
-from base64 import b64decode, b64encode
+from asyncio import get_running_loop, wait
+from base64 import b64decode
 from datetime import timedelta as td
 from json import dumps
 from logging import getLogger
-from typing import Dict, Union
+from os import environ
+from time import time
+from typing import Dict, Optional, Union
 
 from envoy.config.core.v3.base_pb2 import (
     HeaderValueOption as EnvoyHeaderValueOption,
@@ -15,8 +18,11 @@ from gateway.cache.v1.cache_pb2 import CachedHeader, CachedRequestResponse
 from google.protobuf.json_format import MessageToJson
 from grpc import ServicerContext
 
-from ..utils.redis import RedisCache
-from .base import BaseExternalProcessorService
+from ..utils import compression
+from ..utils.cache import LRUCache
+from ..utils.redis import RedisCache, RedisChannels
+from .base import BaseExternalProcessorService, SYNC_HOOK
+from .context import CallContext
 
 logger = getLogger(__name__)
 
@@ -24,70 +30,161 @@ logger = getLogger(__name__)
 IDEMP_CACHE_TIME = td(hours=24)
 IDEMP_SENTINEL_TIME = td(minutes=3)
 
+# cached values (serialized) of at least IDEMP_COMPRESS_THRESHOLD bytes are
+# compressed, with zstd (if installed), lz4 (if installed), zlib or none
+IDEMP_CACHE_CODEC = environ.get(
+    "IDEMP_CACHE_CODEC", "zstd" if compression.available("zstd") else "zlib"
+)
+IDEMP_COMPRESS_THRESHOLD = int(environ.get("IDEMP_COMPRESS_THRESHOLD", "1024"))
+
+# completed responses replayed (recently) are also kept in memory, ready to
+# send (see Replay), up to IDEMP_L1_BYTES (encoded) for up to IDEMP_L1_TTL
+# seconds; they don't change, so any replica can keep them (sentinels do
+# change, so aren't kept)
+IDEMP_L1_BYTES = int(environ.get("IDEMP_L1_BYTES", str(16 * 1024 * 1024)))
+IDEMP_L1_TTL = float(environ.get("IDEMP_L1_TTL", "300"))
+
+# cached entries are redis hashes, with the (serialized) request/response
+# without its body (small, read for every request) and the body (read only
+# to replay a completed response)
+META_FIELD = "meta"
+BODY_FIELD = "body"
+
+# duplicates of a request in progress wait up to IDEMP_WAIT_TIME seconds for
+# its response (see WaitingIdempotencyExternalProcessorService) instead of
+# getting a 409 right away; if 0, they don't wait, and completions aren't
+# published (on a channel per key, IDEMP_CHANNEL_PREFIX + key)
+IDEMP_WAIT_TIME = float(environ.get("IDEMP_WAIT_TIME", "0"))
+IDEMP_CHANNEL_PREFIX = "idemp:completed:"
+
+# the cache stats (hits, misses and hit ratios, see cache_stats) are logged
+# at most every IDEMP_STATS_INTERVAL seconds, while requests come; 0: never
+IDEMP_STATS_INTERVAL = float(environ.get("IDEMP_STATS_INTERVAL", "60"))
+
 # envoy/HTTP uppercases method names
 IDEMP_METHODS = ["POST"]
 
 
+class IdempotencyCallContext(CallContext):
+    """
+    the request/response to cache (None if not cached), and its sentinel;
+    or the sentinel of the request in progress this one duplicates, or the
+    (completed) response replayed
+    """
+
+    __slots__ = ("cached", "sentinel", "duplicate", "replay")
+
+
+class Replay:
+    """
+    a completed response to replay, and the same as a ProcessingResponse,
+    encoded once so that replaying it is sending (cached) bytes; shared by
+    the streams replaying it, so don't modify the response
+    """
+
+    __slots__ = ("response", "encoded")
+
+    def __init__(self, response: ext_api.ImmediateResponse):
+        self.response = response
+        self.encoded = ext_api.ProcessingResponse(immediate_response=response).SerializeToString()
+
+
 class IdempotencyExternalProcessorService(BaseExternalProcessorService):
+    context_class = IdempotencyCallContext
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.cache = RedisCache()
+        self.completed = LRUCache(IDEMP_L1_BYTES)  # key -> Replay
+        self.redis_hits = 0  # responses or sentinels found in redis
+        self.redis_misses = 0  # sentinels set
+        self.in_progress = 0  # of the redis hits, sentinels (409s)
+        self._stats_logged = time()
 
     def process_request_headers(
         self,
         headers: ext_api.HttpHeaders,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: IdempotencyCallContext,
     ) -> Union[ext_api.HeadersResponse, ext_api.ImmediateResponse]:
 
         values = self.get_headers(
-            headers,
-            [":method", ":path", "x-gateway-tenant", "x-request-digest", "x-idempotency-key"],
-            mapping=["method", "path", "tenant", "digest", "idemp_key"],
+            self.header_view(headers, callctx),
+            [":method", ":path", "x-request-digest", "x-idempotency-key"],
+            mapping=["method", "path", "digest", "idemp_key"],
         )
 
         # use only on certain methods
         if values["method"] not in IDEMP_METHODS:
             logger.debug(f"skipping idempotency on {values['method']} {values['path']}")
-            callctx["cached"] = None  # flag, filter not needed on request
+            callctx.cached = None  # flag, filter not needed on request
+            self.skip_phases(callctx, "response_headers", "response_body")
             return self.just_continue_headers()
 
         logger.debug(f"processing idempotency on {values['method']} {values['path']}")
+        self.log_cache_stats()
 
         # default the idempotency key
         if values.get("idemp_key") is None:
             logger.debug("defaulting key to request's digest")
             values["idemp_key"] = values["digest"]
 
-        # respond if cached
-        if self.cache.exists(values["idemp_key"]):
-            return self.response_from_cache(values["idemp_key"])
+        # respond if completed and kept in memory
+        replay = self.completed.get(values["idemp_key"])
+        if replay is not None:
+            callctx.cached, callctx.replay = None, replay
+            return replay.response
 
-        # o/w, start the cache value here
-        callctx["cached"] = CachedRequestResponse(
+        # start the cache value here
+        cached = CachedRequestResponse(
             key=values["idemp_key"],
             path=values["path"],
-            tenant=values["tenant"],
+            tenant=self.identity(callctx, headers).tenant,
             digest=values["digest"],
         )
-        callctx["cached"].when.GetCurrentTime()
+        cached.when.GetCurrentTime()
 
-        self.create_sentinel(callctx["cached"])
+        # respond if cached (or in progress), o/w it is now in progress
+        sentinel = serialize_cache_data(cached)
+        existing = self.create_sentinel(cached, sentinel)
+        if existing is not None:
+            callctx.cached = None
+            return self.response_from_cache(existing, callctx)
 
+        self.redis_misses += 1
+        callctx.cached, callctx.sentinel = cached, sentinel
         return self.just_continue_headers()
 
+    def processing_response(
+        self,
+        phase_name: str,
+        response: Union[
+            ext_api.HeadersResponse,
+            ext_api.BodyResponse,
+            ext_api.TrailersResponse,
+            ext_api.ImmediateResponse,
+        ],
+        duration: int,
+        callctx: IdempotencyCallContext,
+    ) -> Union[bytes, ext_api.ProcessingResponse]:
+        """replays are sent pre-encoded"""
+        replay = callctx.get("replay")
+        if replay is not None and response is replay.response:
+            return replay.encoded
+        return super().processing_response(phase_name, response, duration, callctx)
+
     def process_response_headers(
         self,
         headers: ext_api.HttpHeaders,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: IdempotencyCallContext,
     ) -> Union[ext_api.HeadersResponse, ext_api.ImmediateResponse]:
 
-        cached = callctx["cached"]
+        cached = callctx.cached
         if cached is None:
             return self.just_continue_headers()
 
-        self.delete_sentinel(cached.key)
+        self.delete_sentinel(cached.key, callctx.sentinel)
         # NOTE: between now and the actual cache time is the "danger
         # zone". We have a response, because we have response headers,
         # but we haven't cached it yet so we can't respond with it
@@ -96,11 +193,12 @@ class IdempotencyExternalProcessorService(BaseExternalProcessorService):
         # the sentinel or we risk losing the response forever if the
         # cache update below fails.
 
-        for header in headers.headers.headers:
-            if header.key[0] != ":":
-                cached.headers.append(CachedHeader(key=header.key, value=header.value))
-            elif header.key == ":status":
-                cached.status = int(str(header.value))
+        view = self.header_view(headers, callctx)
+        if ":status" in view:
+            cached.status = int(view[":status"])
+        for key, value in view:
+            if key[0] != ":":
+                cached.headers.append(CachedHeader(key=key, value=value))
 
         response = self.just_continue_headers()
         self.add_header(response.response, "X-Gateway-Cached", "false")
@@ -110,10 +208,10 @@ class IdempotencyExternalProcessorService(BaseExternalProcessorService):
         self,
         body: ext_api.HttpBody,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: IdempotencyCallContext,
     ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
 
-        cached = callctx["cached"]
+        cached = callctx.cached
         if cached is None:
             return self.just_continue_body()
 
@@ -122,38 +220,93 @@ class IdempotencyExternalProcessorService(BaseExternalProcessorService):
         if cached.status in [200, 201]:
             cached.body = body.body
             self.cache_response(cached)
+        if IDEMP_WAIT_TIME > 0:
+            self.cache.publish(completion_channel(cached.key))
 
         return self.just_continue_body()
 
     # cache wrappers
 
-    def create_sentinel(self, data: CachedRequestResponse):
+    def create_sentinel(
+        self, data: CachedRequestResponse, sentinel: Optional[bytes] = None
+    ) -> Optional[bytes]:
+        """
+        set a sentinel for data's key, unless the key is set already (to a
+        sentinel or a response) and then return that (without any body); in
+        one round trip, so concurrent duplicates can't both set it
+        """
         if data.status != 0:
             raise ValueError(f"Sentinels must have status == 0 (not {data.status})")
-        self.cache.setex(data.key, serialize_cache_data(data), expiry=IDEMP_SENTINEL_TIME)
+        if sentinel is None:
+            sentinel = serialize_cache_data(data)
+        return self.cache.hget_or_setex(data.key, META_FIELD, sentinel, expiry=IDEMP_SENTINEL_TIME)
 
-    def delete_sentinel(self, key: str):
-        if self.cache.exists(key):
-            data = self.cache.get(key)
-            cached = deserialize_cache_data(data)
-            if cached.status == 0:
-                self.cache.delete(key)
-            # if status is not 0, ignore (not a sentinel)
+    def delete_sentinel(self, key: str, sentinel: bytes) -> None:
+        """delete the (serialized) sentinel set, if it is still set"""
+        self.cache.delete_if_hequal(key, META_FIELD, sentinel)
 
     def cache_response(self, data: CachedRequestResponse) -> None:
-        self.cache.setex(
-            data.key,
-            serialize_cache_data(data),
-            expiry=IDEMP_CACHE_TIME,
+        self.cache.hsetex(data.key, serialize_cache_fields(data), expiry=IDEMP_CACHE_TIME)
+
+    def fetch_body(self, data: CachedRequestResponse) -> None:
+        """add the body of a completed response (read without it)"""
+        if data.body:  # cached as one value, before bodies were separate
+            return
+        body = self.cache.hget(data.key, BODY_FIELD)
+        if body is not None:
+            data.body = compression.decode(body).decode()
+
+    def keep_completed(self, data: CachedRequestResponse) -> Replay:
+        """
+        keep a completed response (to replay) in memory, expiring no later
+        than in redis; on its first replay, so keys never replayed aren't kept
+        """
+        replay = Replay(self.cached_response(data))
+        expires_at = data.when.seconds + IDEMP_CACHE_TIME.total_seconds()
+        self.completed.set(
+            data.key, replay, min(expires_at, time() + IDEMP_L1_TTL), size=len(replay.encoded)
         )
-
-    def response_from_cache(self, key: str) -> ext_api.ImmediateResponse:
-
-        data = self.cache.get(key)
-        if data is None:
-            raise ValueError(f"{key} is not cached")
-
-        cached = deserialize_cache_data(data)
+        return replay
+
+    def cache_stats(self) -> Dict[str, Dict[str, float]]:
+        """hits, misses and hit ratios of the in-memory (L1) cache and of redis"""
+        return {
+            "l1": {
+                **hit_ratio(self.completed.hits, self.completed.misses),
+                "bytes": self.completed.size,
+            },
+            "redis": {
+                **hit_ratio(self.redis_hits, self.redis_misses),
+                "in_progress": self.in_progress,
+            },
+        }
+
+    def log_cache_stats(self) -> None:
+        """log cache_stats, at most every IDEMP_STATS_INTERVAL seconds"""
+        now = time()
+        if not IDEMP_STATS_INTERVAL or now - self._stats_logged < IDEMP_STATS_INTERVAL:
+            return
+        self._stats_logged = now
+        logger.info(f"Idempotency cache stats {dumps(self.cache_stats())}")
+
+    def response_from_cache(
+        self, existing: bytes, callctx: IdempotencyCallContext
+    ) -> ext_api.ImmediateResponse:
+        """the response for a sentinel or completed response found in redis (serialized)"""
+        self.redis_hits += 1
+        cached = deserialize_cache_data(existing)
+        if cached.status == 0:
+            self.in_progress += 1
+            callctx.duplicate = existing
+            return self.cached_response(cached)
+
+        callctx.duplicate = None
+        self.fetch_body(cached)
+        callctx.replay = self.keep_completed(cached)
+        return callctx.replay.response
+
+    def cached_response(self, cached: CachedRequestResponse) -> ext_api.ImmediateResponse:
+        """the response for a cached sentinel or response"""
 
         if cached.status == 0:  # this is a sentinel, respond 409
             return ext_api.ImmediateResponse(
@@ -185,14 +338,95 @@ class IdempotencyExternalProcessorService(BaseExternalProcessorService):
         )
 
 
+class WaitingIdempotencyExternalProcessorService(IdempotencyExternalProcessorService):
+    """
+    Idempotency where duplicates of a request in progress wait, up to
+    IDEMP_WAIT_TIME seconds, for it to complete, instead of getting a 409
+    right away. Then they get its cached response, or (if it wasn't
+    cached, e.g. it failed) proceed as the request in progress.
+
+    Completions are published to a redis channel per key, so waiting is
+    awaiting a message on the event loop (not polling), and waiting
+    streams don't hold worker threads. That takes the server's event
+    loop, so this can only be served with asyncio (see AsyncProcess);
+    run on a private event loop (see run_sync), duplicates don't wait.
+    """
+
+    requires_asyncio = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.channels: Optional[RedisChannels] = None  # on the server's event loop
+
+    async def process_request_headers(
+        self,
+        headers: ext_api.HttpHeaders,
+        grpcctx: ServicerContext,
+        callctx: IdempotencyCallContext,
+    ) -> Union[ext_api.HeadersResponse, ext_api.ImmediateResponse]:
+
+        loop = get_running_loop()
+        check = super().process_request_headers
+        response = await loop.run_in_executor(None, check, headers, grpcctx, callctx)
+
+        sentinel = callctx.get("duplicate")
+        if sentinel is None or IDEMP_WAIT_TIME <= 0 or SYNC_HOOK.get():
+            return response
+
+        await self.wait_for(deserialize_cache_data(sentinel).key, sentinel)
+        return await loop.run_in_executor(None, check, headers, grpcctx, callctx)
+
+    async def wait_for(self, key: str, sentinel: bytes) -> bool:
+        """wait for the request in progress (its sentinel) to complete, and whether it did"""
+        loop = get_running_loop()
+        if self.channels is None:
+            self.channels = RedisChannels()
+        try:
+            async with self.channels.listen(completion_channel(key)) as completed:
+                # it may have completed before listening
+                meta = await loop.run_in_executor(None, self.cache.hget, key, META_FIELD)
+                if meta != sentinel:
+                    return True
+                done, _ = await wait([completed], timeout=IDEMP_WAIT_TIME)
+                return bool(done)
+
+        except Exception as e:
+            logger.error(f"Waiting for {key} failed: {e.__class__.__name__} {e}")
+            return False
+
+
 # non-class helpers
 
 
-def serialize_cache_data(data: CachedRequestResponse) -> str:
-    return b64encode(data.SerializeToString()).decode()
+def completion_channel(key: str) -> str:
+    return f"{IDEMP_CHANNEL_PREFIX}{key}"
+
+
+def hit_ratio(hits: int, misses: int) -> Dict[str, float]:
+    lookups = hits + misses
+    return {"hits": hits, "misses": misses, "hit_ratio": hits / lookups if lookups else 0.0}
+
+
+def serialize_cache_data(data: CachedRequestResponse) -> bytes:
+    return compression.encode(
+        data.SerializeToString(), codec=IDEMP_CACHE_CODEC, threshold=IDEMP_COMPRESS_THRESHOLD
+    )
+
+
+def serialize_cache_fields(data: CachedRequestResponse) -> Dict[str, bytes]:
+    """a completed request/response, as cached hash fields"""
+    meta = CachedRequestResponse()
+    meta.CopyFrom(data)
+    meta.ClearField("body")
+    return {
+        META_FIELD: serialize_cache_data(meta),
+        BODY_FIELD: compression.encode(
+            data.body.encode(), codec=IDEMP_CACHE_CODEC, threshold=IDEMP_COMPRESS_THRESHOLD
+        ),
+    }
 
 
-def deserialize_cache_data(data: str) -> CachedRequestResponse:
-    obj = CachedRequestResponse()
-    obj.ParseFromString(b64decode(data.encode()))
-    return obj
+def deserialize_cache_data(data: bytes) -> CachedRequestResponse:
+    if compression.is_encoded(data):
+        return CachedRequestResponse.FromString(compression.decode(data))
+    return CachedRequestResponse.FromString(b64decode(data))  # cached before compression
@@ -1,7 +1,11 @@
 from json import JSONDecodeError, loads
 from logging import getLogger
+from os import environ
 from typing import Dict, List, Union
 
+from envoy.extensions.filters.http.ext_proc.v3.processing_mode_pb2 import (
+    ProcessingMode,
+)
 from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
 from flatten_json import flatten
 from gateway.log.v1 import log_pb2 as api
@@ -9,11 +13,27 @@ from grpc import ServicerContext
 
 from ..utils.kafka import kafka_config, KAFKA_TOPIC, ProtobufProducer
 from .base import BaseExternalProcessorService
+from .context import CallContext
 
 logger = getLogger(__name__)
 
+# bodies are streamed through, and only the first LOG_BODY_LIMIT
+# bytes of each (request and response) body are logged
+LOG_BODY_MODE = ProcessingMode.BodySendMode.Value(environ.get("LOG_BODY_MODE", "STREAMED"))
+LOG_BODY_LIMIT = int(environ.get("LOG_BODY_LIMIT", "65536"))
+
+
+class LoggingCallContext(CallContext):
+    """the log, built across phases, and the (prefix of the) body being captured"""
+
+    __slots__ = ("log", "content_type", "body", "body_size")
+
 
 class LoggingExternalProcessorService(BaseExternalProcessorService):
+    context_class = LoggingCallContext
+    request_body_mode = LOG_BODY_MODE
+    response_body_mode = LOG_BODY_MODE
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)  # chain initialization upwards
         self._producer = ProtobufProducer(**kafka_config())
@@ -22,7 +42,7 @@ class LoggingExternalProcessorService(BaseExternalProcessorService):
         self,
         headers: ext_api.HttpHeaders,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: LoggingCallContext,
     ) -> Union[ext_api.HeadersResponse, ext_api.ImmediateResponse]:
 
         # start the log
@@ -31,96 +51,92 @@ class LoggingExternalProcessorService(BaseExternalProcessorService):
             identity=api.LogIdentity(),
         )
 
-        callctx["content_type"] = "text/plain"
-
-        # we loop here because we store all the data
-        for header in headers.headers.headers:
-
-            if header.key == ":method":
-                log.record.method = str(header.value)
-            elif header.key == ":path":
-                log.record.path = str(header.value)
-            elif header.key == ":authority":
-                log.record.domain = str(header.value)
-            elif header.key == ":scheme":
-                log.record.url = str(header.value)  # just start here, see below
-            elif header.key == "x-request-started":
-                log.record.start_time.FromJsonString(str(header.value))
-            elif header.key == "x-request-id":
-                log.record.request_id = str(header.value)
-            elif header.key == "x-gateway-tenant":
-                log.identity.tenant = str(header.value)
-            elif header.key == "x-gateway-userid":
-                log.identity.user_id = str(header.value)
-            elif header.key == "identity":
-                log.identity.key_id = str(header.value)
-            elif header.key == "content-type":
-                callctx["content_type"] = str(header.value).lower()
-
-            # store all but the envoy http-standard headers
-            if header.key[0] != ":":
-                log.request.headers.append(api.LogMetadata(key=header.key, value=header.value))
+        view = self.header_view(headers, callctx)
+
+        log.record.method = view.get(":method", "")
+        log.record.path = view.get(":path", "")
+        log.record.domain = view.get(":authority", "")
+        log.record.url = view.get(":scheme", "")  # just start here, see below
+        if "x-request-started" in view:
+            log.record.start_time.FromJsonString(view["x-request-started"])
+        log.record.request_id = view.get("x-request-id", "")
+        identity = self.identity(callctx, headers)
+        log.identity.tenant = identity.tenant
+        log.identity.user_id = identity.user_id
+        log.identity.key_id = identity.key_id or view.get("identity", "")
+        callctx.content_type = view.get("content-type", "text/plain").lower()
+
+        # store all but the envoy http-standard headers
+        for key, value in view:
+            if key[0] != ":":
+                log.request.headers.append(api.LogMetadata(key=key, value=value))
 
         log.record.url = f"{log.record.url}://{log.record.domain}{log.record.path}"
 
-        callctx["log"] = log
+        callctx.log = log
+        self.start_body(callctx)
 
         return self.just_continue_headers()
 
-    def process_request_body(
+    def process_request_body_chunk(
         self,
         body: ext_api.HttpBody,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: LoggingCallContext,
     ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
+        self.capture_body(body, callctx)
+        return self.just_continue_body()
 
-        log = callctx["log"]
-        log.request.body.extend(
-            encode_body_data(
-                body=body.body,
-                content_type=callctx["content_type"],
-            )
-        )
+    def process_request_body_end(
+        self,
+        body: ext_api.HttpBody,
+        grpcctx: ServicerContext,
+        callctx: LoggingCallContext,
+    ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
+        callctx.log.request.body.extend(self.captured_body(callctx))
         return self.just_continue_body()
 
     def process_response_headers(
         self,
         headers: ext_api.HttpHeaders,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: LoggingCallContext,
     ) -> Union[ext_api.HeadersResponse, ext_api.ImmediateResponse]:
 
-        log = callctx["log"]
-        callctx["content_type"] = "text/plain"
+        log = callctx.log
 
-        # we loop here because we store all the data
-        for header in headers.headers.headers:
+        view = self.header_view(headers, callctx)
+        if ":status" in view:
+            log.record.status = int(view[":status"])
+        callctx.content_type = view.get("content-type", "text/plain").lower()  # for body
 
-            if header.key == ":status":
-                log.record.status = int(str(header.value))
-            elif header.key == "content-type":  # used in response_body phase
-                callctx["content_type"] = str(header.value).lower()
+        # store all but the envoy http-standard headers
+        for key, value in view:
+            if key[0] != ":":
+                log.response.headers.append(api.LogMetadata(key=key, value=value))
 
-            # store all but the envoy http-standard headers
-            if header.key[0] != ":":
-                log.response.headers.append(api.LogMetadata(key=header.key, value=header.value))
+        self.start_body(callctx)
 
         return self.just_continue_headers()
 
-    def process_response_body(
+    def process_response_body_chunk(
         self,
         body: ext_api.HttpBody,
         grpcctx: ServicerContext,
-        callctx: Dict,
+        callctx: LoggingCallContext,
     ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
+        self.capture_body(body, callctx)
+        return self.just_continue_body()
 
-        log = callctx["log"]
-        log.response.body.extend(
-            encode_body_data(
-                body=body.body,
-                content_type=callctx["content_type"],  # from response_headers phase
-            )
-        )
+    def process_response_body_end(
+        self,
+        body: ext_api.HttpBody,
+        grpcctx: ServicerContext,
+        callctx: LoggingCallContext,
+    ) -> Union[ext_api.BodyResponse, ext_api.ImmediateResponse]:
+
+        log = callctx.log
+        log.response.body.extend(self.captured_body(callctx))
         log.record.end_time.GetCurrentTime()
         log.record.duration.FromNanoseconds(
             log.record.end_time.ToNanoseconds() - log.record.start_time.ToNanoseconds()
@@ -135,6 +151,34 @@ class LoggingExternalProcessorService(BaseExternalProcessorService):
 
         return self.just_continue_body()
 
+    # body capture
+
+    def start_body(self, callctx: LoggingCallContext) -> None:
+        callctx.body = bytearray()
+        callctx.body_size = 0
+
+    def capture_body(self, body: ext_api.HttpBody, callctx: LoggingCallContext) -> None:
+        """keep (at most) the first LOG_BODY_LIMIT bytes of a body, chunk by chunk"""
+        callctx.body_size += len(body.body)
+        room = LOG_BODY_LIMIT - len(callctx.body)
+        if room > 0 and body.body:
+            chunk = body.body[:room]
+            callctx.body += chunk
+            callctx.retain(len(chunk))
+
+    def captured_body(self, callctx: LoggingCallContext) -> List[api.LogMetadata]:
+        """the (encoded) body captured, which is then released"""
+        body = bytes(callctx.body)
+        callctx.release(len(body))
+        callctx.body = bytearray()
+
+        if callctx.body_size > len(body):
+            # a truncated body won't parse (as json), log it raw
+            return encode_raw_body_data(body.decode(errors="replace")) + [
+                api.LogMetadata(key="truncated", value=str(callctx.body_size))
+            ]
+        return encode_body_data(body=body, content_type=callctx.content_type)
+
 
 # non-class helpers
 
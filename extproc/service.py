@@ -1,25 +1,179 @@
+import asyncio
 from concurrent import futures
 import logging
+import os
 from os import environ
+import signal
+import time
+from typing import Callable, Dict
 
+from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
 from envoy.service.ext_proc.v3.external_processor_pb2_grpc import (
-    add_ExternalProcessorServicer_to_server,
     ExternalProcessorServicer,
 )
 import grpc
 
 from .processors import BaseExternalProcessorService
+from .processors.base import serialize_response
 
 logger = logging.getLogger(__name__)
 
 GRPC_PORT = environ.get("GRPC_PORT", "50051")
 GRPC_WORKERS = int(environ.get("GRPC_WORKERS", "5"))
 
+# every (forked) server process binds the same port, the kernel
+# balances incoming connections between them
+GRPC_OPTIONS = [("grpc.so_reuseport", 1)]
 
-def serve(service: ExternalProcessorServicer = BaseExternalProcessorService()) -> None:
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=GRPC_WORKERS))
+# pause before restarting a crashed worker, so a crash loop
+# doesn't turn into a fork bomb
+WORKER_RESTART_DELAY = float(environ.get("WORKER_RESTART_DELAY", "1.0"))
+
+# on SIGINT or SIGTERM, how long streams in flight get to complete
+# before the server cancels them
+GRPC_SHUTDOWN_GRACE = float(environ.get("GRPC_SHUTDOWN_GRACE", "5.0"))
+
+EXT_PROC_SERVICE_NAME = "envoy.service.ext_proc.v3.ExternalProcessor"
+
+
+def serve(
+    service: ExternalProcessorServicer = BaseExternalProcessorService(),
+    use_asyncio: bool = False,
+) -> None:
+    if not use_asyncio and getattr(service, "requires_asyncio", False):
+        raise ValueError(f"{service} can only be served with asyncio (--asyncio)")
+    if use_asyncio:
+        return asyncio.run(serve_async(service=service))
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=GRPC_WORKERS), options=GRPC_OPTIONS)
     logger.info(f"Starting gRPC server {service}")
-    add_ExternalProcessorServicer_to_server(service, server)
+    server.add_generic_rpc_handlers((processor_handler(service),))
     server.add_insecure_port(f"[::]:{GRPC_PORT}")
     server.start()
+
+    def stop(signum: int, frame) -> None:
+        logger.info(f"Stopping gRPC server (grace {GRPC_SHUTDOWN_GRACE}s)")
+        server.stop(GRPC_SHUTDOWN_GRACE)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
     server.wait_for_termination()
+
+
+async def serve_async(
+    service: BaseExternalProcessorService = BaseExternalProcessorService(),
+) -> None:
+    """
+    Serve with grpc.aio, so streams are held by the event loop instead
+    of (a fixed number of) threads. Sync "process_..." methods are run
+    in the loop's default executor, sized with GRPC_WORKERS.
+    """
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(futures.ThreadPoolExecutor(max_workers=GRPC_WORKERS))
+
+    server = grpc.aio.server(options=GRPC_OPTIONS)
+    logger.info(f"Starting gRPC (asyncio) server {service}")
+    server.add_generic_rpc_handlers((processor_handler(service, use_asyncio=True),))
+    server.add_insecure_port(f"[::]:{GRPC_PORT}")
+    await server.start()
+
+    stopping = []
+
+    def stop() -> None:
+        logger.info(f"Stopping gRPC (asyncio) server (grace {GRPC_SHUTDOWN_GRACE}s)")
+        stopping.append(loop.create_task(server.stop(GRPC_SHUTDOWN_GRACE)))
+
+    loop.add_signal_handler(signal.SIGINT, stop)
+    loop.add_signal_handler(signal.SIGTERM, stop)
+    await server.wait_for_termination()
+
+
+def processor_handler(
+    service: BaseExternalProcessorService,
+    use_asyncio: bool = False,
+) -> grpc.GenericRpcHandler:
+    """
+    grpc handler for the ext_proc service, with Process (or AsyncProcess)
+    as the stream handler. Serializes with serialize_response so that
+    pre-encoded responses are sent as they are.
+    """
+    return grpc.method_handlers_generic_handler(
+        EXT_PROC_SERVICE_NAME,
+        {
+            "Process": grpc.stream_stream_rpc_method_handler(
+                service.AsyncProcess if use_asyncio else service.Process,
+                request_deserializer=ext_api.ProcessingRequest.FromString,
+                response_serializer=serialize_response,
+            ),
+        },
+    )
+
+
+def serve_processes(
+    factory: Callable[[], ExternalProcessorServicer],
+    processes: int,
+    use_asyncio: bool = False,
+) -> None:
+    """
+    Pre-fork "processes" servers, each binding GRPC_PORT (SO_REUSEPORT),
+    so throughput isn't bound by a single interpreter's GIL. The parent
+    only supervises: it restarts workers that die and forwards SIGINT
+    and SIGTERM to the workers on shutdown, which stop their servers
+    gracefully (see GRPC_SHUTDOWN_GRACE).
+
+    The service is constructed (with "factory") in each worker, _after_
+    forking, because grpc (and clients like kafka's or redis') do not
+    survive a fork.
+    """
+
+    workers: Dict[int, int] = {}  # pid -> worker number
+    stopping = False
+
+    def spawn(number: int) -> None:
+        pid = os.fork()
+        if pid == 0:  # worker
+            # not the parent's forwarding; serve stops gracefully once started
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                serve(service=factory(), use_asyncio=use_asyncio)
+            except Exception:
+                logger.exception(f"Worker {number} ({os.getpid()}) failed")
+                code = 1
+            finally:
+                os._exit(code)
+        logger.info(f"Started worker {number} ({pid})")
+        workers[pid] = number
+
+    def forward(signum: int, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, forward)
+    signal.signal(signal.SIGTERM, forward)
+
+    for number in range(processes):
+        spawn(number)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        number = workers.pop(pid, None)
+        if number is None:
+            continue
+        if stopping:
+            logger.info(f"Worker {number} ({pid}) stopped")
+            continue
+        logger.warning(
+            f"Worker {number} ({pid}) exited ({os.waitstatus_to_exitcode(status)}), restarting"
+        )
+        time.sleep(WORKER_RESTART_DELAY)
+        if not stopping:
+            spawn(number)
@@ -0,0 +1,172 @@
+from collections import OrderedDict
+from threading import Event, Lock
+from time import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+"""
+In-process caches, shared by the streams (threads) of a server process.
+"""
+
+
+class LRUCache:
+    """
+    Bounded, thread-safe LRU cache where each entry expires at a given
+    (epoch) time. Expired entries are dropped when looked up, or when
+    evicted as least recently used. Counts hits and misses.
+
+    Bounded to "maxsize" entries or, if entries are set with a size (e.g.,
+    in bytes), to a total "maxsize" of their sizes.
+    """
+
+    def __init__(self, maxsize: int, clock: Callable[[], float] = time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.size = 0  # of all entries
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float, int]]" = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """the value for key, if present and not expired"""
+        entry = self.get_with_expiry(key)
+        return default if entry is None else entry[0]
+
+    def get_with_expiry(self, key: Hashable) -> Optional[Tuple[Any, float]]:
+        """the value for key and when it expires, if present and not expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at, _ = entry
+                if expires_at > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value, expires_at
+                self._pop(key)
+            self.misses += 1
+            return None
+
+    def set(self, key: Hashable, value: Any, expires_at: float, size: int = 1) -> None:
+        """store value (of size) for key until expires_at, evicting LRU entries if full"""
+        if size > self.maxsize or expires_at <= self.clock():
+            return
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, expires_at, size)
+            self.size += size
+            while self.size > self.maxsize:
+                self._pop(next(iter(self._entries)))
+
+    def expires_at(self, key: Hashable) -> Optional[float]:
+        """when the entry for key expires (None if not present); not a hit or a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry[1]
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._pop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _pop(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+class FlightTimeout(TimeoutError):
+    """waited too long for a call in flight"""
+
+
+class Flight:
+    """a call in flight, and its outcome once done"""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls by key: the first caller for a key runs
+    the function, and callers for the same key while it runs wait (up
+    to "timeout" seconds, then raise FlightTimeout) and share its result,
+    or error, instead of making the same call. Counts the calls made
+    and the calls shared.
+    """
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.timeout = timeout
+        self.calls = 0
+        self.shared = 0
+        self._flights: Dict[Hashable, Flight] = {}
+        self._lock = Lock()
+
+    def do(self, key: Hashable, function: Callable, *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            flight = self._flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self._flights[key] = Flight()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leading:
+            if not flight.done.wait(self.timeout):
+                raise FlightTimeout(f"Waited {self.timeout}s for a call in flight")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function(*args, **kwargs)
+            return flight.result
+        except BaseException as err:
+            flight.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class WindowCounter:
+    """
+    Counts (e.g., failures) by key in fixed windows of "window" seconds,
+    starting at a key's first count; keeps up to "maxsize" keys (LRU).
+    """
+
+    def __init__(self, maxsize: int, window: float, clock: Callable[[], float] = time):
+        self.window = window
+        self._counts = LRUCache(maxsize, clock=clock)
+        self._lock = Lock()
+
+    def add(self, key: Hashable) -> int:
+        """count one more for key, the count in its window"""
+        with self._lock:
+            count = self._counts.get(key, 0) + 1
+            expires_at = self._counts.expires_at(key) or self._counts.clock() + self.window
+            self._counts.set(key, count, expires_at)
+            return count
+
+    def count(self, key: Hashable) -> int:
+        return self._counts.get(key, 0)
+
+    def retry_after(self, key: Hashable) -> float:
+        """seconds until the window for key ends"""
+        expires_at = self._counts.expires_at(key)
+        return 0.0 if expires_at is None else max(0.0, expires_at - self._counts.clock())
@@ -0,0 +1,84 @@
+from importlib import import_module
+from logging import getLogger
+from struct import Struct
+import zlib
+
+logger = getLogger(__name__)
+
+"""
+Compression for cached values, with a (two byte) header saying how a
+value is encoded: a format version and a codec.
+
+zstd and lz4 are used if their packages (zstandard, lz4) are installed;
+zlib is always available.
+"""
+
+VERSION = 1
+HEADER = Struct("BB")  # version, codec
+
+NONE, ZLIB, ZSTD, LZ4 = 0, 1, 2, 3
+CODECS = {"none": NONE, "zlib": ZLIB, "zstd": ZSTD, "lz4": LZ4}
+
+
+class UnknownCodec(ValueError):
+    """a codec that isn't known, or not installed"""
+
+
+def available(codec: str) -> bool:
+    """whether a codec (name) can be used"""
+    try:
+        compressor(CODECS[codec])
+        return True
+    except (KeyError, UnknownCodec):
+        return False
+
+
+def encode(payload: bytes, codec: str = "zlib", threshold: int = 1024) -> bytes:
+    """a header and the payload, compressed with codec if at least threshold bytes"""
+    codec_id = CODECS[codec] if len(payload) >= threshold else NONE
+    if codec_id != NONE:
+        compressed = compressor(codec_id)[0](payload)
+        if len(compressed) < len(payload):
+            return HEADER.pack(VERSION, codec_id) + compressed
+    return HEADER.pack(VERSION, NONE) + payload
+
+
+def decode(data: bytes) -> bytes:
+    """the payload of encoded data"""
+    version, codec_id = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f"Unknown version {version}")
+    payload = memoryview(data)[HEADER.size :]
+    if codec_id == NONE:
+        return bytes(payload)
+    return compressor(codec_id)[1](payload)
+
+
+def is_encoded(data: bytes) -> bool:
+    return len(data) >= HEADER.size and data[0] == VERSION
+
+
+# the (compress, decompress) functions by codec, imported on first use
+_compressors = {ZLIB: (zlib.compress, zlib.decompress)}
+
+
+def compressor(codec_id: int):
+    functions = _compressors.get(codec_id)
+    if functions is not None:
+        return functions
+    try:
+        if codec_id == ZSTD:
+            zstandard = import_module("zstandard")
+            functions = (
+                lambda payload: zstandard.ZstdCompressor().compress(payload),
+                lambda payload: zstandard.ZstdDecompressor().decompress(payload),
+            )
+        elif codec_id == LZ4:
+            frame = import_module("lz4.frame")
+            functions = (frame.compress, frame.decompress)
+        else:
+            raise UnknownCodec(f"Unknown codec {codec_id}")
+    except ImportError as err:
+        raise UnknownCodec(f"Codec {codec_id} is not installed: {err}") from err
+    _compressors[codec_id] = functions
+    return functions
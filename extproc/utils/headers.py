@@ -0,0 +1,79 @@
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from envoy.config.core.v3.base_pb2 import HeaderMap as EnvoyHeaderMap
+from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
+
+
+class HeaderView:
+    """
+    Case-insensitive, indexed (read only) view of the headers envoy sends
+    in a phase. The index is built on the first lookup, with one pass over
+    the headers, and each lookup after that is a dict access instead of a
+    scan of the headers. Repeated headers are kept (see get_all).
+
+    Build one per phase message (BaseExternalProcessorService.header_view
+    caches it on the call context) and pass it around instead of the
+    HttpHeaders.
+    """
+
+    __slots__ = ("source", "map", "_first", "_more")
+
+    def __init__(self, headers: Union[ext_api.HttpHeaders, EnvoyHeaderMap]):
+        self.source = headers
+        self.map = headers.headers if isinstance(headers, ext_api.HttpHeaders) else headers
+        self._first: Optional[Dict[str, str]] = None
+        self._more: Dict[str, List[str]] = {}  # values after the first, if repeated
+
+    def _index(self) -> Dict[str, str]:
+        first: Dict[str, str] = {}
+        for header in self.map.headers:
+            key = header.key.lower()  # envoy lower cases already, but be safe
+            if key in first:
+                self._more.setdefault(key, []).append(header.value)
+            else:
+                first[key] = header.value
+        self._first = first
+        return first
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        """the (first) value of a header, or default if not present"""
+        first = self._first if self._first is not None else self._index()
+        value = first.get(name)
+        if value is None:
+            value = first.get(name.lower(), default)
+        return value
+
+    def get_all(self, name: str) -> List[str]:
+        """all the values of a (possibly repeated) header"""
+        first = self._first if self._first is not None else self._index()
+        key = name if name in first else name.lower()
+        if key not in first:
+            return []
+        return [first[key], *self._more.get(key, [])]
+
+    def pick(self, names: List[str], mapping: Optional[List[str]] = None) -> Dict[str, str]:
+        """values of the headers present, keyed by name (or by mapping[i] for names[i])"""
+        keys = names if mapping is None else mapping
+        results = {}
+        for name, key in zip(names, keys):
+            value = self.get(name)
+            if value is not None:
+                results[key] = value
+        return results
+
+    def __contains__(self, name: str) -> bool:
+        return self.get(name) is not None
+
+    def __getitem__(self, name: str) -> str:
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        """(key, value) pairs, in the order envoy sent them"""
+        for header in self.map.headers:
+            yield header.key, header.value
+
+    def __len__(self) -> int:
+        return len(self.map.headers)
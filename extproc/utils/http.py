@@ -0,0 +1,224 @@
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures import as_completed, Future, ThreadPoolExecutor
+from logging import getLogger
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, List, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = getLogger(__name__)
+
+"""
+A pooled, resilient (blocking) HTTP client for calls to other services
+on the request path: keep-alive connections, timeouts, retries with
+jittered backoff, hedged requests and a circuit breaker.
+"""
+
+# worth retrying (on another connection, or after a pause)
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+
+class Unavailable(Exception):
+    """the service can't be reached, or keeps failing"""
+
+
+class CircuitOpen(Unavailable):
+    """not even trying, the service failed too often lately"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Circuit open, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Opens after "failures" consecutive failed calls, failing fast for
+    "reset_after" seconds. Then one (trial) call is let through: if it
+    succeeds the circuit closes, if it fails it opens again.
+    """
+
+    def __init__(
+        self,
+        failures: int = 5,
+        reset_after: float = 10.0,
+        clock: Callable[[], float] = monotonic,
+    ):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.clock = clock
+        self._failed = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        self._lock = Lock()
+
+    @property
+    def open(self) -> bool:
+        return self._opened_at is not None
+
+    def check(self) -> None:
+        """raise CircuitOpen, unless a call can be made"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_after - self.clock()
+            if remaining > 0 or self._trial:
+                raise CircuitOpen(max(remaining, 0.0))
+            self._trial = True  # half open
+
+    def success(self) -> None:
+        with self._lock:
+            self._failed = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failed += 1
+            if self._trial or self._failed >= self.failures:
+                if self._opened_at is None:
+                    logger.warning(f"Circuit opened after {self._failed} failures")
+                self._opened_at = self.clock()
+                self._trial = False
+
+
+class HttpClient:
+    """
+    requests.Session with a (keep-alive) connection pool of "pool_size",
+    for concurrent use from a server's worker threads.
+
+    Requests are retried ("retries" times) on connection errors,
+    timeouts and RETRY_STATUSES, with exponential backoff and full
+    jitter, within a total "deadline" (seconds, if set) that caps the
+    attempts' timeouts and stops retries. If "hedge_after" (seconds)
+    passes without a response, a second (hedged) request is sent and the
+    first response wins. Calls that fail (however) count towards opening
+    the circuit breaker; while it is open calls raise CircuitOpen right
+    away.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        pool_size: int = 10,
+        connect_timeout: float = 1.0,
+        read_timeout: float = 5.0,
+        retries: int = 2,
+        backoff: float = 0.1,
+        hedge_after: Optional[float] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        deadline: Optional[float] = None,
+    ):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.deadline = deadline or None
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_after = hedge_after or None
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # for hedging, the first and the hedged request run in threads
+        self._hedger: Optional[ThreadPoolExecutor] = None
+        if self.hedge_after:
+            self._hedger = ThreadPoolExecutor(max_workers=2 * pool_size)
+
+    def get(self, path: str = "", **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def request(self, method: str, path: str = "", **kwargs) -> requests.Response:
+        """
+        a response (with any status not retried), or raise Unavailable
+        (CircuitOpen if not even tried)
+        """
+        self.breaker.check()
+        url = f"{self.base_url}{path}"
+        timeout = kwargs.pop("timeout", self.timeout)
+        deadline = None if self.deadline is None else monotonic() + self.deadline
+
+        # every way out is a success or a failure, else a half open
+        # breaker would wait on its trial call forever
+        succeeded = False
+        try:
+            error: Optional[Exception] = None
+            tried = 0
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    pause = uniform(0, self.backoff * 2 ** (attempt - 1))  # full jitter
+                    if deadline is not None and monotonic() + pause >= deadline:
+                        break
+                    sleep(pause)
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    kwargs["timeout"] = cap_timeout(timeout, remaining)
+                else:
+                    kwargs["timeout"] = timeout
+                tried += 1
+                try:
+                    response = self.send(method, url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout, FutureTimeout) as err:
+                    error = err
+                    continue
+                if response.status_code in RETRY_STATUSES:
+                    error = Unavailable(f"{method} {url} responded {response.status_code}")
+                    continue
+                succeeded = True
+                return response
+
+            raise Unavailable(f"{method} {url} failed after {tried} attempts") from error
+
+        finally:
+            if succeeded:
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+
+    def send(self, method: str, url: str, **kwargs) -> requests.Response:
+        """send a request, hedged if it takes more than hedge_after seconds"""
+        if self._hedger is None:
+            return self.session.request(method, url, **kwargs)
+
+        first = self._hedger.submit(self.session.request, method, url, **kwargs)
+        try:
+            return first.result(timeout=self.hedge_after)
+        except FutureTimeout:
+            pass
+
+        logger.debug(f"Hedging {method} {url} after {self.hedge_after}s")
+        hedged = self._hedger.submit(self.session.request, method, url, **kwargs)
+        return first_result([first, hedged])
+
+    def close(self) -> None:
+        self.session.close()
+        if self._hedger is not None:
+            self._hedger.shutdown(wait=False)
+
+
+# non-class helpers
+
+
+def cap_timeout(
+    timeout: Union[float, Tuple[float, float]], limit: float
+) -> Union[float, Tuple[float, float]]:
+    """a (connect, read) or single timeout, no longer than limit"""
+    if isinstance(timeout, tuple):
+        return tuple(min(t, limit) for t in timeout)
+    return min(timeout, limit)
+
+
+def first_result(futures: List[Future]) -> requests.Response:
+    """the first successful result, or the last error if none succeed"""
+    error: Optional[BaseException] = None
+    for future in as_completed(futures):
+        error = future.exception()
+        if error is None:
+            return future.result()
+    raise error
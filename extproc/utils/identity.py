@@ -0,0 +1,50 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from logging import getLogger
+from typing import Dict
+
+from gateway.identity.v1.identity_pb2 import Identity, Scope
+from google.protobuf.message import DecodeError
+
+from .headers import HeaderView
+
+logger = getLogger(__name__)
+
+"""
+The caller's identity, as authenticated, in one (compact) header: a
+serialized gateway.identity.v1.Identity, base64 encoded.
+"""
+
+IDENTITY_HEADER = "x-gateway-identity"
+
+# identity headers authn set before IDENTITY_HEADER; not trusted (clients
+# can send them), so authn removes them from every request
+LEGACY_HEADERS = ("x-gateway-tenant", "x-gateway-userid", "x-gateway-keyid", "x-auth-claims")
+
+
+def encode_identity(claims: Dict) -> str:
+    """the IDENTITY_HEADER value for (verified) token claims"""
+    identity = claims.get("identity") or {}
+    message = Identity(
+        tenant=str(identity.get("tenant") or ""),
+        user_id=str(identity.get("user_id") or ""),
+        key_id=str(identity.get("key_id") or ""),
+        scopes=[
+            Scope(resource=scope["resource"], action=scope["action"])
+            for scope in claims.get("scopes") or []
+        ],
+        expires=int(claims.get("exp", 0)),
+    )
+    return urlsafe_b64encode(message.SerializeToString()).decode()
+
+
+def decode_identity(headers: HeaderView) -> Identity:
+    """the identity in request headers (empty if there's none)"""
+    value = headers.get(IDENTITY_HEADER)
+    if value is None:
+        return Identity()
+    try:
+        return Identity.FromString(urlsafe_b64decode(value))
+    except (Base64Error, DecodeError, ValueError) as err:
+        logger.warning(f"Malformed {IDENTITY_HEADER} header: {err}")
+        return Identity()
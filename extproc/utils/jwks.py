@@ -0,0 +1,136 @@
+from json import load
+from logging import getLogger
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import Callable, Dict, Optional, Tuple
+
+from jwt import PyJWK
+from jwt.exceptions import PyJWKError
+
+from .http import HttpClient
+
+logger = getLogger(__name__)
+
+"""
+Signing keys for (asymmetric) token verification, from a JWKS document.
+"""
+
+# the algorithm implied by a key, when it doesn't say
+DEFAULT_ALGORITHMS = {"RSA": "RS256", ("EC", "P-256"): "ES256"}
+
+
+class KeysUnavailable(Exception):
+    """no keys have been loaded (yet)"""
+
+
+class UnknownKey(Exception):
+    """a kid that isn't in the key set"""
+
+
+class KeySet:
+    """
+    Keys (by kid) from a JWKS document at a "source", a file path or
+    an http(s) URL. Keys are (re)loaded in a background thread, every
+    "refresh_interval" seconds or sooner when asked for an unknown kid
+    (at most every "min_refresh_interval" seconds). While a reload is
+    pending, or if it fails, the keys loaded last are still used
+    ("stale while revalidate"), so looking up a key never waits on
+    loading keys: a kid not (yet) loaded is just unknown.
+
+    The thread is started on first use, so each (forked) process
+    starts its own.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        refresh_interval: float = 300.0,
+        min_refresh_interval: float = 30.0,
+        retry_interval: float = 10.0,
+        clock: Callable[[], float] = monotonic,
+    ):
+        self.source = source
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.retry_interval = retry_interval
+        self.clock = clock
+
+        self.keys: Optional[Dict[str, Tuple[PyJWK, str]]] = None  # kid -> (key, alg)
+        self.loaded_at: Optional[float] = None
+
+        self._client: Optional[HttpClient] = None
+        if source.startswith(("http://", "https://")):
+            self._client = HttpClient(source, pool_size=1)
+
+        self._wake = Event()
+        self._lock = Lock()
+        self._thread: Optional[Thread] = None
+
+    def get(self, kid: Optional[str]) -> Tuple[PyJWK, str]:
+        """the key (and its algorithm) for a kid; doesn't block"""
+        self.start()
+        keys = self.keys  # replaced (not changed) on reloads
+        if keys is None:
+            raise KeysUnavailable(f"No keys loaded from {self.source} yet")
+        try:
+            return keys[kid]
+        except KeyError:
+            self._wake.set()  # maybe the key was added, reload (soon)
+            raise UnknownKey(f"Unknown key {kid}") from None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self.run, name="jwks", daemon=True)
+                self._thread.start()
+
+    def run(self) -> None:
+        """reload keys, until the process ends"""
+        while True:
+            attempted = self.clock()
+            ok = self.reload()
+            woken = self._wake.wait(self.refresh_interval if ok else self.retry_interval)
+            self._wake.clear()
+            if woken:  # for an unknown kid, but don't reload too often
+                sleep(max(0.0, attempted + self.min_refresh_interval - self.clock()))
+
+    def reload(self) -> bool:
+        """(re)load keys, keeping the current keys on failure"""
+        try:
+            self.keys = parse_jwks(self.fetch())
+            self.loaded_at = self.clock()
+            logger.info(f"Loaded {len(self.keys)} keys from {self.source}")
+            return True
+        except Exception as err:
+            logger.error(f"Loading keys from {self.source} failed: {err.__class__.__name__} {err}")
+            return False
+
+    def fetch(self) -> Dict:
+        if self._client is not None:
+            response = self._client.get()
+            response.raise_for_status()
+            return response.json()
+        with open(self.source) as stream:
+            return load(stream)
+
+
+# non-class helpers
+
+
+def parse_jwks(jwks: Dict) -> Dict[str, Tuple[PyJWK, str]]:
+    """signing keys in a JWKS document, by kid, with their algorithm"""
+    keys = {}
+    for data in jwks.get("keys", []):
+        if data.get("use", "sig") != "sig" or "kid" not in data:
+            continue
+        kty = data.get("kty")
+        algorithm = data.get("alg") or DEFAULT_ALGORITHMS.get(
+            kty if kty == "RSA" else (kty, data.get("crv"))
+        )
+        try:
+            keys[data["kid"]] = (PyJWK(data, algorithm=algorithm), algorithm)
+        except PyJWKError as err:
+            logger.warning(f"Skipping key {data['kid']}: {err}")
+    return keys
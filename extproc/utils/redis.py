@@ -1,9 +1,12 @@
+from asyncio import Future, get_running_loop, Task
+from contextlib import asynccontextmanager
 from datetime import timedelta as td
 from logging import getLogger
 from os import environ
-from typing import Optional
+from typing import AsyncIterator, Dict, List, Optional, Union
 
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
 
 logger = getLogger(__name__)
 
@@ -11,18 +14,47 @@ logger = getLogger(__name__)
 Wrappers for redis commands.
 
 The format followed is _<redis-command>
+
+Values are stored and returned as (binary-safe) bytes.
 """
 
 REDIS_CACHE_HOST = environ.get("REDIS_CACHE_HOST", "redis")
 REDIS_CACHE_PORT = int(environ.get("REDIS_CACHE_PORT", "6379"))
 REDIS_CACHE_URL = (f"redis://{REDIS_CACHE_HOST}:{REDIS_CACHE_PORT}",)
 
+# the value of field ARGV[1] of hash KEYS[1] if set, else set it to ARGV[2]
+# (expiring the hash in ARGV[3] ms) and return nil; for a (plain) string
+# KEYS[1], its value
+HGET_OR_SETEX = """
+if redis.call("TYPE", KEYS[1]).ok == "string" then
+    return redis.call("GET", KEYS[1])
+end
+local value = redis.call("HGET", KEYS[1], ARGV[1])
+if value then
+    return value
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+redis.call("PEXPIRE", KEYS[1], ARGV[3])
+return false
+"""
+
+# delete hash KEYS[1] only if its field ARGV[1] is (still) ARGV[2]
+DELETE_IF_HEQUAL = """
+if redis.call("TYPE", KEYS[1]).ok == "hash" and redis.call("HGET", KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
 
 class RedisCache:
     def __init__(self):
-        self.client = Redis(REDIS_CACHE_HOST, REDIS_CACHE_PORT, db=0, decode_responses=True)
+        self.client = Redis(REDIS_CACHE_HOST, REDIS_CACHE_PORT, db=0)
+        # (server side) scripts, atomic and a single round trip (EVALSHA)
+        self._hget_or_setex = self.client.register_script(HGET_OR_SETEX)
+        self._delete_if_hequal = self.client.register_script(DELETE_IF_HEQUAL)
 
-    def setex(self, key: str, value: str = "", expiry: td = td(hours=24)) -> bool:
+    def setex(self, key: str, value: Union[str, bytes] = b"", expiry: td = td(hours=24)) -> bool:
         try:
             self.client.setex(key, expiry, value)
             return True
@@ -31,6 +63,61 @@ class RedisCache:
             logger.error(f"RedisCacheError: setex failed with {e}")
             return False
 
+    def hsetex(
+        self, key: str, fields: Dict[str, Union[str, bytes]], expiry: td = td(hours=24)
+    ) -> bool:
+        """replace hash key with fields, expiring (in one transaction)"""
+        try:
+            pipeline = self.client.pipeline(transaction=True)
+            pipeline.delete(key)
+            pipeline.hset(key, mapping=fields)
+            pipeline.expire(key, expiry)
+            pipeline.execute()
+            return True
+
+        except Exception as e:
+            logger.error(f"RedisCacheError: hsetex failed with {e}")
+            return False
+
+    def hget(self, key: str, field: str) -> Optional[bytes]:
+        try:
+            return self.client.hget(key, field)
+
+        except Exception as e:
+            logger.error(f"RedisCacheError: hget failed with {e}")
+            return None
+
+    def hget_or_setex(
+        self, key: str, field: str, value: Union[str, bytes], expiry: td = td(hours=24)
+    ) -> Optional[bytes]:
+        """the field of hash key, if set; otherwise set it (None) atomically"""
+        try:
+            return self._hget_or_setex(
+                keys=[key], args=[field, value, int(expiry.total_seconds() * 1000)]
+            )
+
+        except Exception as e:
+            logger.error(f"RedisCacheError: hget_or_setex failed with {e}")
+            return None
+
+    def delete_if_hequal(self, key: str, field: str, value: Union[str, bytes]) -> bool:
+        """delete hash key, only if its field is (still) set to value, atomically"""
+        try:
+            return self._delete_if_hequal(keys=[key], args=[field, value]) == 1
+
+        except Exception as e:
+            logger.error(f"RedisCacheError: delete_if_hequal failed with {e}")
+            return False
+
+    def publish(self, channel: str, message: Union[str, bytes] = b"") -> bool:
+        try:
+            self.client.publish(channel, message)
+            return True
+
+        except Exception as e:
+            logger.error(f"RedisCacheError: publish failed with {e}")
+            return False
+
     def exists(self, key: str) -> bool:
         try:
             return self.client.exists(key) == 1
@@ -39,7 +126,7 @@ class RedisCache:
             logger.error(f"RedisCacheError: exists failed with {e}")
             return False
 
-    def get(self, key: str) -> Optional[str]:
+    def get(self, key: str) -> Optional[bytes]:
         try:
             return self.client.get(key)
 
@@ -47,7 +134,7 @@ class RedisCache:
             logger.error(f"RedisCacheError: get failed with {e}")
             return None
 
-    def set(self, key: str, value: str) -> bool:
+    def set(self, key: str, value: Union[str, bytes]) -> bool:
         try:
             return self.client.set(key) == 1
 
@@ -61,3 +148,53 @@ class RedisCache:
 
         except Exception as e:
             logger.error(f"RedisCacheError: delete failed with {e}")
+
+
+class RedisChannels:
+    """
+    Waiting, on an asyncio event loop, for messages published to redis
+    channels. All the channels listened to share one pub/sub connection
+    (and one task reading it); a channel is subscribed to only while
+    something listens to it.
+    """
+
+    def __init__(self):
+        self.pubsub = AsyncRedis(host=REDIS_CACHE_HOST, port=REDIS_CACHE_PORT, db=0).pubsub()
+        self.listeners: Dict[bytes, List[Future]] = {}  # channel -> futures
+        self._reader: Optional[Task] = None
+
+    @asynccontextmanager
+    async def listen(self, channel: str) -> AsyncIterator[Future]:
+        """a future for (the data of) the next message on channel, once subscribed"""
+        loop = get_running_loop()
+        message = loop.create_future()
+        name = channel.encode()
+        listeners = self.listeners.setdefault(name, [])
+        listeners.append(message)
+        try:
+            if len(listeners) == 1:
+                await self.pubsub.subscribe(name)
+            if self._reader is None or self._reader.done():
+                self._reader = loop.create_task(self._read())
+            yield message
+        finally:
+            listeners.remove(message)
+            if not listeners:
+                del self.listeners[name]
+                try:
+                    await self.pubsub.unsubscribe(name)
+                except Exception as e:
+                    logger.error(f"RedisCacheError: unsubscribe failed with {e}")
+
+    async def _read(self) -> None:
+        """resolve the listeners of messages, until no channel is subscribed to"""
+        try:
+            async for message in self.pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                for listener in self.listeners.get(message["channel"], ()):
+                    if not listener.done():
+                        listener.set_result(message["data"])
+
+        except Exception as e:
+            logger.error(f"RedisCacheError: listen failed with {e}")
@@ -0,0 +1,87 @@
+from logging import getLogger
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Callable, Dict, Optional
+
+from .http import HttpClient
+
+logger = getLogger(__name__)
+
+"""
+Revoked API keys, polled from the auth service, so (cached) tokens of
+revoked keys are rejected before they expire.
+"""
+
+
+class RevocationSet:
+    """
+    Key ids revoked within the auth service's "window" (as long as its
+    tokens live, so keys revoked earlier have no valid tokens left), by
+    polling a "source" URL every "interval" seconds. Polls ask only for
+    revocations since the last poll's cursor; revocations older than the
+    window are dropped.
+
+    Checks are a dict lookup and never wait on polling: if a poll fails,
+    the revocations polled last are still used. The polling thread is
+    started on first use, so each (forked) process starts its own.
+    """
+
+    def __init__(self, source: str, interval: float = 2.0, clock: Callable[[], float] = time):
+        self.source = source
+        self.interval = interval
+        self.clock = clock
+
+        self.revoked: Dict[str, float] = {}  # key id -> revoked at
+        self.cursor: Optional[float] = None
+        self.window: Optional[float] = None
+
+        self._client = HttpClient(source, pool_size=1)
+        self._lock = Lock()
+        self._thread: Optional[Thread] = None
+
+    def __contains__(self, key_id: str) -> bool:
+        self.start()
+        return key_id in self.revoked
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self.run, name="revocations", daemon=True)
+                self._thread.start()
+
+    def run(self) -> None:
+        """poll, until the process ends"""
+        while True:
+            self.poll()
+            sleep(self.interval)
+
+    def poll(self) -> bool:
+        """add revocations since the last poll, keeping the current ones on failure"""
+        try:
+            params = {} if self.cursor is None else {"since": self.cursor}
+            response = self._client.get(params=params)
+            response.raise_for_status()
+            self.update(response.json())
+            return True
+        except Exception as err:
+            logger.error(f"Polling {self.source} failed: {err.__class__.__name__} {err}")
+            return False
+
+    def update(self, data: Dict) -> None:
+        revoked = self.revoked
+        added = {
+            r["key_id"]: r["revoked_at"] for r in data["revoked"] if r["key_id"] not in revoked
+        }
+        self.window = float(data["window"])
+        self.cursor = data["cursor"]
+
+        oldest = self.clock() - self.window
+        if any(revoked_at < oldest for revoked_at in revoked.values()):
+            self.revoked = {k: at for k, at in revoked.items() if at >= oldest}
+        self.revoked.update(added)
+        if added:
+            logger.info(
+                f"{len(added)} keys revoked, {len(self.revoked)} in the last {self.window}s"
+            )
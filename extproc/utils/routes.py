@@ -0,0 +1,104 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from re import Pattern
+from typing import Dict, List, Optional, Tuple
+
+"""
+Matching request paths to (templated) routes.
+"""
+
+PARAM_SEGMENT = ":"  # matches any one segment, e.g. /api/v0/keys/:
+REST_SEGMENT = "*"  # matches the rest of the path, e.g. /docs/*
+
+
+@dataclass(frozen=True)
+class Route:
+    template: str
+    public: bool = False  # no authentication needed
+    registered: bool = False  # added to the matcher, or just templated
+
+
+class RouteNode:
+    __slots__ = ("children", "route")
+
+    def __init__(self):
+        self.children: Dict[str, "RouteNode"] = {}
+        self.route: Optional[Route] = None
+
+
+class RouteMatcher:
+    """
+    A trie of route templates, by path segment. Templates are literal
+    segments, PARAM_SEGMENT (any one segment) and a final REST_SEGMENT
+    (any remaining segments), and literal segments match first.
+
+    Paths that don't match a (registered) route are templated instead,
+    replacing segments that match any of the "param_patterns" (like
+    UUIDs) with PARAM_SEGMENT, so that distinct paths map to a bounded
+    set of templates (e.g., for metrics or rate limits).
+
+    Matches are memoized (up to "cache_size" paths), so repeated paths
+    cost a dict lookup; otherwise matching is linear in the path length.
+    """
+
+    def __init__(self, param_patterns: List[Pattern], cache_size: int = 10000):
+        self.param_patterns = param_patterns
+        self.root = RouteNode()
+        self.matches = lru_cache(maxsize=cache_size)(self._match)  # by path, without query
+
+    def add(self, template: str, public: bool = False) -> Route:
+        node = self.root
+        for segment in split_path(template):
+            node = node.children.setdefault(segment, RouteNode())
+        node.route = Route(template=template, public=public, registered=True)
+        self.matches.cache_clear()
+        return node.route
+
+    def match(self, path: str) -> Route:
+        """
+        the route for a path; any query string is dropped first, so that
+        distinct queries don't each take a memoized match
+        """
+        return self.matches(path.split("?", 1)[0])
+
+    def _match(self, path: str) -> Route:
+        """the route for a path (without any query string)"""
+        segments = split_path(path)
+        route = find(self.root, segments, 0)
+        if route is not None:
+            return route
+        return Route(template=join_path(self.template_segment(s) for s in segments))
+
+    def template_segment(self, segment: str) -> str:
+        for pattern in self.param_patterns:
+            if pattern.fullmatch(segment):
+                return PARAM_SEGMENT
+        return segment
+
+
+# non-class helpers
+
+
+def split_path(path: str) -> Tuple[str, ...]:
+    """the (non-empty) segments of a path, ignoring any query string"""
+    return tuple(segment for segment in path.split("?", 1)[0].split("/") if segment)
+
+
+def join_path(segments) -> str:
+    return "/" + "/".join(segments)
+
+
+def find(node: RouteNode, segments: Tuple[str, ...], i: int) -> Optional[Route]:
+    if i == len(segments):
+        if node.route is not None:
+            return node.route
+        rest = node.children.get(REST_SEGMENT)
+        return None if rest is None else rest.route
+    for key in (segments[i], PARAM_SEGMENT):
+        child = node.children.get(key)
+        if child is not None:
+            route = find(child, segments, i + 1)
+            if route is not None:
+                return route
+    rest = node.children.get(REST_SEGMENT)
+    return None if rest is None else rest.route
@@ -0,0 +1,85 @@
+from json import load, loads
+from typing import Dict, Iterable, List, Tuple
+
+"""
+Token scopes (resource and action pairs) as bitmasks, so checking that
+a token has the scopes a route requires is an integer AND.
+"""
+
+ANY_METHOD = "*"
+
+# a "write" scope is a create, update and delete scope
+IMPLIED_ACTIONS = {"write": ("create", "update", "delete")}
+
+
+class ScopeBits:
+    """
+    A bit per (resource, action) scope. Bits are assigned to the scopes
+    routes require, when those are compiled (at startup); other scopes
+    (of tokens) don't matter to any check, and have no bit.
+    """
+
+    def __init__(self):
+        self.bits: Dict[Tuple[str, str], int] = {}
+
+    def required(self, scopes: Iterable[Tuple[str, str]]) -> int:
+        """the mask of scopes (adding bits for new ones)"""
+        mask = 0
+        for resource, action in expand(scopes):
+            bit = self.bits.get((resource, action))
+            if bit is None:
+                bit = self.bits[(resource, action)] = 1 << len(self.bits)
+            mask |= bit
+        return mask
+
+    def granted(self, scopes: Iterable[Tuple[str, str]]) -> int:
+        """the mask of scopes (ignoring ones without bits)"""
+        mask = 0
+        for scope in expand(scopes):
+            mask |= self.bits.get(scope, 0)
+        return mask
+
+
+# non-class helpers
+
+
+def expand(scopes: Iterable[Tuple[str, str]]) -> Iterable[Tuple[str, str]]:
+    for resource, action in scopes:
+        for implied in IMPLIED_ACTIONS.get(action, (action,)):
+            yield resource, implied
+
+
+def claims_scopes(claims: Dict) -> List[Tuple[str, str]]:
+    """the (resource, action) scopes in token claims"""
+    return [(scope["resource"], scope["action"]) for scope in claims.get("scopes") or []]
+
+
+def parse_scope(scope: str) -> Tuple[str, str]:
+    """a "resource:action" scope"""
+    resource, _, action = scope.rpartition(":")
+    if not resource or not action:
+        raise ValueError(f"Malformed scope {scope!r}, expected resource:action")
+    return resource, action
+
+
+def load_route_scopes(source: str) -> Dict[str, Dict[str, List[Tuple[str, str]]]]:
+    """
+    the scopes routes require, by route template and method (or ANY_METHOD),
+    from inline JSON or a JSON file, e.g.,
+
+        {"/api/v0/keys/:": {"GET": ["keys:read"], "DELETE": ["keys:delete"]}}
+    """
+    if not source:
+        return {}
+    if source.lstrip().startswith("{"):
+        document = loads(source)
+    else:
+        with open(source) as stream:
+            document = load(stream)
+    return {
+        template: {
+            method.upper(): [parse_scope(scope) for scope in scopes]
+            for method, scopes in methods.items()
+        }
+        for template, methods in document.items()
+    }
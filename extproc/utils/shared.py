@@ -0,0 +1,145 @@
+import fcntl
+from hashlib import blake2b
+import mmap
+import os
+from struct import Struct
+from threading import Lock
+from time import time
+from typing import Callable, Dict, Optional, Tuple
+
+"""
+A cache shared by the (forked) server processes on a host, in a
+memory-mapped file (e.g., under /dev/shm).
+"""
+
+# file header: magic, slots, slot size, a random secret shared by the processes
+HEADER = Struct("<8sII32s")
+MAGIC = b"extproc1"
+
+# slot header: sequence (odd while written), key, expires at, value length
+SLOT = Struct("<Q32sdI")
+SEQUENCE = Struct("<Q")
+
+PROBES = 4  # slots a key can be in
+READ_RETRIES = 3  # times a read is retried while the slot is being written
+
+
+class SharedCache:
+    """
+    A fixed size hash table of "slots" slots, each holding a (32 byte)
+    key and a value of up to "slot_size" (less a slot header) bytes until
+    an (epoch) expiry, in a file mapped into each process using it.
+
+    A key can be in any of PROBES (adjacent) slots; writes replace the
+    key's slot, else an empty or expired slot, else the slot expiring
+    first. Writers lock the slots (across processes, with a file lock, and
+    threads); reads don't lock: slots have a sequence number, odd while
+    written, and a read that sees it change (or odd) is retried, or a
+    miss. Counts hits and misses (of this process).
+
+    The file is "path" with the settings appended (e.g., path-16384x2048),
+    so that processes with other settings use another file: a file mapped
+    by other processes is never resized. It is initialized if missing (or
+    empty), and a file that isn't a cache with these settings is refused.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        slots: int = 16384,
+        slot_size: int = 2048,
+        clock: Callable[[], float] = time,
+    ):
+        if slots < PROBES or slot_size <= SLOT.size:
+            raise ValueError(f"At least {PROBES} slots of more than {SLOT.size} bytes needed")
+        self.path = f"{path}-{slots}x{slot_size}"
+        self.slots = slots
+        self.slot_size = slot_size
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+
+        size = HEADER.size + slots * slot_size
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size == 0:  # new: grown with zeroes, empty slots
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, HEADER.pack(MAGIC, slots, slot_size, os.urandom(32)), 0)
+            header = os.pread(self._fd, HEADER.size, 0)
+            settings = (MAGIC, slots, slot_size)
+            valid = os.fstat(self._fd).st_size == size and HEADER.unpack(header)[:3] == settings
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        if not valid:  # (maybe) mapped by other processes, so never truncated
+            os.close(self._fd)
+            raise ValueError(f"{self.path} is not a shared cache of {slots}x{slot_size}")
+        self.secret: bytes = HEADER.unpack(header)[3]
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = Lock()  # file locks don't exclude threads of a process
+
+    def get(self, key: bytes) -> Optional[Tuple[bytes, float]]:
+        """the value for a key, and when it expires, if present and not expired"""
+        for offset in self._offsets(key):
+            entry = self._read(offset, key)
+            if entry is not None:
+                if entry[1] > self.clock():
+                    self.hits += 1
+                    return entry
+                break
+        self.misses += 1
+        return None
+
+    def set(self, key: bytes, value: bytes, expires_at: float) -> bool:
+        """store a value for a key until expires_at (False if it doesn't fit)"""
+        if len(value) > self.slot_size - SLOT.size or expires_at <= self.clock():
+            return False
+        offsets = self._offsets(key)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, PROBES * self.slot_size, offsets[0])
+            try:
+                offset = self._victim(offsets, key)
+                sequence = SEQUENCE.unpack_from(self._map, offset)[0] | 1  # odd: writing
+                SEQUENCE.pack_into(self._map, offset, sequence)
+                SLOT.pack_into(self._map, offset, sequence, key, expires_at, len(value))
+                start = offset + SLOT.size
+                self._map[start : start + len(value)] = value
+                SEQUENCE.pack_into(self._map, offset, sequence + 1)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, PROBES * self.slot_size, offsets[0])
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "slots": self.slots}
+
+    def close(self) -> None:
+        self._map.close()
+        os.close(self._fd)
+
+    def _offsets(self, key: bytes) -> Tuple[int, ...]:
+        """the (adjacent) slots for a key, so writers lock one range"""
+        first = int.from_bytes(blake2b(key, digest_size=8).digest(), "little")
+        first %= self.slots - PROBES + 1
+        return tuple(HEADER.size + (first + i) * self.slot_size for i in range(PROBES))
+
+    def _read(self, offset: int, key: bytes) -> Optional[Tuple[bytes, float]]:
+        """a slot's value and expiry, if it holds the key (and isn't being written)"""
+        for _ in range(READ_RETRIES):
+            sequence, slot_key, expires_at, length = SLOT.unpack_from(self._map, offset)
+            if sequence & 1:
+                continue
+            if slot_key != key:
+                return None
+            start = offset + SLOT.size
+            value = self._map[start : start + min(length, self.slot_size - SLOT.size)]
+            if SEQUENCE.unpack_from(self._map, offset)[0] == sequence:
+                return value, expires_at
+        return None
+
+    def _victim(self, offsets: Tuple[int, ...], key: bytes) -> int:
+        """the slot to write a key to"""
+        slots = [(offset, *SLOT.unpack_from(self._map, offset)[1:3]) for offset in offsets]
+        for offset, slot_key, _ in slots:
+            if slot_key == key:
+                return offset
+        return min(slots, key=lambda slot: slot[2])[0]  # empty, expired or expiring first
@@ -0,0 +1,95 @@
+"""
+Microbenchmark for per-phase overhead in BaseExternalProcessorService:
+looking up the "process_..." method, timing it, and wrapping/serializing
+its response.
+
+    PYTHONPATH=generated/python/standardproto/ python -m tests.benchmarks.dispatch
+
+"legacy" reproduces the original Process loop (f-string method name,
+getattr twice, protobuf Timer, freshly constructed "move on" responses
+wrapped and serialized every time), "current" is Process as it is now
+(dispatch table, perf_counter_ns, pre-encoded "move on" responses).
+"""
+
+from logging import getLogger
+from timeit import repeat
+from typing import Iterator
+
+from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
+
+from extproc.processors import BaseExternalProcessorService
+from extproc.processors.base import serialize_response
+from extproc.utils.timing import Timer
+
+logger = getLogger(__name__)
+
+NUMBER = 20_000
+
+REQUESTS = {
+    "request_headers": ext_api.ProcessingRequest(request_headers=ext_api.HttpHeaders()),
+    "request_body": ext_api.ProcessingRequest(request_body=ext_api.HttpBody(body=b"{}")),
+    "response_headers": ext_api.ProcessingRequest(response_headers=ext_api.HttpHeaders()),
+    "response_body": ext_api.ProcessingRequest(response_body=ext_api.HttpBody(body=b"{}")),
+}
+
+
+class LegacyService(BaseExternalProcessorService):
+    """the original loop and "move on" responses"""
+
+    override_processing_mode = False
+
+    def Process(self, request_iterator, context) -> Iterator[ext_api.ProcessingResponse]:
+        callctx = {"__overhead_ns": 0}
+        for request in request_iterator:
+            phase_name = request.WhichOneof("request")
+            action_name = f"process_{phase_name}"
+            action = getattr(self, action_name)
+            phase_data = getattr(request, phase_name)
+            logger.debug(f"{self.__class__.__name__} started {phase_name}")
+            T = Timer()
+            with T:
+                response = action(phase_data, context, callctx)
+            duration = T.duration.ToNanoseconds()
+            callctx["__overhead_ns"] += duration
+            logger.debug(
+                f"{self.__class__.__name__} finished {phase_name} ({duration*1e-9} seconds)"
+            )
+            yield ext_api.ProcessingResponse(**{phase_name: response})
+
+    def just_continue_response(self) -> ext_api.CommonResponse:
+        return ext_api.CommonResponse(
+            status=ext_api.CommonResponse.ResponseStatus.CONTINUE,
+            header_mutation=ext_api.HeaderMutation(
+                set_headers=[],
+                remove_headers=[],
+            ),
+        )
+
+    def just_continue_headers(self) -> ext_api.HeadersResponse:
+        return ext_api.HeadersResponse(response=self.just_continue_response())
+
+    def just_continue_body(self) -> ext_api.BodyResponse:
+        return ext_api.BodyResponse(response=self.just_continue_response())
+
+
+def stream(p: BaseExternalProcessorService, request: ext_api.ProcessingRequest) -> None:
+    for response in p.Process(iter((request,)), None):
+        serialize_response(response)
+
+
+def best_ns(p: BaseExternalProcessorService, request: ext_api.ProcessingRequest) -> float:
+    return min(repeat(lambda: stream(p, request), number=NUMBER, repeat=5)) / NUMBER * 1e9
+
+
+def main() -> None:
+    legacy, current = LegacyService(), BaseExternalProcessorService()
+
+    # per phase, for a single-phase stream answered with "move on"
+    print(f"{'phase':<18}{'legacy (ns)':>14}{'current (ns)':>14}{'saved':>8}")
+    for phase_name, request in REQUESTS.items():
+        before, after = best_ns(legacy, request), best_ns(current, request)
+        print(f"{phase_name:<18}{before:>14.0f}{after:>14.0f}{1 - after / before:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
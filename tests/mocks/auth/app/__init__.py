@@ -1,13 +1,37 @@
+from datetime import datetime as dt
+from datetime import timedelta as td
+from datetime import timezone as tz
+from os import environ
+from typing import Optional
 from uuid import UUID, uuid4
 
 from fastapi import Depends, FastAPI
 
 from .auth import authenticate, authorize
-from .crud import create_key_in_db, delete_key_in_db, get_db, get_key_in_db
+from .crud import (
+    create_key_in_db,
+    delete_key_in_db,
+    get_db,
+    get_key_in_db,
+    get_revocations_in_db,
+    now,
+)
 from .errors import Forbidden
 from .logs import *  # noqa: F403, E402, F401
-from .models import APIKeyModel, APIKeyModelCreated, TokenCreated, TokenScope
-from .tokens import encode
+from .models import (
+    APIKeyModel,
+    APIKeyModelCreated,
+    Revocations,
+    TokenCreated,
+    TokenScope,
+)
+from .tokens import encode, TOKEN_TTL
+
+# tokens of keys revoked earlier have expired, no need to list those
+REVOCATION_WINDOW = int(environ.get("REVOCATION_WINDOW", str(TOKEN_TTL + 60)))
+
+# revoked_at is set before the commit, so revocations can show up late
+REVOCATION_OVERLAP = int(environ.get("REVOCATION_OVERLAP", "5"))
 
 app = FastAPI()
 
@@ -31,6 +55,23 @@ async def rootkey(db=Depends(get_db)) -> None:
     return {"secret": secret, **record.__dict__}
 
 
+@app.get("/revocations", response_model=Revocations)
+async def revocations(since: Optional[float] = None, db=Depends(get_db)) -> None:
+    """keys revoked (within the window) since a cursor, for gateways to poll"""
+    cursor = now()
+    start = cursor - td(seconds=REVOCATION_WINDOW)
+    if since is not None:
+        start = max(start, dt.fromtimestamp(since - REVOCATION_OVERLAP, tz.utc))
+    return {
+        "cursor": cursor.timestamp(),
+        "window": REVOCATION_WINDOW,
+        "revoked": [
+            {"key_id": record.key_id, "revoked_at": record.revoked_at.timestamp()}
+            for record in get_revocations_in_db(db, start)
+        ],
+    }
+
+
 @app.get("/api/v0/tokens", response_model=TokenCreated)
 async def create_token(authctx=Depends(authenticate)) -> None:
     return {"token": encode(identity=authctx.identity, scopes=authctx.scopes)}
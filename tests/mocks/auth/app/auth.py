@@ -6,7 +6,7 @@ from fastapi import Header
 
 from .crud import compute_hmac, get_db, get_key_in_db
 from .errors import Forbidden, NotFound, Unauthorized
-from .models import IdentityAndScope, TokenIdentity, TokenScope
+from .models import APIKeyStatus, IdentityAndScope, TokenIdentity, TokenScope
 from .tokens import verify
 
 
@@ -73,6 +73,8 @@ def authenticate_with_api_key(identity: str, secret: str) -> IdentityAndScope:
             key = get_key_in_db(db, _id)
         except NotFound:
             raise Unauthorized()
+        if key.status == APIKeyStatus.REVOKED:
+            raise Unauthorized()
         _st = b64decode(key.salt.encode())
         hmac, _ = compute_hmac(_id.bytes, _pk, salt=_st)
         hmac = b64encode(hmac).decode()
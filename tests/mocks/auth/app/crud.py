@@ -3,7 +3,7 @@ from datetime import datetime as dt
 from datetime import timezone as tz
 from hashlib import pbkdf2_hmac
 from os import environ, urandom
-from typing import Tuple
+from typing import List, Tuple
 from uuid import UUID, uuid4
 
 from sqlalchemy import Column, create_engine
@@ -101,6 +101,10 @@ def get_key_in_db(db: Session, _id: UUID) -> APIKeyRecord:
     return result
 
 
+def get_revocations_in_db(db: Session, since: dt) -> List[APIKeyRecord]:
+    return db.query(APIKeyRecord).filter(APIKeyRecord.revoked_at > since).all()
+
+
 def delete_key_in_db(db: Session, _id: UUID, hard: bool = False) -> APIKeyRecord:
     key = get_key_in_db(db, _id)
     if hard:
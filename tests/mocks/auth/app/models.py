@@ -51,6 +51,17 @@ class APIKeyStatus(str, Enum):
     REVOKED = "revoked"
 
 
+class Revocation(BaseModel):
+    key_id: UUID
+    revoked_at: float  # epoch seconds
+
+
+class Revocations(BaseModel):
+    cursor: float  # pass as "since" for revocations after these
+    window: int  # seconds revocations are listed for
+    revoked: List[Revocation]
+
+
 class APIKeyModel(BaseModel):
     tenant: Optional[UUID] = None
     user_id: Optional[str] = None
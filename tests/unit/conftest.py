@@ -1,15 +1,26 @@
+from asyncio import get_running_loop
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from datetime import datetime as dt
 from datetime import timedelta as td
-from typing import Optional
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Union,
+)
 
+from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
 import pytest  # noqa: F401
 
 
 @dataclass
 class StoredString:
     upd: dt
-    val: str
+    val: Union[bytes, Dict[str, bytes]]
     ttl: Optional[td] = None
     exp: Optional[dt] = None
 
@@ -17,23 +28,55 @@ class StoredString:
 class FakeRedisCache:
     def __init__(self):
         self.store = {}
+        self.subscribers: Dict[str, List[Callable]] = {}  # channel -> callbacks
 
     def __call__(self):
         """this is so we can "pretend" to instantiate"""
         return self
 
-    def set(self, key: str, value: str) -> bool:
+    def set(self, key: str, value: bytes) -> bool:
         self.store[key] = StoredString(upd=dt.now(), val=value)
         return True
 
-    def setex(self, key: str, value: str = "", expiry: td = td(hours=24)) -> bool:
+    def setex(self, key: str, value: bytes = b"", expiry: td = td(hours=24)) -> bool:
         self.store[key] = StoredString(upd=dt.now(), val=value, ttl=expiry, exp=dt.now() + expiry)
         return True
 
+    def hsetex(self, key: str, fields: Dict[str, bytes], expiry: td = td(hours=24)) -> bool:
+        self.store[key] = StoredString(
+            upd=dt.now(), val=dict(fields), ttl=expiry, exp=dt.now() + expiry
+        )
+        return True
+
+    def hget(self, key: str, field: str) -> Optional[bytes]:
+        data = self._get(key)
+        if data is None:
+            return None
+        return data.val.get(field)
+
+    def hget_or_setex(
+        self, key: str, field: str, value: bytes, expiry: td = td(hours=24)
+    ) -> Optional[bytes]:
+        current = self.hget(key, field)
+        if current is None:
+            self.hsetex(key, {field: value}, expiry)
+        return current
+
+    def delete_if_hequal(self, key: str, field: str, value: bytes) -> bool:
+        if self.hget(key, field) != value:
+            return False
+        self.delete(key)
+        return True
+
+    def publish(self, channel: str, message: bytes = b"") -> bool:
+        for subscriber in list(self.subscribers.get(channel, ())):
+            subscriber(message)
+        return True
+
     def exists(self, key: str) -> bool:
         return key in self.store
 
-    def get(self, key: str) -> Optional[str]:
+    def get(self, key: str) -> Optional[bytes]:
         data = self._get(key)
         if data is None:
             return None
@@ -52,3 +95,42 @@ class FakeRedisCache:
     def delete(self, key: str) -> None:
         if key in self.store:
             del self.store[key]
+
+
+class FakeRedisChannels:
+    """listening to what a FakeRedisCache publishes"""
+
+    def __init__(self, cache: FakeRedisCache):
+        self.cache = cache
+
+    def __call__(self):
+        return self
+
+    @asynccontextmanager
+    async def listen(self, channel: str) -> AsyncIterator:
+        loop = get_running_loop()
+        message = loop.create_future()
+
+        def deliver(data: bytes) -> None:
+            loop.call_soon_threadsafe(lambda: message.done() or message.set_result(data))
+
+        subscribers = self.cache.subscribers.setdefault(channel, [])
+        subscribers.append(deliver)
+        try:
+            yield message
+        finally:
+            subscribers.remove(deliver)
+
+
+def parse_responses(
+    responses: Iterable[Union[bytes, ext_api.ProcessingResponse]],
+) -> List[ext_api.ProcessingResponse]:
+    """Process yields pre-encoded bytes for unmodified responses"""
+    return [
+        ext_api.ProcessingResponse.FromString(r) if isinstance(r, bytes) else r for r in responses
+    ]
+
+
+async def async_iterate(requests: Iterable) -> AsyncIterator:
+    for request in requests:
+        yield request
@@ -0,0 +1,448 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from threading import Event
+from time import sleep, time
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from envoy.config.core.v3.base_pb2 import HeaderMap as EnvoyHeaderMap
+from envoy.config.core.v3.base_pb2 import HeaderValue as EnvoyHeaderValue
+from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
+from envoy.type.v3.http_status_pb2 import StatusCode
+from gateway.identity.v1.identity_pb2 import Identity
+import jwt
+import pytest
+
+from extproc.processors import authn, AuthnExternalProcessorService
+from extproc.utils.headers import HeaderView
+from extproc.utils.http import CircuitOpen
+from extproc.utils.identity import LEGACY_HEADERS
+from extproc.utils.revocations import RevocationSet
+
+
+def make_token(ttl: int = 300, claims: Optional[Dict] = None) -> str:
+    now = int(time())
+    return jwt.encode(
+        {
+            "exp": now + ttl,
+            "nbf": now,
+            "iat": now,
+            "iss": authn.TOKEN_ISSUER,
+            "aud": authn.TOKEN_AUDIENCE,
+            "identity": {"tenant": str(uuid4()), "user_id": str(uuid4()), "key_id": None},
+            **(claims or {}),
+        },
+        authn.TOKEN_PRIVATE_KEY,
+        algorithm="HS256",
+    )
+
+
+def bearer_headers(token: str, path: str = "/api/v0/resource") -> ext_api.HttpHeaders:
+    return ext_api.HttpHeaders(
+        headers=EnvoyHeaderMap(
+            headers=[
+                EnvoyHeaderValue(key=":method", value="GET"),
+                EnvoyHeaderValue(key=":path", value=path),
+                EnvoyHeaderValue(key="authorization", value=f"Bearer {token}"),
+            ]
+        )
+    )
+
+
+def set_headers(response: ext_api.HeadersResponse) -> Dict[str, str]:
+    return {o.header.key: o.header.value for o in response.response.header_mutation.set_headers}
+
+
+def header_identity(response: ext_api.HeadersResponse) -> Identity:
+    return Identity.FromString(urlsafe_b64decode(set_headers(response)["X-Gateway-Identity"]))
+
+
+def token_identity(token: str) -> Identity:
+    claims = jwt.decode(token, options={"verify_signature": False})
+    return Identity(
+        tenant=claims["identity"]["tenant"],
+        user_id=claims["identity"]["user_id"],
+        key_id=claims["identity"]["key_id"] or "",
+        expires=claims["exp"],
+    )
+
+
+def test_verified_tokens_are_cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = []
+    verify = authn.verify_token
+    monkeypatch.setattr(authn, "verify_token", lambda token: calls.append(token) or verify(token))
+
+    p = AuthnExternalProcessorService()
+    token = make_token()
+    for _ in range(3):
+        response = p.process_request_headers(bearer_headers(token), None, p.new_call_context())
+        assert isinstance(response, ext_api.HeadersResponse)
+
+    assert len(calls) == 1
+    assert (p.tokens.hits, p.tokens.misses) == (2, 1)
+
+    # the (cached) encoded identity is the token's
+    assert header_identity(response) == token_identity(token)
+
+
+def test_cached_tokens_expire() -> None:
+    p = AuthnExternalProcessorService()
+    token = make_token(ttl=60)
+    p.verify_token(token)
+    key = sha256(token.encode()).digest()
+    assert p.tokens.expires_at(key) == pytest.approx(time() + 60, abs=2)
+
+    # "later"
+    p.tokens.clock = lambda: time() + 120
+    assert p.tokens.get(key) is None
+
+
+def test_invalid_tokens_are_not_cached() -> None:
+    p = AuthnExternalProcessorService()
+    token = make_token(ttl=-10)  # expired
+    for _ in range(2):
+        response = p.process_request_headers(bearer_headers(token), None, p.new_call_context())
+        assert isinstance(response, ext_api.ImmediateResponse)
+        assert response.status.code == StatusCode.Unauthorized
+    assert len(p.tokens) == 0
+
+
+def basic_headers(identity: str, secret: str) -> ext_api.HttpHeaders:
+    basic = urlsafe_b64encode(f"{identity}:{secret}".encode()).decode()
+    return ext_api.HttpHeaders(
+        headers=EnvoyHeaderMap(
+            headers=[
+                EnvoyHeaderValue(key=":method", value="GET"),
+                EnvoyHeaderValue(key=":path", value="/api/v0/resource"),
+                EnvoyHeaderValue(key="authorization", value=f"Basic {basic}"),
+            ]
+        )
+    )
+
+
+def test_basic_auth_exchanges_are_cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = []
+
+    def verify_basic_auth(identity: str, secret: str) -> str:
+        calls.append(identity)
+        return make_token(ttl=300)
+
+    monkeypatch.setattr(authn, "verify_basic_auth", verify_basic_auth)
+
+    p = AuthnExternalProcessorService()
+    identity, secret = str(uuid4()), "secret-" + str(uuid4())
+    for _ in range(3):
+        response = p.process_request_headers(
+            basic_headers(identity, secret), None, p.new_call_context()
+        )
+        assert isinstance(response, ext_api.HeadersResponse)
+    assert len(calls) == 1
+
+    # cached by a digest of the secret, not the secret
+    ((key_id, digest),) = p.exchanges._entries.keys()
+    assert key_id == identity and secret.encode() not in digest
+
+    # a different secret for the same key id isn't a hit
+    p.exchange_basic_auth(identity, "other")
+    assert len(calls) == 2
+
+
+def test_basic_auth_exchanges_refresh_ahead(monkeypatch: pytest.MonkeyPatch) -> None:
+    tokens = []
+
+    def verify_basic_auth(identity: str, secret: str) -> str:
+        tokens.append(make_token(ttl=300, claims={"jti": str(len(tokens))}))
+        return tokens[-1]
+
+    monkeypatch.setattr(authn, "verify_basic_auth", verify_basic_auth)
+
+    p = AuthnExternalProcessorService()
+    identity = str(uuid4())
+    first = p.exchange_basic_auth(identity, "secret")
+
+    # close to expiring: still used, but refreshed in the background
+    p.exchanges.clock = lambda: time() + 300 - authn.TOKEN_REFRESH_AHEAD
+    assert p.exchange_basic_auth(identity, "secret") == first
+    p._refresher.shutdown(wait=True)
+    assert len(tokens) == 2
+    p.exchanges.clock = time
+    assert p.exchange_basic_auth(identity, "secret") == tokens[1]
+
+
+def test_basic_auth_requires_credentials() -> None:
+    p = AuthnExternalProcessorService()
+    with pytest.raises(authn.NoCredentials):
+        p.exchange_basic_auth(None, "secret")
+    with pytest.raises(authn.MalformedCredentials):
+        p.exchange_basic_auth("not-a-uuid", "secret")
+
+
+def test_auth_service_unavailable(monkeypatch: pytest.MonkeyPatch) -> None:
+    def verify_basic_auth(identity: str, secret: str) -> str:
+        raise CircuitOpen(3.2)
+
+    monkeypatch.setattr(authn, "verify_basic_auth", verify_basic_auth)
+
+    p = AuthnExternalProcessorService()
+    response = p.process_request_headers(
+        basic_headers(str(uuid4()), "secret"), None, p.new_call_context()
+    )
+    assert isinstance(response, ext_api.ImmediateResponse)
+    assert response.status.code == StatusCode.ServiceUnavailable
+    assert response.headers.set_headers[0].header.key == "Retry-After"
+    assert response.headers.set_headers[0].header.value == "3"
+
+
+def test_concurrent_basic_auth_lookups_are_coalesced(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls, release = [], Event()
+
+    def verify_basic_auth(identity: str, secret: str) -> str:
+        calls.append(identity)
+        release.wait(5)
+        return make_token()
+
+    monkeypatch.setattr(authn, "verify_basic_auth", verify_basic_auth)
+
+    p = AuthnExternalProcessorService()
+    identity = str(uuid4())
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(p.exchange_basic_auth, identity, "secret") for _ in range(8)]
+        while p.flights.shared < 7:
+            sleep(0.001)
+        release.set()
+        assert len({f.result() for f in futures}) == 1
+    assert len(calls) == 1
+
+
+def test_whitelisted_routes_skip_authentication(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(authn, "verify_token", lambda token: pytest.fail("authenticated"))
+
+    p = AuthnExternalProcessorService()
+    callctx = p.new_call_context()
+    headers = ext_api.HttpHeaders(
+        headers=EnvoyHeaderMap(headers=[EnvoyHeaderValue(key=":path", value="/health?full=1")])
+    )
+    response = p.process_request_headers(headers, None, callctx)
+    assert isinstance(response, ext_api.HeadersResponse)
+    assert set_headers(response)["X-Gateway-Endpoint"] == "/health"
+    assert set(response.response.header_mutation.remove_headers) == {
+        "x-gateway-identity",
+        *LEGACY_HEADERS,
+    }
+    assert callctx.route.public
+
+
+@pytest.mark.parametrize("path", ["/health", "/api/v0/resource"])
+def test_spoofed_identity_headers_are_removed(path: str) -> None:
+    p = AuthnExternalProcessorService()
+    headers = bearer_headers(make_token(), path=path)
+    headers.headers.headers.append(EnvoyHeaderValue(key="x-gateway-tenant", value="victim"))
+    callctx = p.new_call_context()
+
+    response = p.process_request_headers(headers, None, callctx)
+    assert "x-gateway-tenant" in response.response.header_mutation.remove_headers
+    assert "X-Gateway-Tenant" not in set_headers(response)
+    assert p.identity(callctx).tenant != "victim"
+
+
+def test_endpoints_are_templated() -> None:
+    p = AuthnExternalProcessorService()
+    key_id = str(uuid4())
+    response = p.process_request_headers(
+        bearer_headers(make_token(), path=f"/api/v0/keys/{key_id}?all=true"),
+        None,
+        p.new_call_context(),
+    )
+    assert isinstance(response, ext_api.HeadersResponse)
+    assert set_headers(response)["X-Gateway-Endpoint"] == "/api/v0/keys/:"
+    assert "X-Gateway-Identity" in set_headers(response)
+
+
+@pytest.mark.parametrize(
+    "method,scopes,status",
+    [
+        ("GET", [{"resource": "keys", "action": "read"}], None),
+        ("GET", [{"resource": "tokens", "action": "read"}], StatusCode.Forbidden),
+        ("GET", [], StatusCode.Forbidden),
+        ("DELETE", [{"resource": "keys", "action": "read"}], StatusCode.Forbidden),
+        ("DELETE", [{"resource": "keys", "action": "write"}], None),
+        ("POST", [], None),  # no scopes required
+    ],
+)
+def test_route_scopes_are_required(
+    monkeypatch: pytest.MonkeyPatch, method: str, scopes: List[Dict], status: Optional[int]
+) -> None:
+    monkeypatch.setattr(
+        authn,
+        "ROUTE_SCOPES",
+        '{"/api/v0/keys/:": {"GET": ["keys:read"], "DELETE": ["keys:delete"]}}',
+    )
+    p = AuthnExternalProcessorService()
+    headers = bearer_headers(make_token(claims={"scopes": scopes}), path=f"/api/v0/keys/{uuid4()}")
+    headers.headers.headers[0].value = method
+
+    response = p.process_request_headers(headers, None, p.new_call_context())
+    if status is None:
+        assert isinstance(response, ext_api.HeadersResponse)
+    else:
+        assert isinstance(response, ext_api.ImmediateResponse)
+        assert response.status.code == status
+
+
+def test_rejected_api_keys_are_cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = []
+
+    def verify_basic_auth(identity: str, secret: str) -> str:
+        calls.append(identity)
+        raise authn.Unauthenticated("Invalid secret")
+
+    monkeypatch.setattr(authn, "verify_basic_auth", verify_basic_auth)
+
+    p = AuthnExternalProcessorService()
+    identity = str(uuid4())
+    for _ in range(3):
+        response = p.process_request_headers(
+            basic_headers(identity, "wrong"), None, p.new_call_context()
+        )
+        assert response.status.code == StatusCode.Unauthorized
+    assert len(calls) == 1
+
+    # another secret is another key
+    p.process_request_headers(basic_headers(identity, "other"), None, p.new_call_context())
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("per", ["key", "client"])
+def test_failures_are_throttled(monkeypatch: pytest.MonkeyPatch, per: str) -> None:
+    calls = []
+
+    def verify_basic_auth(identity: str, secret: str) -> str:
+        calls.append(identity)
+        raise authn.Unauthenticated("Invalid secret")
+
+    monkeypatch.setattr(authn, "verify_basic_auth", verify_basic_auth)
+    monkeypatch.setattr(authn, "AUTH_KEY_FAILURE_LIMIT", 3 if per == "key" else 0)
+    monkeypatch.setattr(authn, "AUTH_CLIENT_FAILURE_LIMIT", 3 if per == "client" else 0)
+
+    p = AuthnExternalProcessorService()
+    identity = str(uuid4())
+
+    def attempt(secret: str) -> ext_api.ImmediateResponse:
+        headers = basic_headers(identity if per == "key" else str(uuid4()), secret)
+        headers.headers.headers.append(
+            EnvoyHeaderValue(key="x-forwarded-for", value="203.0.113.7, 10.0.0.1")
+        )
+        return p.process_request_headers(headers, None, p.new_call_context())
+
+    statuses = [attempt(f"secret-{i}").status.code for i in range(5)]
+    assert statuses == [StatusCode.Unauthorized] * 3 + [StatusCode.TooManyRequests] * 2
+    assert len(calls) == 3
+
+    response = attempt("secret-5")
+    assert response.headers.set_headers[0].header.key == "Retry-After"
+    assert 1 <= int(response.headers.set_headers[0].header.value) <= authn.AUTH_FAILURE_WINDOW
+
+
+@pytest.mark.parametrize(
+    "values,trusted_hops,client",
+    [
+        ({}, 0, None),
+        ({"x-forwarded-for": "203.0.113.7, 10.0.0.1"}, 0, "10.0.0.1"),
+        ({"x-forwarded-for": "203.0.113.7, 10.0.0.1"}, 1, "203.0.113.7"),
+        ({"x-forwarded-for": "10.0.0.1"}, 1, None),
+        ({"x-forwarded-for": "203.0.113.7", "x-envoy-external-address": "10.0.0.2"}, 0, "10.0.0.2"),
+    ],
+)
+def test_clients_are_the_addresses_envoy_trusts(
+    monkeypatch: pytest.MonkeyPatch, values: Dict[str, str], trusted_hops: int, client: str
+) -> None:
+    monkeypatch.setattr(authn, "AUTH_XFF_TRUSTED_HOPS", trusted_hops)
+    headers = ext_api.HttpHeaders(
+        headers=EnvoyHeaderMap(
+            headers=[EnvoyHeaderValue(key=k, value=v) for k, v in values.items()]
+        )
+    )
+    assert authn.client_address(HeaderView(headers)) == client
+
+
+@pytest.mark.parametrize("per", ["key", "client"])
+def test_failures_dont_throttle_cached_credentials(
+    monkeypatch: pytest.MonkeyPatch, per: str
+) -> None:
+    def verify_basic_auth(identity: str, secret: str) -> str:
+        if secret != "right":
+            raise authn.Unauthenticated("Invalid secret")
+        return make_token(ttl=300)
+
+    monkeypatch.setattr(authn, "verify_basic_auth", verify_basic_auth)
+    monkeypatch.setattr(authn, "AUTH_KEY_FAILURE_LIMIT", 3 if per == "key" else 0)
+    monkeypatch.setattr(authn, "AUTH_CLIENT_FAILURE_LIMIT", 3 if per == "client" else 0)
+
+    p = AuthnExternalProcessorService()
+    identity = str(uuid4())
+    token = make_token(ttl=300)
+
+    def attempt(headers: ext_api.HttpHeaders) -> ext_api.ProcessingResponse:
+        # all from the same address, e.g. behind a load balancer
+        headers.headers.headers.append(EnvoyHeaderValue(key="x-forwarded-for", value="10.0.0.1"))
+        return p.process_request_headers(headers, None, p.new_call_context())
+
+    assert isinstance(attempt(basic_headers(identity, "right")), ext_api.HeadersResponse)
+    statuses = [
+        attempt(basic_headers(identity if per == "key" else str(uuid4()), f"wrong-{i}")).status.code
+        for i in range(5)
+    ]
+    assert statuses == [StatusCode.Unauthorized] * 3 + [StatusCode.TooManyRequests] * 2
+
+    # cached credentials and (valid) tokens still get through
+    assert isinstance(attempt(basic_headers(identity, "right")), ext_api.HeadersResponse)
+    assert isinstance(attempt(bearer_headers(token)), ext_api.HeadersResponse)
+
+
+def test_tokens_of_revoked_keys_are_rejected(monkeypatch: pytest.MonkeyPatch) -> None:
+    key_id = str(uuid4())
+    token = make_token(claims={"identity": {"tenant": "t", "user_id": "u", "key_id": key_id}})
+    monkeypatch.setattr(authn, "verify_basic_auth", lambda identity, secret: token)
+
+    revocations = RevocationSet("http://auth/revocations")
+    revocations.start = lambda: None  # no background polling
+    monkeypatch.setattr(authn, "TOKEN_REVOCATIONS", revocations.source)
+    monkeypatch.setattr(authn, "_revocations", revocations)
+
+    p = AuthnExternalProcessorService()
+    response = p.process_request_headers(
+        basic_headers(key_id, "secret"), None, p.new_call_context()
+    )
+    assert header_identity(response).key_id == key_id
+
+    # once revoked, the (cached) token is rejected
+    revocations.revoked[key_id] = time()
+    response = p.process_request_headers(
+        basic_headers(key_id, "secret"), None, p.new_call_context()
+    )
+    assert response.status.code == StatusCode.Unauthorized
+    assert "revoked" in response.details
+
+
+def test_processes_share_verified_tokens_and_exchanges(
+    monkeypatch: pytest.MonkeyPatch, tmp_path
+) -> None:
+    calls = []
+    verify = authn.verify_token
+    monkeypatch.setattr(authn, "verify_token", lambda token: calls.append(token) or verify(token))
+    token = make_token()
+    monkeypatch.setattr(authn, "verify_basic_auth", lambda identity, secret: token)
+    monkeypatch.setattr(authn, "AUTH_SHARED_CACHE", str(tmp_path / "authn"))
+
+    # services in different processes, but with the same (shared) file
+    first, second = AuthnExternalProcessorService(), AuthnExternalProcessorService()
+    identity = str(uuid4())
+    first.process_request_headers(basic_headers(identity, "secret"), None, first.new_call_context())
+    response = second.process_request_headers(
+        basic_headers(identity, "secret"), None, second.new_call_context()
+    )
+    assert isinstance(response, ext_api.HeadersResponse)
+    assert len(calls) == 1
+    assert second.shared.hits == 2  # the exchange, and the verified token
+    assert header_identity(response) == token_identity(token)
@@ -1,14 +1,24 @@
+import asyncio
 from typing import Dict, List, Optional
 
+from envoy.config.core.v3.base_pb2 import HeaderMap as EnvoyHeaderMap
 from envoy.config.core.v3.base_pb2 import (
     HeaderValueOption as EnvoyHeaderValueOption,
 )
-from envoy.config.core.v3.base_pb2 import HeaderMap as EnvoyHeaderMap
 from envoy.config.core.v3.base_pb2 import HeaderValue as EnvoyHeaderValue
+from envoy.extensions.filters.http.ext_proc.v3.processing_mode_pb2 import (
+    ProcessingMode,
+)
 from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
+from envoy.type.v3.http_status_pb2 import HttpStatus, StatusCode
 import pytest
 
 from extproc.processors import BaseExternalProcessorService
+from extproc.processors.base import CONTINUE_ENCODED
+from extproc.processors.base import PHASES as PHASE_NAMES
+from extproc.processors.base import serialize_response
+
+from .conftest import async_iterate, parse_responses
 
 
 def assert_empty_header_mutation(headers: ext_api.HeaderMutation) -> None:
@@ -265,3 +275,196 @@ def test_process_response_trailers(trailers: ext_api.HttpTrailers) -> None:
     p = BaseExternalProcessorService()
     response = p.process_response_trailers(trailers, None, {})
     assert isinstance(response, ext_api.TrailersResponse)
+
+
+class AsyncHookService(BaseExternalProcessorService):
+    async def process_request_headers(
+        self,
+        headers: ext_api.HttpHeaders,
+        grpcctx: None,
+        callctx: Dict,
+    ) -> ext_api.HeadersResponse:
+        await asyncio.sleep(0)
+        response = self.just_continue_headers()
+        self.add_header(response.response, "X-Async", "true")
+        return response
+
+
+PHASES = (
+    ext_api.ProcessingRequest(request_headers=ext_api.HttpHeaders()),
+    ext_api.ProcessingRequest(request_body=ext_api.HttpBody()),
+    ext_api.ProcessingRequest(response_headers=ext_api.HttpHeaders()),
+    ext_api.ProcessingRequest(response_body=ext_api.HttpBody()),
+)
+
+
+def async_process(p: BaseExternalProcessorService, requests) -> List[ext_api.ProcessingResponse]:
+    async def consume():
+        return [r async for r in p.AsyncProcess(async_iterate(requests), None)]
+
+    return parse_responses(asyncio.run(consume()))
+
+
+@pytest.mark.parametrize("service", (BaseExternalProcessorService, AsyncHookService))
+def test_process_phases(service) -> None:
+    p = service()
+    responses = parse_responses(p.Process(iter(PHASES), None))
+    assert [r.WhichOneof("response") for r in responses] == [
+        r.WhichOneof("request") for r in PHASES
+    ]
+
+
+@pytest.mark.parametrize("service", (BaseExternalProcessorService, AsyncHookService))
+def test_async_process_phases(service) -> None:
+    p = service()
+    sync_responses = parse_responses(p.Process(iter(PHASES), None))
+    async_responses = async_process(p, PHASES)
+    assert async_responses == sync_responses
+
+
+def test_async_process_awaits_async_hooks() -> None:
+    p = AsyncHookService()
+    (response,) = async_process(p, PHASES[:1])
+    new_header = EnvoyHeaderValueOption(header=EnvoyHeaderValue(key="X-Async", value="true"))
+    assert new_header in response.request_headers.response.header_mutation.set_headers
+
+
+@pytest.mark.parametrize(
+    "service, phases",
+    (
+        (BaseExternalProcessorService, set()),
+        (AsyncHookService, {"request_headers"}),
+    ),
+)
+def test_implemented_phases(service, phases) -> None:
+    assert service.phases == phases
+
+
+def test_mode_override_skips_unimplemented_phases() -> None:
+    p = AsyncHookService()
+    (response,) = parse_responses(p.Process(iter(PHASES[:1]), None))
+    assert response.HasField("mode_override")
+    mode = response.mode_override
+    assert mode.request_body_mode == ProcessingMode.NONE
+    assert mode.response_body_mode == ProcessingMode.NONE
+    assert mode.response_header_mode == ProcessingMode.SKIP
+    assert mode.request_trailer_mode == ProcessingMode.SKIP
+    assert mode.response_trailer_mode == ProcessingMode.SKIP
+
+
+def test_mode_override_only_on_request_headers() -> None:
+    p = AsyncHookService()
+    responses = parse_responses(p.Process(iter(PHASES), None))
+    assert [r.HasField("mode_override") for r in responses] == [True, False, False, False]
+
+
+def test_skip_phases() -> None:
+    class BodyService(BaseExternalProcessorService):
+        def process_request_body(self, body, grpcctx, callctx):
+            return self.just_continue_body()
+
+    p = BodyService()
+    callctx = p.new_call_context()
+    assert p.processing_mode(callctx).request_body_mode == ProcessingMode.BUFFERED
+    p.skip_phases(callctx, "request_body")
+    assert p.processing_mode(callctx).request_body_mode == ProcessingMode.NONE
+
+
+def test_dispatch_table() -> None:
+    assert set(AsyncHookService._dispatch) == set(PHASE_NAMES)
+    assert AsyncHookService._dispatch["request_headers"] == (
+        AsyncHookService.process_request_headers,
+        True,
+    )
+    assert AsyncHookService._dispatch["request_body"] == (
+        BaseExternalProcessorService.process_request_body,
+        False,
+    )
+
+
+@pytest.mark.parametrize("phase", PHASE_NAMES)
+def test_continue_responses_are_pre_encoded(phase: str) -> None:
+    p = BaseExternalProcessorService()
+    data = getattr(ext_api.ProcessingRequest(), phase)  # an empty message for the phase
+    response = getattr(p, f"process_{phase}")(data, None, p.new_call_context())
+    expected = ext_api.ProcessingResponse(**{phase: response}).SerializeToString()
+    assert CONTINUE_ENCODED[phase] == expected
+    assert serialize_response(CONTINUE_ENCODED[phase]) == expected
+
+
+def test_modified_responses_are_not_pre_encoded() -> None:
+    p = AsyncHookService()
+    (response,) = p.Process(iter(PHASES[:1]), None)
+    assert isinstance(response, ext_api.ProcessingResponse)
+    (response,) = BaseExternalProcessorService().Process(iter(PHASES[:1]), None)
+    assert isinstance(response, bytes)
+
+
+class ChunkCountingService(BaseExternalProcessorService):
+    response_body_mode = ProcessingMode.STREAMED
+
+    def process_response_body_chunk(self, body, grpcctx, callctx):
+        callctx["chunks"] = callctx.get("chunks", 0) + 1
+        response = self.just_continue_body()
+        response.response.body_mutation.body = body.body.upper()
+        return response
+
+    def process_response_body_end(self, body, grpcctx, callctx):
+        response = self.just_continue_body()
+        self.add_header(response.response, "X-Chunks", str(callctx["chunks"]))
+        return response
+
+
+def test_streamed_body_hooks() -> None:
+    # trailers too, as a streamed body can end with them
+    assert ChunkCountingService.phases == {"response_body", "response_trailers"}
+    requests = [
+        ext_api.ProcessingRequest(response_body=ext_api.HttpBody(body=b"a")),
+        ext_api.ProcessingRequest(response_body=ext_api.HttpBody(body=b"b")),
+        ext_api.ProcessingRequest(response_body=ext_api.HttpBody(body=b"c", end_of_stream=True)),
+    ]
+    responses = parse_responses(ChunkCountingService().Process(iter(requests), None))
+    assert [r.response_body.response.body_mutation.body for r in responses] == [b"A", b"B", b"C"]
+
+    # the end hook's response is merged into the last chunk's
+    assert [len(r.response_body.response.header_mutation.set_headers) for r in responses] == [
+        0,
+        0,
+        1,
+    ]
+    assert responses[-1].response_body.response.header_mutation.set_headers[0].header.value == "3"
+
+
+class RejectingAtEndService(ChunkCountingService):
+    def process_response_body_end(self, body, grpcctx, callctx):
+        callctx["ended"] = callctx["chunks"]
+        return ext_api.ImmediateResponse(status=HttpStatus(code=StatusCode.Forbidden))
+
+
+def test_streamed_body_ending_with_trailers() -> None:
+    requests = [
+        ext_api.ProcessingRequest(response_body=ext_api.HttpBody(body=b"a")),
+        ext_api.ProcessingRequest(response_body=ext_api.HttpBody(body=b"b")),
+        ext_api.ProcessingRequest(response_trailers=ext_api.HttpTrailers()),
+    ]
+    p = RejectingAtEndService()
+    callctx = p.new_call_context()
+    for request in requests:
+        phase_name = request.WhichOneof("request")
+        response = getattr(p, f"process_{phase_name}")(getattr(request, phase_name), None, callctx)
+
+    # the end hook runs, after the chunks, in the trailers phase
+    assert callctx["ended"] == 2
+    assert response.status.code == StatusCode.Forbidden
+
+    # unless the body was skipped
+    callctx = p.new_call_context()
+    p.skip_phases(callctx, "response_body")
+    p.process_response_trailers(ext_api.HttpTrailers(), None, callctx)
+    assert "ended" not in callctx
+
+
+def test_trailers_continue_without_end_hooks() -> None:
+    p = BaseExternalProcessorService()
+    response = p.process_response_trailers(ext_api.HttpTrailers(), None, p.new_call_context())
+    assert response == p.just_continue_trailers()
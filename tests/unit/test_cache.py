@@ -0,0 +1,129 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import sleep
+
+import pytest
+
+from extproc.utils.cache import (
+    FlightTimeout,
+    LRUCache,
+    SingleFlight,
+    WindowCounter,
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_lru_eviction() -> None:
+    cache = LRUCache(2, clock=Clock())
+    cache.set("a", 1, 2000)
+    cache.set("b", 2, 2000)
+    assert cache.get("a") == 1  # now "b" is least recently used
+    cache.set("c", 3, 2000)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats() == {"hits": 3, "misses": 1, "size": 2}
+
+
+def test_expiry() -> None:
+    clock = Clock()
+    cache = LRUCache(10, clock=clock)
+    cache.set("a", 1, 1010)
+    cache.set("expired", 1, 1000)  # not even stored
+    assert len(cache) == 1
+    assert cache.get("a") == 1
+    assert cache.get_with_expiry("a") == (1, 1010)
+    clock.now = 1010
+    assert cache.get("a", "default") == "default"
+    assert cache.get_with_expiry("a") is None
+    assert len(cache) == 0
+
+
+def test_single_flight() -> None:
+    flights = SingleFlight(timeout=5)
+    started, release = Event(), Event()
+    calls = []
+
+    def lookup(key: str) -> str:
+        calls.append(key)
+        started.set()
+        release.wait(5)
+        return key.upper()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        leader = executor.submit(flights.do, "key", lookup, "key")
+        started.wait(5)
+        waiters = [executor.submit(flights.do, "key", lookup, "key") for _ in range(3)]
+        while flights.shared < 3:
+            sleep(0.001)
+        release.set()
+        assert [f.result() for f in [leader, *waiters]] == ["KEY"] * 4
+
+    assert calls == ["key"]
+    assert (flights.calls, flights.shared) == (1, 3)
+
+    # not in flight anymore, so called again
+    assert flights.do("key", lookup, "key") == "KEY"
+    assert len(calls) == 2
+
+
+def test_single_flight_errors_and_timeouts() -> None:
+    flights = SingleFlight(timeout=0.01)
+    release = Event()
+
+    def fail() -> None:
+        release.wait(5)
+        raise ValueError("shared")
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        leader = executor.submit(flights.do, "key", fail)
+        while not flights.calls:
+            sleep(0.001)
+        with pytest.raises(FlightTimeout):
+            flights.do("key", fail)
+
+        flights.timeout = 5
+        waiter = executor.submit(flights.do, "key", fail)
+        while flights.shared < 2:
+            sleep(0.001)
+        release.set()
+        for future in (leader, waiter):
+            with pytest.raises(ValueError):
+                future.result()
+
+
+def test_window_counter() -> None:
+    clock = Clock()
+    counter = WindowCounter(maxsize=10, window=60, clock=clock)
+    assert [counter.add("a") for _ in range(3)] == [1, 2, 3]
+    assert (counter.count("a"), counter.count("b")) == (3, 0)
+
+    clock.now += 45
+    assert counter.add("a") == 4
+    assert counter.retry_after("a") == 15
+
+    clock.now += 15  # the window ends
+    assert counter.count("a") == 0
+    assert counter.add("a") == 1
+    assert counter.retry_after("a") == 60
+
+
+def test_lru_bounded_by_size() -> None:
+    cache = LRUCache(100, clock=Clock())
+    cache.set("a", "a", 2000, size=40)
+    cache.set("b", "b", 2000, size=40)
+    cache.set("c", "c", 2000, size=40)  # evicts "a"
+    assert cache.get("a") is None
+    assert cache.size == 80
+
+    cache.set("b", "b", 2000, size=10)  # replaced, resized
+    assert cache.size == 50
+    cache.set("big", "big", 2000, size=101)  # never fits
+    assert cache.get("big") is None
+    assert (cache.get("b"), cache.get("c")) == ("b", "c")
@@ -0,0 +1,278 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import time
+from typing import Dict, Union
+from uuid import uuid4
+
+from envoy.config.core.v3.base_pb2 import HeaderMap as EnvoyHeaderMap
+from envoy.config.core.v3.base_pb2 import HeaderValue as EnvoyHeaderValue
+from envoy.config.core.v3.base_pb2 import (
+    HeaderValueOption as EnvoyHeaderValueOption,
+)
+from envoy.extensions.filters.http.ext_proc.v3.processing_mode_pb2 import (
+    ProcessingMode,
+)
+from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
+from envoy.type.v3.http_status_pb2 import HttpStatus, StatusCode
+import pytest
+
+from extproc.processors import (
+    BaseExternalProcessorService,
+    CompositeExternalProcessorService,
+    DigestExternalProcessorService,
+)
+from extproc.processors.composite import (
+    apply_header_mutation,
+    merge_header_mutation,
+)
+
+from .conftest import async_iterate, parse_responses
+
+
+class DigestReaderService(BaseExternalProcessorService):
+    """records the digest header it sees, like idempotency would"""
+
+    def process_request_headers(
+        self,
+        headers: ext_api.HttpHeaders,
+        grpcctx: None,
+        callctx: Dict,
+    ) -> ext_api.HeadersResponse:
+        callctx["digest"] = self.get_header(headers, "x-request-digest")
+        response = self.just_continue_headers()
+        self.add_header(response.response, "X-Digest-Seen", str(callctx["digest"] is not None))
+        return response
+
+
+class RejectingService(BaseExternalProcessorService):
+    def process_request_headers(
+        self,
+        headers: ext_api.HttpHeaders,
+        grpcctx: None,
+        callctx: Dict,
+    ) -> Union[ext_api.HeadersResponse, ext_api.ImmediateResponse]:
+        return ext_api.ImmediateResponse(status=HttpStatus(code=StatusCode.Forbidden))
+
+
+def request_headers(method: str, end_of_stream: bool) -> ext_api.ProcessingRequest:
+    return ext_api.ProcessingRequest(
+        request_headers=ext_api.HttpHeaders(
+            headers=EnvoyHeaderMap(
+                headers=[
+                    EnvoyHeaderValue(key=":method", value=method),
+                    EnvoyHeaderValue(key=":path", value="/api/v0/resource"),
+                    EnvoyHeaderValue(key="x-gateway-tenant", value=str(uuid4())),
+                ]
+            ),
+            end_of_stream=end_of_stream,
+        )
+    )
+
+
+def set_header_keys(mutation: ext_api.HeaderMutation) -> Dict[str, str]:
+    return {o.header.key: o.header.value for o in mutation.set_headers}
+
+
+def test_composite_holds_headers_for_body() -> None:
+
+    reader = DigestReaderService()
+    p = CompositeExternalProcessorService([DigestExternalProcessorService(), reader])
+    requests = [
+        request_headers("POST", end_of_stream=False),
+        ext_api.ProcessingRequest(request_body=ext_api.HttpBody(body=b"{}", end_of_stream=True)),
+    ]
+    headers_response, body_response = parse_responses(p.Process(iter(requests), None))
+
+    # the reader's headers phase waits for the digest, computed from the body
+    assert "X-Digest-Seen" not in set_header_keys(
+        headers_response.request_headers.response.header_mutation
+    )
+    mutated = set_header_keys(body_response.request_body.response.header_mutation)
+    assert mutated["X-Digest-Seen"] == "True"
+    assert mutated["X-Request-Digest"]
+
+
+def test_composite_runs_headers_without_body() -> None:
+
+    p = CompositeExternalProcessorService([DigestExternalProcessorService(), DigestReaderService()])
+    (response,) = parse_responses(
+        p.Process(iter([request_headers("GET", end_of_stream=True)]), None)
+    )
+    mutated = set_header_keys(response.request_headers.response.header_mutation)
+    assert mutated["X-Digest-Seen"] == "True"
+
+
+def test_composite_short_circuits() -> None:
+
+    reader = DigestReaderService()
+    p = CompositeExternalProcessorService([RejectingService(), reader])
+    (response,) = parse_responses(
+        p.Process(iter([request_headers("GET", end_of_stream=True)]), None)
+    )
+    assert response.WhichOneof("response") == "immediate_response"
+    assert response.immediate_response.status.code == StatusCode.Forbidden
+
+
+def test_composite_requires_processors() -> None:
+    with pytest.raises(ValueError):
+        CompositeExternalProcessorService([])
+
+
+def test_apply_header_mutation() -> None:
+    headers = EnvoyHeaderMap(
+        headers=[
+            EnvoyHeaderValue(key="keep", value="1"),
+            EnvoyHeaderValue(key="replace", value="old"),
+            EnvoyHeaderValue(key="remove", value="gone"),
+        ]
+    )
+    mutation = ext_api.HeaderMutation(
+        set_headers=[
+            EnvoyHeaderValueOption(header=EnvoyHeaderValue(key="Replace", value="new")),
+        ],
+        remove_headers=["remove"],
+    )
+    apply_header_mutation(headers, mutation)
+    assert {h.key: h.value for h in headers.headers} == {"keep": "1", "replace": "new"}
+
+
+def test_merge_header_mutation_removal_drops_earlier_sets() -> None:
+    merged = ext_api.HeaderMutation(
+        set_headers=[EnvoyHeaderValueOption(header=EnvoyHeaderValue(key="x-a", value="1"))]
+    )
+    merge_header_mutation(merged, ext_api.HeaderMutation(remove_headers=["X-A"]))
+    assert len(merged.set_headers) == 0
+    assert list(merged.remove_headers) == ["X-A"]
+
+
+def test_composite_phases_are_the_union() -> None:
+    p = CompositeExternalProcessorService([DigestExternalProcessorService(), DigestReaderService()])
+    assert p.phases == {"request_headers", "request_body"}
+
+
+@pytest.mark.parametrize(
+    "method, body_mode",
+    (
+        ("GET", ProcessingMode.NONE),
+        ("POST", ProcessingMode.BUFFERED),
+    ),
+)
+def test_composite_mode_override(method: str, body_mode: int) -> None:
+    p = CompositeExternalProcessorService([DigestExternalProcessorService(), DigestReaderService()])
+    (response,) = parse_responses(
+        p.Process(iter([request_headers(method, end_of_stream=False)]), None)
+    )
+    assert response.mode_override.request_body_mode == body_mode
+    assert response.mode_override.response_header_mode == ProcessingMode.SKIP
+
+    # the reader is held for the body only if the digester reads it
+    mutated = set_header_keys(response.request_headers.response.header_mutation)
+    assert ("X-Digest-Seen" in mutated) == (body_mode == ProcessingMode.NONE)
+
+
+def test_composite_holds_headers_for_streamed_body() -> None:
+    class StreamingDigester(DigestExternalProcessorService):
+        request_body_mode = ProcessingMode.STREAMED
+
+    p = CompositeExternalProcessorService([StreamingDigester(), DigestReaderService()])
+    assert p.request_body_mode == ProcessingMode.STREAMED
+    requests = [
+        request_headers("POST", end_of_stream=False),
+        ext_api.ProcessingRequest(request_body=ext_api.HttpBody(body=b"{")),
+        ext_api.ProcessingRequest(request_body=ext_api.HttpBody(body=b"}", end_of_stream=True)),
+    ]
+    _, first, last = parse_responses(p.Process(iter(requests), None))
+
+    # the reader runs with the last chunk, once the digest is complete
+    assert not first.request_body.response.header_mutation.set_headers
+    mutated = set_header_keys(last.request_body.response.header_mutation)
+    assert mutated["X-Digest-Seen"] == "True"
+
+
+class SkippingBodyService(BaseExternalProcessorService):
+    """skips the body, but records it if it runs"""
+
+    def process_request_headers(
+        self,
+        headers: ext_api.HttpHeaders,
+        grpcctx: None,
+        callctx: Dict,
+    ) -> ext_api.HeadersResponse:
+        self.skip_phases(callctx, "request_body")
+        return self.just_continue_headers()
+
+    def process_request_body(
+        self,
+        body: ext_api.HttpBody,
+        grpcctx: None,
+        callctx: Dict,
+    ) -> ext_api.BodyResponse:
+        callctx["body"] = body.body
+        return self.just_continue_body()
+
+
+def test_composite_honors_skipped_phases() -> None:
+    p = CompositeExternalProcessorService([SkippingBodyService(), DigestReaderService()])
+    callctx = p.new_call_context()
+    p.process_request_headers(
+        request_headers("POST", end_of_stream=False).request_headers, None, callctx
+    )
+    p.process_request_body(ext_api.HttpBody(body=b"{}", end_of_stream=True), None, callctx)
+    assert "body" not in callctx.contexts[0]
+
+
+class AsyncLoopService(BaseExternalProcessorService):
+    """records the event loops its (async) hook runs on; uses the executor, like idempotency"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loops = []
+
+    async def process_request_headers(
+        self,
+        headers: ext_api.HttpHeaders,
+        grpcctx: None,
+        callctx: Dict,
+    ) -> ext_api.HeadersResponse:
+        loop = asyncio.get_running_loop()
+        self.loops.append(loop)
+        await loop.run_in_executor(None, time.sleep, 0.01)
+        return self.just_continue_headers()
+
+
+def test_composite_awaits_async_hooks_on_the_server_loop() -> None:
+    inner = AsyncLoopService()
+    p = CompositeExternalProcessorService([inner, DigestReaderService()])
+
+    async def run():
+        requests = [request_headers("GET", end_of_stream=True)]
+        async for _ in p.AsyncProcess(async_iterate(requests), None):
+            pass
+        return asyncio.get_running_loop()
+
+    assert inner.loops == [asyncio.run(run())]
+
+
+def test_composite_streams_dont_hold_executor_threads() -> None:
+    p = CompositeExternalProcessorService([AsyncLoopService(), DigestReaderService()])
+
+    async def stream():
+        requests = [request_headers("GET", end_of_stream=True)]
+        return [r async for r in p.AsyncProcess(async_iterate(requests), None)]
+
+    async def run():
+        # (many) more streams than threads; async hooks using the executor
+        # themselves must not wait for a thread held by their own stream
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=1))
+        return await asyncio.wait_for(asyncio.gather(*(stream() for _ in range(5))), timeout=5.0)
+
+    assert all(len(responses) == 1 for responses in asyncio.run(run()))
+
+
+def test_composite_runs_async_hooks_synchronously() -> None:
+    inner = AsyncLoopService()
+    p = CompositeExternalProcessorService([inner, DigestReaderService()])
+    responses = parse_responses(p.Process(iter([request_headers("GET", end_of_stream=True)]), None))
+    mutated = set_header_keys(responses[0].request_headers.response.header_mutation)
+    assert mutated["X-Digest-Seen"] == "False"
+    assert len(inner.loops) == 1
@@ -0,0 +1,28 @@
+import pytest
+
+from extproc.utils import compression
+
+PAYLOAD = b'{"message": "hello"}' * 200
+
+
+@pytest.mark.parametrize("codec", [c for c in compression.CODECS if compression.available(c)])
+def test_round_trip(codec: str) -> None:
+    data = compression.encode(PAYLOAD, codec=codec, threshold=100)
+    assert compression.is_encoded(data)
+    assert compression.decode(data) == PAYLOAD
+    if codec != "none":
+        assert len(data) < len(PAYLOAD) / 4
+
+
+def test_small_or_incompressible_payloads_are_not_compressed() -> None:
+    assert compression.encode(b"small", threshold=100) == bytes([compression.VERSION, 0]) + b"small"
+    random = bytes(range(256))
+    assert compression.encode(random, threshold=1)[1] == compression.NONE
+
+
+def test_unknown_versions_and_codecs() -> None:
+    with pytest.raises(ValueError):
+        compression.decode(bytes([compression.VERSION + 1, 0]) + PAYLOAD)
+    with pytest.raises(compression.UnknownCodec):
+        compression.decode(bytes([compression.VERSION, 99]) + PAYLOAD)
+    assert not compression.available("brotli")
@@ -36,9 +36,8 @@ from extproc.processors import ConcurrencyTestingService
 )
 def test_process_request_headers(headers: ext_api.HttpHeaders) -> None:
 
-    ctx = {}
-
     p = ConcurrencyTestingService()
+    ctx = p.new_call_context()
     response = p.process_request_headers(headers, None, ctx)
     assert isinstance(response, ext_api.HeadersResponse)
     for k in ["path", "_rid", "grid"]:
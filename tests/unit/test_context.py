@@ -0,0 +1,93 @@
+from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
+import pytest
+
+from extproc.processors import (
+    BaseExternalProcessorService,
+    CallContext,
+    DigestExternalProcessorService,
+)
+from extproc.processors.digester import DigestCallContext
+
+from .conftest import parse_responses
+
+
+class FieldsCallContext(CallContext):
+    __slots__ = ("first", "second")
+
+
+def test_fields_are_slots() -> None:
+    ctx = FieldsCallContext()
+    assert not hasattr(ctx, "__dict__")
+    ctx.first = 1
+    assert ctx["first"] == 1
+    with pytest.raises(AttributeError):
+        ctx.undeclared = 1
+
+
+def test_dict_style_access() -> None:
+    ctx = FieldsCallContext()
+
+    # fields
+    assert "second" not in ctx
+    assert ctx.get("second", "default") == "default"
+    with pytest.raises(KeyError):
+        ctx["second"]
+    ctx["second"] = 2
+    assert ctx.second == 2 and "second" in ctx
+
+    # other keys
+    assert "other" not in ctx
+    ctx.update(other=3, first=1)
+    assert ctx["other"] == 3 and ctx.first == 1
+    assert ctx.setdefault("other", 4) == 3
+    assert ctx.setdefault("more", 5) == 5
+    del ctx["more"]
+    assert "more" not in ctx
+
+    items = dict(ctx.items())
+    assert (items["first"], items["second"], items["other"]) == (1, 2, 3)
+    assert items["overhead_ns"] == 0  # built-in fields too
+
+
+def test_stream_stats() -> None:
+    p = DigestExternalProcessorService()
+    callctx = p.new_call_context()
+    assert isinstance(callctx, DigestCallContext)
+
+    requests = [
+        ext_api.ProcessingRequest(request_body=ext_api.HttpBody(body=b"1234")),
+        ext_api.ProcessingRequest(request_body=ext_api.HttpBody(body=b"56", end_of_stream=True)),
+    ]
+    for request in requests:
+        callctx.record("request_body", request.request_body, 100)
+
+    assert callctx.count("request_body") == 2
+    assert callctx.count("request_headers") == 0
+    assert callctx.request_bytes == 6
+    assert callctx.overhead_ns == 200
+
+    callctx.retain(10)
+    callctx.release(4)
+    assert callctx.stats()["retained_bytes"] == 6
+    assert callctx.elapsed_ns() > 0
+
+
+def test_process_records_phases() -> None:
+    contexts = []
+
+    class RecordingService(BaseExternalProcessorService):
+        def new_call_context(self) -> CallContext:
+            contexts.append(super().new_call_context())
+            return contexts[-1]
+
+    requests = [
+        ext_api.ProcessingRequest(request_headers=ext_api.HttpHeaders()),
+        ext_api.ProcessingRequest(request_body=ext_api.HttpBody(body=b"{}")),
+        ext_api.ProcessingRequest(response_body=ext_api.HttpBody(body=b"[1]")),
+    ]
+    parse_responses(RecordingService().Process(iter(requests), None))
+
+    (callctx,) = contexts
+    assert callctx.phase_counts == [1, 1, 0, 0, 1, 0]
+    assert (callctx.request_bytes, callctx.response_bytes) == (2, 3)
+    assert callctx.overhead_ns > 0
@@ -1,12 +1,24 @@
+from hashlib import sha256
 import re
+from typing import List
 from uuid import uuid4
 
 from envoy.config.core.v3.base_pb2 import HeaderMap as EnvoyHeaderMap
 from envoy.config.core.v3.base_pb2 import HeaderValue as EnvoyHeaderValue
+from envoy.extensions.filters.http.ext_proc.v3.processing_mode_pb2 import (
+    ProcessingMode,
+)
 from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
 import pytest
 
 from extproc.processors import DigestExternalProcessorService
+from extproc.utils.identity import encode_identity
+
+from .conftest import parse_responses
+
+
+def tenant_identity(tenant: str) -> str:
+    return encode_identity({"identity": {"tenant": tenant}})
 
 
 @pytest.mark.parametrize(
@@ -24,8 +36,8 @@ from extproc.processors import DigestExternalProcessorService
                         value="/api/v0/resource",
                     ),
                     EnvoyHeaderValue(
-                        key="x-gateway-tenant",
-                        value=str(uuid4()),
+                        key="x-gateway-identity",
+                        value=tenant_identity(str(uuid4())),
                     ),
                 ]
             )
@@ -38,9 +50,8 @@ from extproc.processors import DigestExternalProcessorService
 )
 def test_digester_flow(headers: ext_api.HttpHeaders, body: ext_api.HttpBody) -> None:
 
-    ctx = {}
-
     p = DigestExternalProcessorService()
+    ctx = p.new_call_context()
     response = p.process_request_headers(headers, None, ctx)
     assert isinstance(response, ext_api.HeadersResponse)
     for k in ["tenant", "method", "path", "digest"]:
@@ -55,3 +66,63 @@ def test_digester_flow(headers: ext_api.HttpHeaders, body: ext_api.HttpBody) ->
             digest = h.header.value
     assert digest is not None
     assert re.match(r"^[0-9a-f]{64}$", digest) is not None
+
+
+@pytest.mark.parametrize(
+    "method, body_mode",
+    (
+        ("GET", ProcessingMode.NONE),
+        ("POST", ProcessingMode.BUFFERED),
+    ),
+)
+def test_digester_skips_body_for_gets(method: str, body_mode: int) -> None:
+    tenant = str(uuid4())
+    headers = ext_api.HttpHeaders(
+        headers=EnvoyHeaderMap(
+            headers=[
+                EnvoyHeaderValue(key=":method", value=method),
+                EnvoyHeaderValue(key=":path", value="/api/v0/resource"),
+                EnvoyHeaderValue(key="x-gateway-identity", value=tenant_identity(tenant)),
+            ]
+        )
+    )
+    p = DigestExternalProcessorService()
+    request = ext_api.ProcessingRequest(request_headers=headers)
+    (response,) = parse_responses(p.Process(iter([request]), None))
+    assert response.mode_override.request_body_mode == body_mode
+
+
+def test_digester_hashes_streamed_chunks() -> None:
+    tenant = str(uuid4())
+    headers = ext_api.HttpHeaders(
+        headers=EnvoyHeaderMap(
+            headers=[
+                EnvoyHeaderValue(key=":method", value="POST"),
+                EnvoyHeaderValue(key=":path", value="/api/v0/resource"),
+                EnvoyHeaderValue(key="x-gateway-identity", value=tenant_identity(tenant)),
+            ]
+        )
+    )
+    body = b'{"data": "' + b"x" * 1000 + b'"}'
+
+    def digest(chunks: List[bytes], body_mode: int) -> str:
+        class Digester(DigestExternalProcessorService):
+            request_body_mode = body_mode
+
+        requests = [ext_api.ProcessingRequest(request_headers=headers)] + [
+            ext_api.ProcessingRequest(
+                request_body=ext_api.HttpBody(body=chunk, end_of_stream=(i == len(chunks) - 1))
+            )
+            for i, chunk in enumerate(chunks)
+        ]
+        *responses, last = parse_responses(Digester().Process(iter(requests), None))
+        for response in responses[1:]:  # chunks before the last are just passed on
+            assert not response.request_body.response.header_mutation.set_headers
+        (header,) = last.request_body.response.header_mutation.set_headers
+        assert header.header.key == "X-Request-Digest"
+        return header.header.value
+
+    chunks = [body[i : i + 100] for i in range(0, len(body), 100)]
+    assert digest(chunks, ProcessingMode.STREAMED) == digest([body], ProcessingMode.BUFFERED)
+    expected = sha256(tenant.encode() + b"POST/api/v0/resource" + body).hexdigest()
+    assert digest(chunks, ProcessingMode.STREAMED) == expected
@@ -0,0 +1,79 @@
+from envoy.config.core.v3.base_pb2 import HeaderMap as EnvoyHeaderMap
+from envoy.config.core.v3.base_pb2 import HeaderValue as EnvoyHeaderValue
+from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
+import pytest
+
+from extproc.processors import BaseExternalProcessorService
+from extproc.utils.headers import HeaderView
+
+
+def http_headers() -> ext_api.HttpHeaders:
+    return ext_api.HttpHeaders(
+        headers=EnvoyHeaderMap(
+            headers=[
+                EnvoyHeaderValue(key=":method", value="POST"),
+                EnvoyHeaderValue(key="x-forwarded-for", value="10.0.0.1"),
+                EnvoyHeaderValue(key="Content-Type", value="application/json"),
+                EnvoyHeaderValue(key="x-forwarded-for", value="10.0.0.2"),
+            ]
+        )
+    )
+
+
+@pytest.mark.parametrize(
+    "name, value",
+    (
+        (":method", "POST"),
+        ("content-type", "application/json"),
+        ("Content-Type", "application/json"),
+        ("x-forwarded-for", "10.0.0.1"),
+        ("x-missing", None),
+    ),
+)
+def test_get(name: str, value: str) -> None:
+    assert HeaderView(http_headers()).get(name) == value
+
+
+def test_get_all() -> None:
+    view = HeaderView(http_headers())
+    assert view.get_all("x-forwarded-for") == ["10.0.0.1", "10.0.0.2"]
+    assert view.get_all(":method") == ["POST"]
+    assert view.get_all("x-missing") == []
+
+
+def test_pick() -> None:
+    view = HeaderView(http_headers().headers)  # from a HeaderMap too
+    names = [":method", "content-type", "x-missing"]
+    assert view.pick(names) == {":method": "POST", "content-type": "application/json"}
+    assert view.pick(names, mapping=["method", "type", "missing"]) == {
+        "method": "POST",
+        "type": "application/json",
+    }
+
+
+def test_mapping_access() -> None:
+    view = HeaderView(http_headers())
+    assert "content-type" in view
+    assert "x-missing" not in view
+    assert view[":method"] == "POST"
+    with pytest.raises(KeyError):
+        view["x-missing"]
+    assert len(view) == 4
+    assert [key for key, _ in view] == [
+        ":method",
+        "x-forwarded-for",
+        "Content-Type",
+        "x-forwarded-for",
+    ]
+
+
+def test_header_view_is_cached_per_message() -> None:
+    p = BaseExternalProcessorService()
+    callctx = p.new_call_context()
+    headers = http_headers()
+    view = p.header_view(headers, callctx)
+    assert p.header_view(headers, callctx) is view
+    assert p.header_view(http_headers(), callctx) is not view
+
+    # helpers accept either
+    assert p.get_header(view, ":method") == p.get_header(headers, ":method") == "POST"
@@ -0,0 +1,148 @@
+from threading import Event
+from time import monotonic, sleep
+from typing import List
+
+import pytest
+import requests
+
+from extproc.utils.http import (
+    cap_timeout,
+    CircuitBreaker,
+    CircuitOpen,
+    HttpClient,
+    Unavailable,
+)
+
+
+def response(status: int) -> requests.Response:
+    r = requests.Response()
+    r.status_code = status
+    return r
+
+
+class FakeSession:
+    """responds (or raises) with the given results, in order"""
+
+    def __init__(self, results: List):
+        self.results = results
+        self.calls = 0
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        result = self.results[min(self.calls, len(self.results) - 1)]
+        self.calls += 1
+        if callable(result):
+            return result()
+        if isinstance(result, Exception):
+            raise result
+        return response(result)
+
+    def close(self) -> None:
+        pass
+
+
+def client(results: List, **kwargs) -> HttpClient:
+    c = HttpClient("http://auth", backoff=0.001, **kwargs)
+    c.session = FakeSession(results)
+    return c
+
+
+def test_retries() -> None:
+    c = client([requests.ConnectionError(), 503, 200])
+    assert c.get().status_code == 200
+    assert c.session.calls == 3
+
+    c = client([503], retries=1)
+    with pytest.raises(Unavailable):
+        c.get()
+    assert c.session.calls == 2
+
+    c = client([401])  # not retried
+    assert c.get().status_code == 401
+    assert c.session.calls == 1
+
+
+def test_circuit_breaker() -> None:
+    now = [0.0]
+    breaker = CircuitBreaker(failures=2, reset_after=10, clock=lambda: now[0])
+    c = client([requests.Timeout()], retries=0, breaker=breaker)
+
+    for _ in range(2):
+        with pytest.raises(Unavailable):
+            c.get()
+    assert breaker.open
+
+    # fails fast
+    with pytest.raises(CircuitOpen) as err:
+        c.get()
+    assert err.value.retry_after == 10
+    assert c.session.calls == 2
+
+    # after reset_after one trial call is let through, and it closes the circuit
+    now[0] = 11
+    c.session.results = [200]
+    assert c.get().status_code == 200
+    assert not breaker.open
+
+
+def test_half_open_failure_reopens() -> None:
+    now = [0.0]
+    breaker = CircuitBreaker(failures=1, reset_after=10, clock=lambda: now[0])
+    breaker.failure()
+    now[0] = 11
+    breaker.check()  # the trial
+    with pytest.raises(CircuitOpen):
+        breaker.check()  # only one at a time
+    breaker.failure()
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+
+@pytest.mark.parametrize("error", [requests.TooManyRedirects(), ValueError("unexpected")])
+def test_other_errors_end_the_trial_call(error: Exception) -> None:
+    now = [0.0]
+    breaker = CircuitBreaker(failures=1, reset_after=10, clock=lambda: now[0])
+    c = client([requests.Timeout()], retries=0, breaker=breaker)
+    with pytest.raises(Unavailable):
+        c.get()
+
+    now[0] = 11
+    c.session.results = [error]
+    with pytest.raises(type(error)):
+        c.get()  # the trial call, failed
+
+    now[0] = 22
+    c.session.results = [200]
+    assert c.get().status_code == 200  # not stuck open
+    assert not breaker.open
+
+
+def test_deadline_bounds_retries() -> None:
+    def slow() -> requests.Response:
+        sleep(0.03)
+        raise requests.Timeout()
+
+    c = client([slow], retries=10, deadline=0.1)
+    started = monotonic()
+    with pytest.raises(Unavailable):
+        c.get()
+    assert monotonic() - started < 0.5
+    assert c.session.calls < 10
+
+
+def test_deadline_caps_timeouts() -> None:
+    assert cap_timeout((1.0, 5.0), 2.0) == (1.0, 2.0)
+    assert cap_timeout(5.0, 2.0) == 2.0
+
+
+def test_hedging() -> None:
+    release = Event()
+
+    def slow() -> requests.Response:
+        release.wait(5)
+        return response(500)
+
+    c = client([slow, 200], hedge_after=0.01)
+    assert c.get().status_code == 200  # the hedged request wins
+    assert c.session.calls == 2
+    release.set()
+    c.close()
@@ -1,20 +1,34 @@
+import asyncio
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
 from random import choice
 from string import digits
+from time import time
+from typing import Optional
 from uuid import uuid4
 
 from envoy.config.core.v3.base_pb2 import (
     HeaderValueOption as EnvoyHeaderValueOption,
 )
+from envoy.config.core.v3.base_pb2 import HeaderMap as EnvoyHeaderMap
 from envoy.config.core.v3.base_pb2 import HeaderValue as EnvoyHeaderValue
+from envoy.extensions.filters.http.ext_proc.v3.processing_mode_pb2 import (
+    ProcessingMode,
+)
 from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
 from gateway.cache.v1.cache_pb2 import CachedHeader  # noqa: F401
 from gateway.cache.v1.cache_pb2 import CachedRequestResponse
 from google.protobuf.timestamp_pb2 import Timestamp
 import pytest
 
+from extproc import service
 from extproc.processors import idempotency
+from extproc.processors.composite import CompositeExternalProcessorService
+
+from .conftest import FakeRedisCache, FakeRedisChannels, parse_responses
 
-from .conftest import FakeRedisCache
+META, BODY = idempotency.META_FIELD, idempotency.BODY_FIELD
 
 HEX_DIGITS = digits.split() + ["a", "b", "c", "d", "e", "f"]
 
@@ -48,10 +62,10 @@ def now_proto() -> Timestamp:
 )
 def test_caching_serialization(data: CachedRequestResponse) -> None:
 
-    wire: str = idempotency.serialize_cache_data(data)
+    wire: bytes = idempotency.serialize_cache_data(data)
     value: CachedRequestResponse = idempotency.deserialize_cache_data(wire)
 
-    assert isinstance(wire, str)
+    assert isinstance(wire, bytes)
     assert isinstance(value, CachedRequestResponse)
     assert value == data
 
@@ -81,7 +95,7 @@ def test_create_sentinel(monkeypatch, data: CachedRequestResponse) -> None:
     p.create_sentinel(data)
     assert cache.exists(data.key)
     assert cache._get(data.key).ttl == idempotency.IDEMP_SENTINEL_TIME
-    assert idempotency.deserialize_cache_data(cache.get(data.key)) == data
+    assert idempotency.deserialize_cache_data(cache.hget(data.key, META)) == data
 
 
 @pytest.mark.parametrize(
@@ -135,7 +149,7 @@ def test_cache_response(monkeypatch, data: CachedRequestResponse) -> None:
     p.cache_response(data)
     assert cache.exists(data.key)
     assert cache._get(data.key).ttl == idempotency.IDEMP_CACHE_TIME
-    assert idempotency.deserialize_cache_data(cache.get(data.key)) == data
+    assert idempotency.deserialize_cache_data(cache.hget(data.key, META)) == data
 
 
 @pytest.mark.parametrize(
@@ -161,17 +175,358 @@ def test_respond_from_cache(monkeypatch, data: CachedRequestResponse) -> None:
 
     p = idempotency.IdempotencyExternalProcessorService()
 
-    # raise a ValueError when asked for a response from cached
-    with pytest.raises(ValueError):
-        p.response_from_cache(data.key)
-
     # cache the data and assert construction of response
     p.cache_response(data)
-    response = p.response_from_cache(data.key)
+    assert len(p.completed) == 0  # kept in memory only once replayed
+    callctx = p.new_call_context()
+    response = p.response_from_cache(cache.hget(data.key, META), callctx)
 
     assert isinstance(response, ext_api.ImmediateResponse)
+    assert response is callctx.replay.response
+    assert p.completed.get(data.key) is callctx.replay
 
     cached_header = EnvoyHeaderValueOption(
         header=EnvoyHeaderValue(key="X-Gateway-Cached", value="true")
     )
     assert cached_header in response.headers.set_headers
+
+
+@pytest.mark.parametrize("method", ("GET", "PUT", "DELETE"))
+def test_skips_response_phases_for_other_methods(monkeypatch, method: str) -> None:
+
+    cache = FakeRedisCache()
+    monkeypatch.setattr(idempotency, "RedisCache", cache)
+
+    headers = ext_api.HttpHeaders(
+        headers=EnvoyHeaderMap(
+            headers=[
+                EnvoyHeaderValue(key=":method", value=method),
+                EnvoyHeaderValue(key=":path", value="/api/v0/resource"),
+            ]
+        )
+    )
+    p = idempotency.IdempotencyExternalProcessorService()
+    request = ext_api.ProcessingRequest(request_headers=headers)
+    (response,) = parse_responses(p.Process(iter([request]), None))
+    assert response.mode_override.response_header_mode == ProcessingMode.SKIP
+    assert response.mode_override.response_body_mode == ProcessingMode.NONE
+
+
+def post_headers(key: str) -> ext_api.HttpHeaders:
+    return ext_api.HttpHeaders(
+        headers=EnvoyHeaderMap(
+            headers=[
+                EnvoyHeaderValue(key=":method", value="POST"),
+                EnvoyHeaderValue(key=":path", value="/api/v0/resource"),
+                EnvoyHeaderValue(key="x-request-digest", value=random_digest()),
+                EnvoyHeaderValue(key="x-idempotency-key", value=key),
+            ]
+        )
+    )
+
+
+def test_duplicates_in_progress_conflict(monkeypatch) -> None:
+
+    cache = FakeRedisCache()
+    monkeypatch.setattr(idempotency, "RedisCache", cache)
+
+    p = idempotency.IdempotencyExternalProcessorService()
+    key = str(uuid4())
+    first, second = p.new_call_context(), p.new_call_context()
+
+    response = p.process_request_headers(post_headers(key), None, first)
+    assert isinstance(response, ext_api.HeadersResponse)
+    assert cache.hget(key, META) == first.sentinel
+
+    response = p.process_request_headers(post_headers(key), None, second)
+    assert isinstance(response, ext_api.ImmediateResponse)
+    assert response.status.code == 409
+    assert second.cached is None
+
+
+def test_only_the_own_sentinel_is_deleted(monkeypatch) -> None:
+
+    cache = FakeRedisCache()
+    monkeypatch.setattr(idempotency, "RedisCache", cache)
+
+    p = idempotency.IdempotencyExternalProcessorService()
+    key = str(uuid4())
+    callctx = p.new_call_context()
+    p.process_request_headers(post_headers(key), None, callctx)
+
+    # the sentinel expired, and another request set its own
+    cache.delete(key)
+    other = p.new_call_context()
+    p.process_request_headers(post_headers(key), None, other)
+
+    response_headers = ext_api.HttpHeaders(
+        headers=EnvoyHeaderMap(headers=[EnvoyHeaderValue(key=":status", value="201")])
+    )
+    p.process_response_headers(response_headers, None, callctx)
+    assert cache.hget(key, META) == other.sentinel
+
+    p.process_response_headers(response_headers, None, other)
+    assert not cache.exists(key)
+
+
+def test_bodies_are_read_only_to_replay(monkeypatch) -> None:
+
+    cache = FakeRedisCache()
+    monkeypatch.setattr(idempotency, "RedisCache", cache)
+
+    p = idempotency.IdempotencyExternalProcessorService()
+    key = str(uuid4())
+    fields = []
+    hget = cache.hget
+    monkeypatch.setattr(cache, "hget", lambda k, f: fields.append(f) or hget(k, f))
+
+    p.process_request_headers(post_headers(key), None, p.new_call_context())
+    response = p.process_request_headers(post_headers(key), None, p.new_call_context())
+    assert response.status.code == 409
+    assert BODY not in fields
+
+    data = CachedRequestResponse(key=key, when=now_proto(), status=201, body='{"id": 1}')
+    p.cache_response(data)
+    assert idempotency.deserialize_cache_data(hget(key, META)).body == ""
+
+    p.completed.clear()
+    response = p.process_request_headers(post_headers(key), None, p.new_call_context())
+    assert response.status.code == 201
+    assert response.body == '{"id": 1}'
+    assert fields.count(BODY) == 1
+
+
+def test_large_entries_are_compressed() -> None:
+
+    data = CachedRequestResponse(
+        key=str(uuid4()), status=200, body=dumps([{"id": i} for i in range(1000)])
+    )
+    wire = idempotency.serialize_cache_data(data)
+    assert len(wire) < data.ByteSize() / 4
+    assert idempotency.deserialize_cache_data(wire) == data
+
+
+def test_entries_cached_before_compression_are_read() -> None:
+
+    data = CachedRequestResponse(key=str(uuid4()), status=201, body="{}")
+    assert idempotency.deserialize_cache_data(b64encode(data.SerializeToString())) == data
+
+
+def test_completed_responses_are_replayed_from_memory(monkeypatch) -> None:
+
+    cache = FakeRedisCache()
+    monkeypatch.setattr(idempotency, "RedisCache", cache)
+
+    # completed by another replica
+    p = idempotency.IdempotencyExternalProcessorService()
+    key = str(uuid4())
+    data = CachedRequestResponse(key=key, when=now_proto(), status=201, body='{"id": 1}')
+    cache.hsetex(key, idempotency.serialize_cache_fields(data))
+
+    gets = []
+    hget_or_setex = cache.hget_or_setex
+    monkeypatch.setattr(
+        cache, "hget_or_setex", lambda *a, **k: gets.append(a) or hget_or_setex(*a, **k)
+    )
+
+    for _ in range(3):
+        response = p.process_request_headers(post_headers(key), None, p.new_call_context())
+        assert response.status.code == 201
+        assert response.body == '{"id": 1}'
+    assert len(gets) == 1
+
+    stats = p.cache_stats()
+    assert (stats["redis"]["hits"], stats["redis"]["misses"]) == (1, 0)
+    assert (stats["l1"]["hits"], stats["l1"]["misses"]) == (2, 1)
+    assert stats["l1"]["bytes"] == len(p.completed.get(key).encoded)
+
+
+def test_cache_stats_are_logged(monkeypatch, caplog) -> None:
+
+    monkeypatch.setattr(idempotency, "RedisCache", FakeRedisCache())
+    monkeypatch.setattr(idempotency, "IDEMP_STATS_INTERVAL", 60.0)
+
+    p = idempotency.IdempotencyExternalProcessorService()
+    caplog.set_level("INFO", logger=idempotency.__name__)
+    p.process_request_headers(post_headers(str(uuid4())), None, p.new_call_context())
+    assert not caplog.records  # not yet
+
+    p._stats_logged -= 60.0
+    stats = dumps(p.cache_stats())  # as of the next request
+    p.process_request_headers(post_headers(str(uuid4())), None, p.new_call_context())
+    (record,) = caplog.records
+    assert record.getMessage() == f"Idempotency cache stats {stats}"
+    assert '"misses": 1' in stats
+
+
+@pytest.mark.parametrize("composite", (False, True))
+def test_replays_are_sent_pre_encoded(monkeypatch, composite: bool) -> None:
+
+    cache = FakeRedisCache()
+    monkeypatch.setattr(idempotency, "RedisCache", cache)
+
+    p = idempotency.IdempotencyExternalProcessorService()
+    service = CompositeExternalProcessorService([p]) if composite else p
+    key = str(uuid4())
+    data = CachedRequestResponse(
+        key=key,
+        when=now_proto(),
+        status=201,
+        headers=[CachedHeader(key="content-type", value="application/json")],
+        body='{"id": 1}',
+    )
+    p.cache_response(data)
+
+    request = ext_api.ProcessingRequest(request_headers=post_headers(key))
+    responses = [next(service.Process(iter([request]), None)) for _ in range(2)]
+    assert all(isinstance(r, bytes) for r in responses)
+    assert responses[0] is responses[1]
+
+    (response,) = parse_responses(responses[:1])
+    assert response.immediate_response == p.cached_response(data)
+
+
+def test_sentinels_are_not_kept_in_memory(monkeypatch) -> None:
+
+    cache = FakeRedisCache()
+    monkeypatch.setattr(idempotency, "RedisCache", cache)
+
+    p = idempotency.IdempotencyExternalProcessorService()
+    key = str(uuid4())
+    p.process_request_headers(post_headers(key), None, p.new_call_context())
+    response = p.process_request_headers(post_headers(key), None, p.new_call_context())
+    assert response.status.code == 409
+    assert len(p.completed) == 0
+    stats = p.cache_stats()["redis"]
+    assert (stats["hits"], stats["misses"], stats["in_progress"]) == (1, 1, 1)
+
+
+def response_headers(status: int) -> ext_api.HttpHeaders:
+    return ext_api.HttpHeaders(
+        headers=EnvoyHeaderMap(headers=[EnvoyHeaderValue(key=":status", value=str(status))])
+    )
+
+
+def waiting_service(monkeypatch, wait_time: float):
+    cache = FakeRedisCache()
+    monkeypatch.setattr(idempotency, "RedisCache", cache)
+    monkeypatch.setattr(idempotency, "RedisChannels", FakeRedisChannels(cache))
+    monkeypatch.setattr(idempotency, "IDEMP_WAIT_TIME", wait_time)
+    return idempotency.WaitingIdempotencyExternalProcessorService()
+
+
+@pytest.mark.parametrize("status", (201, 500))
+def test_duplicates_wait_for_the_request_in_progress(monkeypatch, status: int) -> None:
+
+    p = waiting_service(monkeypatch, wait_time=5.0)
+    key = str(uuid4())
+
+    async def run():
+        first, second = p.new_call_context(), p.new_call_context()
+        await p.process_request_headers(post_headers(key), None, first)
+        waiting = asyncio.create_task(p.process_request_headers(post_headers(key), None, second))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+
+        p.process_response_headers(response_headers(status), None, first)
+        p.process_response_body(ext_api.HttpBody(body=b'{"id": 1}'), None, first)
+        return await asyncio.wait_for(waiting, timeout=1.0), second
+
+    response, second = asyncio.run(run())
+    if status == 201:  # replayed
+        assert response.status.code == 201
+        assert response.body == '{"id": 1}'
+    else:  # not cached, so the duplicate proceeds
+        assert isinstance(response, ext_api.HeadersResponse)
+        assert second.cached.key == key
+
+
+def test_duplicates_stop_waiting(monkeypatch) -> None:
+
+    p = waiting_service(monkeypatch, wait_time=0.05)
+    key = str(uuid4())
+
+    async def run():
+        await p.process_request_headers(post_headers(key), None, p.new_call_context())
+        return await p.process_request_headers(post_headers(key), None, p.new_call_context())
+
+    response = asyncio.run(run())
+    assert response.status.code == 409
+
+
+def test_duplicates_dont_wait_on_a_private_event_loop(monkeypatch) -> None:
+
+    p = waiting_service(monkeypatch, wait_time=5.0)
+    key = str(uuid4())
+
+    def process() -> ext_api.ProcessingResponse:
+        request = ext_api.ProcessingRequest(request_headers=post_headers(key))
+        return parse_responses(p.Process(iter([request]), None))[0]
+
+    process()
+    started = time()
+    response = process()
+    assert time() - started < 1.0
+    assert response.immediate_response.status.code == 409
+    assert p.channels is None
+
+
+def test_waiting_is_served_only_with_asyncio(monkeypatch) -> None:
+
+    p = waiting_service(monkeypatch, wait_time=5.0)
+    with pytest.raises(ValueError):
+        service.serve(p, use_asyncio=False)
+    with pytest.raises(ValueError):
+        service.serve(CompositeExternalProcessorService([p]), use_asyncio=False)
+
+
+def test_waiting_in_a_composite_doesnt_hold_threads(monkeypatch) -> None:
+
+    p = CompositeExternalProcessorService([waiting_service(monkeypatch, wait_time=5.0)])
+    key = str(uuid4())
+
+    async def requests(queue: asyncio.Queue):
+        while (request := await queue.get()) is not None:
+            yield request
+
+    def stream(*messages: Optional[ext_api.ProcessingRequest]):
+        """a stream's (open) queue of messages, and the task collecting its responses"""
+        queue: asyncio.Queue = asyncio.Queue()
+        for message in messages:
+            queue.put_nowait(message)
+        return queue, asyncio.create_task(collect(queue))
+
+    def post(key: str) -> ext_api.ProcessingRequest:
+        return ext_api.ProcessingRequest(request_headers=post_headers(key))
+
+    async def collect(queue: asyncio.Queue):
+        return parse_responses([r async for r in p.AsyncProcess(requests(queue), None)])
+
+    async def run():
+        # a single thread: waiting streams must not hold it
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=1))
+
+        first, first_responses = stream(post(key))
+        await asyncio.sleep(0.05)
+        duplicates = [stream(post(key), None)[1] for _ in range(3)]
+        await asyncio.sleep(0.05)
+        assert not any(d.done() for d in duplicates)
+
+        # other requests go on while the duplicates wait
+        others = [stream(post(str(uuid4())), None)[1] for _ in range(5)]
+        for responses in await asyncio.wait_for(asyncio.gather(*others), timeout=5.0):
+            assert responses[0].HasField("request_headers")
+
+        first.put_nowait(ext_api.ProcessingRequest(response_headers=response_headers(201)))
+        first.put_nowait(
+            ext_api.ProcessingRequest(
+                response_body=ext_api.HttpBody(body=b'{"id": 1}', end_of_stream=True)
+            )
+        )
+        first.put_nowait(None)
+        await asyncio.wait_for(first_responses, timeout=5.0)
+        return await asyncio.wait_for(asyncio.gather(*duplicates), timeout=5.0)
+
+    for (response,) in asyncio.run(run()):
+        assert response.immediate_response.status.code == 201
+        assert response.immediate_response.body == '{"id": 1}'
@@ -0,0 +1,63 @@
+from envoy.config.core.v3.base_pb2 import HeaderMap as EnvoyHeaderMap
+from envoy.config.core.v3.base_pb2 import HeaderValue as EnvoyHeaderValue
+from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
+from gateway.identity.v1.identity_pb2 import Identity, Scope
+import pytest
+
+from extproc.processors import BaseExternalProcessorService
+from extproc.utils import identity as identity_module
+from extproc.utils.headers import HeaderView
+from extproc.utils.identity import decode_identity, encode_identity
+
+CLAIMS = {
+    "exp": 1700000000,
+    "identity": {"tenant": "tenant", "user_id": "user", "key_id": "key"},
+    "scopes": [{"resource": "keys", "action": "read"}],
+}
+
+
+def headers(**values: str) -> ext_api.HttpHeaders:
+    return ext_api.HttpHeaders(
+        headers=EnvoyHeaderMap(
+            headers=[EnvoyHeaderValue(key=k.replace("_", "-"), value=v) for k, v in values.items()]
+        )
+    )
+
+
+def test_identity_round_trip() -> None:
+    encoded = encode_identity(CLAIMS)
+    assert decode_identity(HeaderView(headers(x_gateway_identity=encoded))) == Identity(
+        tenant="tenant",
+        user_id="user",
+        key_id="key",
+        scopes=[Scope(resource="keys", action="read")],
+        expires=1700000000,
+    )
+
+
+@pytest.mark.parametrize(
+    "values,expected",
+    [
+        ({}, Identity()),
+        ({"x_gateway_identity": "not base64!"}, Identity()),
+        ({"x_gateway_tenant": "tenant", "x_gateway_userid": "user"}, Identity()),  # spoofable
+    ],
+)
+def test_missing_malformed_and_legacy_identities(values, expected: Identity) -> None:
+    assert decode_identity(HeaderView(headers(**values))) == expected
+
+
+def test_identity_is_decoded_once_per_stream(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = []
+    decode = identity_module.decode_identity
+    monkeypatch.setattr(
+        "extproc.processors.base.decode_identity", lambda view: calls.append(view) or decode(view)
+    )
+
+    p = BaseExternalProcessorService()
+    callctx = p.new_call_context()
+    assert p.identity(callctx) == Identity()  # no headers (yet)
+    request = headers(x_gateway_identity=encode_identity(CLAIMS))
+    assert p.identity(callctx, request).tenant == "tenant"
+    assert p.identity(callctx).user_id == "user"  # e.g., in a body phase
+    assert len(calls) == 1
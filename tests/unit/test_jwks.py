@@ -0,0 +1,89 @@
+from json import dumps, loads
+from pathlib import Path
+from time import time
+from uuid import uuid4
+
+import jwt
+import pytest
+
+from extproc.processors import authn
+from extproc.utils.http import Unavailable
+from extproc.utils.jwks import KeySet, KeysUnavailable, UnknownKey
+
+
+def test_keys_unavailable_until_loaded(tmp_path: Path) -> None:
+    keys = KeySet(str(tmp_path / "missing.json"))
+    keys.start = lambda: None  # no background loading
+    with pytest.raises(KeysUnavailable):
+        keys.get("kid")
+    assert not keys.reload()
+
+
+def test_stale_keys_are_kept(tmp_path: Path) -> None:
+    source = tmp_path / "jwks.json"
+    keys = KeySet(str(source))
+    keys.start = lambda: None
+    keys.keys = {"old": ("key", "RS256")}
+
+    # a failed reload keeps the (stale) keys
+    assert not keys.reload()
+    assert keys.get("old") == ("key", "RS256")
+
+    # unknown kids don't wait for a reload, they ask for one
+    with pytest.raises(UnknownKey):
+        keys.get("new")
+    assert keys._wake.is_set()
+
+    # keys that aren't for signing are skipped
+    source.write_text(dumps({"keys": [{"kid": "enc", "use": "enc", "kty": "RSA"}]}))
+    assert keys.reload()
+    assert keys.keys == {}
+
+
+@pytest.fixture
+def rsa_jwks(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    pytest.importorskip("cryptography")
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    source = tmp_path / "jwks.json"
+    source.write_text(dumps({"keys": [{**jwk, "kid": "key-1", "use": "sig"}]}))
+
+    keys = KeySet(str(source))
+    keys.start = lambda: None
+    assert keys.reload()
+    monkeypatch.setattr(authn, "TOKEN_JWKS", str(source))
+    monkeypatch.setattr(authn, "_signing_keys", keys)
+    return private_key
+
+
+def rs256_token(private_key, kid: str) -> str:
+    now = int(time())
+    claims = {
+        "exp": now + 60,
+        "iat": now,
+        "iss": authn.TOKEN_ISSUER,
+        "aud": authn.TOKEN_AUDIENCE,
+        "identity": {"tenant": str(uuid4()), "user_id": str(uuid4())},
+    }
+    return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+def test_verify_rs256_tokens(rsa_jwks) -> None:
+    claims = authn.verify_token(rs256_token(rsa_jwks, "key-1"))
+    assert "identity" in claims
+
+    with pytest.raises(authn.Unauthenticated):
+        authn.verify_token(rs256_token(rsa_jwks, "key-2"))
+
+
+def test_verify_without_keys(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    keys = KeySet(str(tmp_path / "missing.json"))
+    keys.start = lambda: None
+    monkeypatch.setattr(authn, "TOKEN_JWKS", keys.source)
+    monkeypatch.setattr(authn, "_signing_keys", keys)
+
+    header = jwt.utils.base64url_encode(dumps({"alg": "RS256", "kid": "k"}).encode()).decode()
+    with pytest.raises(Unavailable):
+        authn.verify_token(f"{header}.e30.c2ln")
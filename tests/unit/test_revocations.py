@@ -0,0 +1,59 @@
+from typing import Dict, List
+
+from extproc.utils.revocations import RevocationSet
+
+
+class FakeResponse:
+    def __init__(self, data: Dict):
+        self.data = data
+
+    def raise_for_status(self) -> None:
+        pass
+
+    def json(self) -> Dict:
+        return self.data
+
+
+class FakeClient:
+    def __init__(self, responses: List[Dict]):
+        self.responses = responses
+        self.params: List[Dict] = []
+
+    def get(self, params: Dict) -> FakeResponse:
+        self.params.append(params)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return FakeResponse(response)
+
+
+def polled(*responses: Dict, now: float = 1000.0) -> RevocationSet:
+    revocations = RevocationSet("http://auth/revocations", clock=lambda: now)
+    revocations.start = lambda: None  # no background polling
+    revocations._client = FakeClient(list(responses))
+    return revocations
+
+
+def test_polls_are_incremental() -> None:
+    revocations = polled(
+        {"cursor": 990.0, "window": 360, "revoked": [{"key_id": "a", "revoked_at": 900.0}]},
+        {"cursor": 992.0, "window": 360, "revoked": [{"key_id": "b", "revoked_at": 991.0}]},
+        ConnectionError("down"),
+    )
+    assert revocations.poll() and revocations.poll()
+    assert revocations._client.params == [{}, {"since": 990.0}]
+    assert "a" in revocations and "b" in revocations and "c" not in revocations
+
+    # a failed poll keeps the revocations, and the cursor
+    assert not revocations.poll()
+    assert "a" in revocations and revocations.cursor == 992.0
+
+
+def test_revocations_older_than_the_window_are_dropped() -> None:
+    revocations = polled(
+        {"cursor": 990.0, "window": 60, "revoked": [{"key_id": "a", "revoked_at": 900.0}]},
+        now=1000.0,
+    )
+    revocations.revoked = {"old": 100.0}
+    assert revocations.poll()
+    assert revocations.revoked == {"a": 900.0}  # only "old" is that old
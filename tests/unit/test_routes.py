@@ -0,0 +1,54 @@
+import re
+
+import pytest
+
+from extproc.utils.routes import RouteMatcher
+
+UUID_REGEX = re.compile(r"[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}")
+KEY_ID = "0b9c2d1e-5a4f-4c3b-9e8d-7f6a5b4c3d2e"
+
+
+@pytest.mark.parametrize(
+    "path,template,public",
+    [
+        ("/health", "/health", True),
+        ("/health?verbose=1", "/health", True),
+        ("/health/", "/health", True),
+        ("/docs/v0/index.html", "/docs/*", True),
+        ("/docs", "/docs/*", True),
+        (f"/api/v0/keys/{KEY_ID}", "/api/v0/keys/:", False),
+        (f"/api/v0/keys/{KEY_ID}/rotate?x=y", "/api/v0/keys/:/rotate", False),
+        ("/api/v0/keys/current", "/api/v0/keys/current", False),  # literal first
+        ("/api/v0/keys/other", "/api/v0/keys/:", False),  # registered param
+        ("/api/v0/healthy", "/api/v0/healthy", False),
+        ("/", "/", False),
+    ],
+)
+def test_match(path: str, template: str, public: bool) -> None:
+    routes = RouteMatcher([UUID_REGEX])
+    routes.add("/health", public=True)
+    routes.add("/docs/*", public=True)
+    routes.add("/api/v0/keys/:")
+    routes.add("/api/v0/keys/current")
+
+    route = routes.match(path)
+    assert (route.template, route.public) == (template, public)
+
+
+def test_matches_are_memoized() -> None:
+    routes = RouteMatcher([UUID_REGEX], cache_size=2)
+    for _ in range(3):
+        assert routes.match(f"/api/v0/keys/{KEY_ID}").template == "/api/v0/keys/:"
+    assert (routes.matches.cache_info().hits, routes.matches.cache_info().misses) == (2, 1)
+
+    # adding routes forgets matches
+    routes.add("/api/v0/keys/:", public=True)
+    assert routes.match(f"/api/v0/keys/{KEY_ID}").public
+
+
+def test_queries_are_not_memoized() -> None:
+    routes = RouteMatcher([UUID_REGEX], cache_size=2)
+    for i in range(5):
+        assert routes.match(f"/api/v0/keys/{KEY_ID}?page={i}").template == "/api/v0/keys/:"
+    info = routes.matches.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (4, 1, 1)
@@ -0,0 +1,51 @@
+from json import dumps
+from pathlib import Path
+
+import pytest
+
+from extproc.utils.scopes import (
+    claims_scopes,
+    load_route_scopes,
+    parse_scope,
+    ScopeBits,
+)
+
+
+def test_granted_scopes_cover_required() -> None:
+    bits = ScopeBits()
+    required = bits.required([("keys", "read"), ("keys", "update")])
+    assert bin(required).count("1") == 2
+
+    assert bits.granted([("keys", "read")]) & required != required
+    assert bits.granted([("keys", "read"), ("keys", "write")]) & required == required
+    assert bits.granted([("other", "read")]) == 0  # no bit, not required anywhere
+
+
+def test_write_requires_create_update_and_delete() -> None:
+    bits = ScopeBits()
+    required = bits.required([("keys", "write")])
+    assert bits.granted([("keys", "create"), ("keys", "update")]) & required != required
+    assert bits.granted([("keys", "write")]) & required == required
+
+
+def test_claims_scopes() -> None:
+    claims = {"scopes": [{"resource": "keys", "action": "read"}]}
+    assert claims_scopes(claims) == [("keys", "read")]
+    assert claims_scopes({}) == []
+
+
+@pytest.mark.parametrize("scope", ["keys", ":read", "keys:"])
+def test_malformed_scopes(scope: str) -> None:
+    with pytest.raises(ValueError):
+        parse_scope(scope)
+
+
+def test_load_route_scopes(tmp_path: Path) -> None:
+    document = {"/api/v0/keys/:": {"get": ["keys:read"], "*": ["keys:write"]}}
+    expected = {"/api/v0/keys/:": {"GET": [("keys", "read")], "*": [("keys", "write")]}}
+    assert load_route_scopes(dumps(document)) == expected
+
+    path = tmp_path / "scopes.json"
+    path.write_text(dumps(document))
+    assert load_route_scopes(str(path)) == expected
+    assert load_route_scopes("") == {}
@@ -0,0 +1,75 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+from textwrap import dedent
+import time
+
+from envoy.service.ext_proc.v3 import external_processor_pb2 as ext_api
+import grpc
+import pytest
+
+from extproc import service
+from extproc.processors import BaseExternalProcessorService
+
+# workers each take a (slow) stream, then stop when it's in flight
+SERVER = dedent("""
+    import time
+
+    from extproc.processors import BaseExternalProcessorService
+    from extproc.service import serve_processes
+
+
+    class SlowService(BaseExternalProcessorService):
+        def process_request_headers(self, headers, grpcctx, callctx):
+            time.sleep(1.0)
+            return self.just_continue_headers()
+
+
+    serve_processes(SlowService, 2)
+    """)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def test_requires_asyncio_is_refused_without_it() -> None:
+    class AsyncOnly(BaseExternalProcessorService):
+        requires_asyncio = True
+
+    with pytest.raises(ValueError):
+        service.serve(AsyncOnly(), use_asyncio=False)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="pre-forking needs fork")
+def test_workers_stop_gracefully() -> None:
+
+    port = free_port()
+    env = dict(os.environ, GRPC_PORT=str(port), GRPC_SHUTDOWN_GRACE="5.0")
+    server = subprocess.Popen([sys.executable, "-c", SERVER], env=env)
+    try:
+        request = ext_api.ProcessingRequest(request_headers=ext_api.HttpHeaders())
+        in_flight = []
+        for _ in range(4):  # connections, balanced between the workers
+            channel = grpc.insecure_channel(f"localhost:{port}")
+            grpc.channel_ready_future(channel).result(timeout=10.0)
+            process = channel.stream_stream(
+                f"/{service.EXT_PROC_SERVICE_NAME}/Process",
+                request_serializer=ext_api.ProcessingRequest.SerializeToString,
+                response_deserializer=ext_api.ProcessingResponse.FromString,
+            )
+            in_flight.append(process(iter([request])))
+
+        time.sleep(0.3)
+        server.send_signal(signal.SIGTERM)
+
+        for responses in in_flight:
+            assert [r.WhichOneof("response") for r in responses] == ["request_headers"]
+        assert server.wait(timeout=10.0) == 0
+    finally:
+        if server.poll() is None:
+            server.kill()
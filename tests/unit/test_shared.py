@@ -0,0 +1,100 @@
+from hashlib import sha256
+import os
+from pathlib import Path
+
+import pytest
+
+from extproc.utils.shared import PROBES, SEQUENCE, SharedCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def key(name: str) -> bytes:
+    return sha256(name.encode()).digest()
+
+
+def test_get_and_set(tmp_path: Path) -> None:
+    cache = SharedCache(str(tmp_path / "cache"), slots=64, slot_size=128, clock=Clock())
+    assert cache.get(key("a")) is None
+    assert cache.set(key("a"), b"value", 2000)
+    assert cache.get(key("a")) == (b"value", 2000)
+    assert cache.set(key("a"), b"other", 3000)  # replaced, in the same slot
+    assert cache.get(key("a")) == (b"other", 3000)
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # too big, or expired already
+    assert not cache.set(key("b"), b"x" * 100, 2000)
+    assert not cache.set(key("b"), b"value", 1000)
+
+
+def test_entries_expire(tmp_path: Path) -> None:
+    clock = Clock()
+    cache = SharedCache(str(tmp_path / "cache"), slots=64, clock=clock)
+    cache.set(key("a"), b"value", 1060)
+    clock.now += 60
+    assert cache.get(key("a")) is None
+
+
+def test_full_slots_evict_the_first_to_expire(tmp_path: Path) -> None:
+    # PROBES slots, so all keys share them
+    cache = SharedCache(str(tmp_path / "cache"), slots=PROBES, clock=Clock())
+    for i in range(PROBES):
+        cache.set(key(str(i)), b"value", 2000 + i)
+    cache.set(key("new"), b"value", 3000)
+    assert cache.get(key("0")) is None
+    assert all(cache.get(key(str(i))) for i in range(1, PROBES))
+    assert cache.get(key("new"))
+
+
+def test_processes_share_entries(tmp_path: Path) -> None:
+    path = str(tmp_path / "cache")
+    first = SharedCache(path, slots=64)
+    first.set(key("a"), b"value", 2e9)
+
+    pid = os.fork()
+    if pid == 0:  # another process, with its own mapping
+        second = SharedCache(path, slots=64)
+        ok = second.get(key("a")) == (b"value", 2e9) and second.secret == first.secret
+        ok = ok and second.set(key("b"), b"from child", 2e9)
+        os._exit(0 if ok else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert first.get(key("b")) == (b"from child", 2e9)
+
+
+def test_other_settings_use_another_file(tmp_path: Path) -> None:
+    path = str(tmp_path / "cache")
+    first = SharedCache(path, slots=64)
+    first.set(key("a"), b"value", 2e9)
+    second = SharedCache(path, slots=128)
+    assert second.path != first.path
+    assert second.get(key("a")) is None
+    assert second.secret != first.secret
+    assert first.get(key("a")) == (b"value", 2e9)
+
+
+def test_other_files_are_refused(tmp_path: Path) -> None:
+    path = str(tmp_path / "cache")
+    other = Path(f"{path}-64x2048")
+    other.write_bytes(b"not a cache")
+    with pytest.raises(ValueError):
+        SharedCache(path, slots=64)
+    assert other.read_bytes() == b"not a cache"  # not truncated
+
+
+def test_slots_being_written_are_misses(tmp_path: Path) -> None:
+    cache = SharedCache(str(tmp_path / "cache"), slots=PROBES)
+    cache.set(key("a"), b"value", 2e9)
+    offset = cache._offsets(key("a"))[0]
+    SEQUENCE.pack_into(cache._map, offset, SEQUENCE.unpack_from(cache._map, offset)[0] | 1)
+    assert cache.get(key("a")) is None
+
+
+def test_slots_are_checked(tmp_path: Path) -> None:
+    with pytest.raises(ValueError):
+        SharedCache(str(tmp_path / "cache"), slots=PROBES - 1)